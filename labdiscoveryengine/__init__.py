@@ -3,9 +3,8 @@ import os
 import sys
 from typing import Dict, Optional
 from babel import Locale
-from flask import Flask, has_request_context, request, session
+from flask import Flask, current_app, has_request_context, request, session
 
-import yaml
 from flask_babel import Babel
 from flask_assets import Environment
 from flask_pymongo import PyMongo
@@ -49,6 +48,7 @@ def running_mode() -> str:
     return 'web'
 
 from labdiscoveryengine.scheduling.sync.web_api import initialize_web
+from labdiscoveryengine.history.retention import ArchiveModes, ensure_archive_indexes
 
 def create_app(config_name: Optional[str] = None):
     if config_name is None:
@@ -60,7 +60,9 @@ def create_app(config_name: Optional[str] = None):
     # configuration.variables module, so it uses os.environ which can be
     # precisely the configuration.yml file as defaults.
     if os.path.exists('configuration.yml'):
-        configuration = yaml.safe_load(open('configuration.yml'))
+        from .configuration.storage import load_yaml
+        with open('configuration.yml') as configuration_file:
+            configuration = load_yaml(configuration_file)
         for configuration_key, configuration_value in configuration.items():
             os.environ[configuration_key] = str(configuration_value)
 
@@ -133,6 +135,9 @@ def create_app(config_name: Optional[str] = None):
     if running_mode() == 'web':
         initialize_web(app)
 
+        from .configuration.storage import ConfigurationReloader
+        app.before_request(ConfigurationReloader(app).reload_if_needed)
+
     return app
     
 
@@ -143,6 +148,12 @@ def create_mongodb_indexes():
                     'end_reservation']:
         mongo.db.sessions.create_index(column)
 
+    mongo.db.session_rollups.create_index([('laboratory', 1), ('resource', 1), ('hour', 1)], unique=True)
+    mongo.db.session_rollups.create_index('hour')
+
+    if current_app.config.get('SESSIONS_ARCHIVE_MODE') == ArchiveModes.collection:
+        ensure_archive_indexes(mongo.db.sessions_archive, current_app.config.get('SESSIONS_ARCHIVE_TTL_DAYS'))
+
 SUPPORTED_TRANSLATIONS = None
 SUPPORTED_LANGUAGES = None
 
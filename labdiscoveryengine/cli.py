@@ -1,4 +1,5 @@
 import datetime
+import json
 import os
 import sys
 import time
@@ -9,7 +10,7 @@ import multiprocessing
 import asyncio
 import logging
 
-from typing import Callable, Dict, Optional
+from typing import Callable, Dict, List, Optional
 
 import click
 from alembic import command as alembic_command
@@ -18,8 +19,11 @@ from flask_migrate import Config as MigrationConfig
 import labdiscoveryengine
 from labdiscoveryengine import create_app
 from labdiscoveryengine.configuration.exc import InvalidUsernameConfigurationError
+from labdiscoveryengine.history.retention import ArchiveModes, apply_retention_policy, ensure_archive_indexes
+from labdiscoveryengine.history.export import ExportFormats, is_format_available, iter_sessions, write_csv, write_parquet
 from labdiscoveryengine.configuration.storage import change_credentials_password, create_admin_user, create_deployment_folder, create_external_user as storage_create_external_user, list_users, check_credentials_password
 from labdiscoveryengine.scheduling.asyncio.runner import main as runner_main
+from labdiscoveryengine.scheduling.supervisor import ShardSupervisor
 
 def with_app(func: Callable):
     """
@@ -335,6 +339,8 @@ def deployments_add_supervisor(directory: str, force: bool, name: str, user: str
         "autorestart=true",
         "stopasgroup=true",
         "killasgroup=true",
+        # On SIGTERM the worker hands the running sessions over (up to WORKER_DRAIN_TIMEOUT seconds)
+        "stopwaitsecs=60",
     ]
 
     supervisor_config = ''.join([
@@ -538,6 +544,90 @@ def check_external_user_password(login: str, password: Optional[str] = None):
     if not check_credentials_password('external', login, password):
         sys.exit(1)
 
+@lde.group('sessions')
+def sessions_group():
+    """
+    Session history-related commands (requires MongoDB)
+    """
+
+@sessions_group.command('export')
+@click.option('-o', '--output', type=click.Path(dir_okay=False, allow_dash=True), required=True, help="Output file (- for stdout, only in CSV)")
+@click.option('-f', '--format', 'export_format', type=click.Choice(ExportFormats.all_formats), default=None, help="Output format. By default, guessed from the output file extension (CSV otherwise)")
+@click.option('--since', type=click.DateTime(), default=None, help="Only sessions requested on or after this date (UTC)")
+@click.option('--until', type=click.DateTime(), default=None, help="Only sessions requested before this date (UTC)")
+@click.option('-l', '--laboratory', 'laboratories', multiple=True, help="Only sessions of this laboratory (can be repeated)")
+@click.option('--batch-size', type=int, default=1000, help="Number of sessions retrieved from MongoDB at a time")
+@with_app
+def sessions_export(output: str, export_format: Optional[str], since: Optional[datetime.datetime], until: Optional[datetime.datetime], laboratories: List[str], batch_size: int):
+    """
+    Export the session history to CSV or Parquet
+    """
+    from labdiscoveryengine import mongo
+    from labdiscoveryengine.utils import is_mongo_active
+
+    if not is_mongo_active():
+        click.echo(click.style("Error: MONGO_URI is not configured, so there is no session history to export", fg='red'))
+        sys.exit(1)
+
+    if export_format is None:
+        export_format = ExportFormats.parquet if output.endswith('.parquet') else ExportFormats.csv
+
+    if not is_format_available(export_format):
+        click.echo(click.style(f"Error: {export_format} is not available. Exporting to Parquet requires pyarrow (pip install pyarrow)", fg='red'))
+        sys.exit(1)
+
+    sessions = iter_sessions(mongo.db.sessions, since=since, until=until, laboratories=laboratories, batch_size=batch_size)
+
+    if export_format == ExportFormats.csv:
+        if output == '-':
+            total = write_csv(sessions, sys.stdout)
+        else:
+            with open(output, 'w', newline='') as output_file:
+                total = write_csv(sessions, output_file)
+    else:
+        if output == '-':
+            click.echo(click.style("Error: Parquet cannot be written to stdout", fg='red'))
+            sys.exit(1)
+        with open(output, 'wb') as output_file:
+            total = write_parquet(sessions, output_file)
+
+    print(f"[{time.asctime()}] {total} sessions exported", file=sys.stderr)
+
+@sessions_group.command('archive')
+@click.option('--days', type=float, default=None, help="Archive sessions older than these days (by default, SESSIONS_RETENTION_DAYS)")
+@click.option('--mode', type=click.Choice(ArchiveModes.all_modes), default=None, help="Archive in the sessions_archive collection or in files (by default, SESSIONS_ARCHIVE_MODE)")
+@click.option('--directory', type=click.Path(dir_okay=True, file_okay=False), default=None, help="Directory of the archive files (by default, SESSIONS_ARCHIVE_DIRECTORY)")
+@with_app
+def sessions_archive(days: Optional[float], mode: Optional[str], directory: Optional[str]):
+    """
+    Move old sessions to the archive (the worker does it periodically if SESSIONS_RETENTION_DAYS is set)
+    """
+    from flask import current_app
+    from labdiscoveryengine import mongo
+    from labdiscoveryengine.utils import is_mongo_active
+
+    if not is_mongo_active():
+        click.echo(click.style("Error: MONGO_URI is not configured, so there is no session history to archive", fg='red'))
+        sys.exit(1)
+
+    config = dict(current_app.config)
+    if days is not None:
+        config['SESSIONS_RETENTION_DAYS'] = days
+    if mode is not None:
+        config['SESSIONS_ARCHIVE_MODE'] = mode
+    if directory is not None:
+        config['SESSIONS_ARCHIVE_DIRECTORY'] = directory
+
+    if config.get('SESSIONS_RETENTION_DAYS') is None:
+        click.echo(click.style("Error: pass --days or configure SESSIONS_RETENTION_DAYS", fg='red'))
+        sys.exit(1)
+
+    if config.get('SESSIONS_ARCHIVE_MODE') == ArchiveModes.collection:
+        ensure_archive_indexes(mongo.db.sessions_archive, config.get('SESSIONS_ARCHIVE_TTL_DAYS'))
+
+    total = apply_retention_policy(config, mongo.db)
+    print(f"[{time.asctime()}] {total} sessions archived")
+
 @lde.group('worker')
 def worker_group():
     """
@@ -545,18 +635,61 @@ def worker_group():
     """
 
 @worker_group.command('run')
+@click.option('--processes', type=int, default=None, help="Number of worker processes, among which resources are distributed. By default, WORKER_PROCESSES (1)")
 @with_app
-def worker_run():
+def worker_run(processes: Optional[int]):
     """
     Run the worker
     """
+    from flask import current_app
+
+    if processes is None:
+        processes = current_app.config['WORKER_PROCESSES']
+    if processes < 1:
+        raise click.BadParameter("There must be at least one process", param_hint='--processes')
+
     logging.basicConfig(level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s')
 
     formatted_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
     print(f"[{formatted_time}] Starting worker...", flush=True)
     print(f"[{formatted_time}] Starting worker...", file=sys.stderr, flush=True)
 
-    asyncio.run(runner_main())
+    if processes == 1:
+        asyncio.run(runner_main())
+    else:
+        stop_timeout = current_app.config['WORKER_DRAIN_TIMEOUT'] + 10
+        ShardSupervisor(processes, os.environ.get('FLASK_CONFIG', 'production'), stop_timeout=stop_timeout).run()
+
+@worker_group.command('status')
+@with_app
+def worker_status():
+    """
+    Show the state of the worker of each resource, as reported by the running workers
+    """
+    from labdiscoveryengine.scheduling.keys import WorkerKeys
+    from labdiscoveryengine.scheduling.sync.web_api import redis_store
+    from labdiscoveryengine.scheduling.asyncio.runner import WorkerAggregator
+    from labdiscoveryengine.utils import get_lde_config
+
+    reported_states = redis_store.hgetall(WorkerKeys.resources())
+    now = time.time()
+
+    for resource in sorted(set(get_lde_config().resources) | set(reported_states)):
+        if resource not in reported_states:
+            print(f"{resource}: not reported by any worker")
+            continue
+
+        state = json.loads(reported_states[resource])
+        line = f"{resource}: {state['state']} for {now - state['since']:.0f}s in {state['owner']}"
+        if state.get('reservation'):
+            line += f" (reservation {state['reservation']})"
+        if state.get('error'):
+            line += f" (error: {state['error']})"
+        if not state.get('healthchecks'):
+            line += " [healthchecks not running]"
+        if now - state['updated_at'] > 2 * WorkerAggregator.state_refresh_interval:
+            line += f" [last report {now - state['updated_at']:.0f}s ago]"
+        print(line)
 
 if __name__ == '__main__':
     lde()
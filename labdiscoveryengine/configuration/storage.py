@@ -1,22 +1,37 @@
+import os
+import re
 import time
+import pickle
+import hashlib
 import pathlib
+import tempfile
+import threading
 import secrets
 import datetime
 
 from collections import OrderedDict
 from functools import partial
-from typing import Any, Dict, List, NamedTuple, Optional, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import yaml
 from flask import current_app
 
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from labdiscoveryengine.configuration.exc import ConfigurationDirectoryNotFoundError, ConfigurationFileNotFoundError, InvalidConfigurationFoundError, InvalidConfigurationValueError, InvalidLaboratoryConfigurationError, InvalidUsernameConfigurationError
+from labdiscoveryengine.configuration.exc import ConfigurationDirectoryNotFoundError, ConfigurationError, ConfigurationFileNotFoundError, InvalidConfigurationFoundError, InvalidConfigurationValueError, InvalidLaboratoryConfigurationError, InvalidUsernameConfigurationError
 
 from ..data import Administrator, Camera, ExternalUser, Healthcheck, HttpHealthcheck, ImageCamera, Laboratory, Resource, RobotcheckerHealthcheck
 
 
+# Use the libyaml-based loader if PyYAML was compiled with it (much faster)
+YamlSafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def load_yaml(stream) -> Any:
+    """
+    Equivalent to yaml.safe_load, but using libyaml when available
+    """
+    return yaml.load(stream, Loader=YamlSafeLoader)
+
 # Define a custom representer for OrderedDict
 def represent_ordered_dict(dumper, data):
     return dumper.represent_mapping('tag:yaml.org,2002:map', data.items())
@@ -61,6 +76,20 @@ class StoredConfiguration(NamedTuple):
             }
         )
     
+    def copy(self) -> 'StoredConfiguration':
+        """
+        Return a new configuration with the same values, which can be modified without
+        affecting this one (the values themselves are immutable).
+        """
+        return StoredConfiguration(
+            administrators=dict(self.administrators),
+            external_users=dict(self.external_users),
+            laboratories=dict(self.laboratories),
+            resources=dict(self.resources),
+            variables=dict(self.variables),
+            last_check=dict(self.last_check),
+        )
+
     def clear(self):
         """
         Clear the configuration.
@@ -92,18 +121,29 @@ def get_current_deployment_directory() -> pathlib.Path:
 
 def get_latest_configuration(configuration: Optional[StoredConfiguration] = None) -> StoredConfiguration:
     """
-    If a configuration is provided, it will modify it if the files have changed. 
-    
+    If a configuration is provided and the files have changed, it will return a new
+    configuration with the changes applied. If nothing changed, the same configuration
+    is returned. The provided configuration is never modified, so it can be safely
+    used (e.g., by other threads) while the new one is being built, and replaced
+    at once afterwards.
+
     If the configuration is not provided, it will create a new one.
     """
     directory: pathlib.Path = get_current_deployment_directory()
 
     configuration_files: Dict[str, pathlib.Path] = _generate_files_dict(directory)
 
+    snapshot_key: Optional[str] = None
     if configuration is None:
-        configuration = StoredConfiguration.create_empty()
+        # Cold start: if the files were already parsed with the same contents, reuse it
+        if current_app.config.get('CONFIGURATION_CACHE', True):
+            snapshot_key, modification_times = _get_snapshot_key(configuration_files)
+            cached_configuration = _load_snapshot(directory, snapshot_key, modification_times)
+            if cached_configuration is not None:
+                cached_configuration.apply_variables()
+                return cached_configuration
 
-    get_config = partial(_get_config, configuration)
+        configuration = StoredConfiguration.create_empty()
 
     configuration_values: Dict[str, Dict] = {}
     configuration_checks: Dict[str, datetime.datetime] = {}
@@ -116,29 +156,26 @@ def get_latest_configuration(configuration: Optional[StoredConfiguration] = None
         if configuration.last_check[configuration_type] >= modification_time_before_reading:
             continue
 
-        # By default one day in the future
-        modification_time_after_reading = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        configuration_values[configuration_type], configuration_checks[configuration_type] = _read_configuration_file(configuration_file_path)
 
-        # If the the file has potentially been modified after it was read, read again just in case.
-        while modification_time_after_reading > modification_time_before_reading:
+    # The laboratories are built from the resources, and the external users from the laboratories:
+    # build them again too, so a reload accepts exactly the same files as a cold start
+    for dependency, dependent in ((ConfigurationFileNames.resources, ConfigurationFileNames.laboratories),
+                                  (ConfigurationFileNames.laboratories, ConfigurationFileNames.credentials)):
+        if dependency in configuration_values and dependent not in configuration_values:
+            configuration_values[dependent], configuration_checks[dependent] = _read_configuration_file(configuration_files[dependent])
 
-            modification_time_before_reading = datetime.datetime.utcfromtimestamp(configuration_file_path.stat().st_mtime)
-            with configuration_file_path.open() as f:
-                try:
-                    file_data = yaml.safe_load(f)
-                except Exception as err:
-                    raise InvalidConfigurationFoundError(f"Invalid configuration in file {configuration_file_path.absolute()}: {err}")
-                
-            configuration_values[configuration_type] = file_data or {}
-            configuration_checks[configuration_type] = modification_time_before_reading
+    if not configuration_values:
+        return configuration
+
+    # Copy on write: apply the changes on a new configuration
+    configuration = configuration.copy()
+    get_config = partial(_get_config, configuration)
 
-            modification_time_after_reading = datetime.datetime.utcfromtimestamp(configuration_file_path.stat().st_mtime)
-    
     if ConfigurationFileNames.configuration in configuration_values:
         try:
             configuration.variables.update(configuration_values[ConfigurationFileNames.configuration])
             configuration.last_check[ConfigurationFileNames.configuration] = configuration_checks[ConfigurationFileNames.configuration]
-            configuration.apply_variables()
         except Exception as err:
             raise InvalidConfigurationValueError(f"Invalid variables in file {configuration_files[ConfigurationFileNames.configuration].absolute()}: {err}")
 
@@ -172,9 +209,9 @@ def get_latest_configuration(configuration: Optional[StoredConfiguration] = None
                     url=resource_url,
                     login=resource_login,
                     password=resource_password,
-                    features=resource_features,
-                    healthchecks=resource_healthchecks,
-                    cameras=resource_cameras,
+                    features=frozenset(resource_features),
+                    healthchecks=tuple(resource_healthchecks),
+                    cameras=tuple(resource_cameras),
                     api=resource_api
                 )
                 
@@ -208,12 +245,13 @@ def get_latest_configuration(configuration: Optional[StoredConfiguration] = None
                     display_name=laboratory_data.get('display_name') or identifier,
                     category=laboratory_data.get('category'),
                     description=laboratory_data.get('description'),
-                    keywords=laboratory_data.get('keywords') or [],
+                    keywords=tuple(laboratory_data.get('keywords') or []),
                     max_time=laboratory_data.get('max_time') or get_config('DEFAULT_MAX_TIME'),
-                    resources=resources,
-                    features=features,
+                    resources=frozenset(resources),
+                    features=frozenset(features),
                     image=laboratory_data.get('image', ''),
                     bypass_resource_health=bool(laboratory_data.get('bypass_resource_health', False)),
+                    prewarm=int(laboratory_data.get('prewarm') or 0),
                 )
                 configuration.laboratories[identifier] = laboratories[identifier]
 
@@ -263,7 +301,7 @@ def get_latest_configuration(configuration: Optional[StoredConfiguration] = None
                                                             name=external_user_data.get('name') or login,
                                                             email=external_user_data.get('email'),
                                                             hashed_password=external_user_data['password'],
-                                                            laboratories=external_user_laboratories
+                                                            laboratories=frozenset(external_user_laboratories)
                                                     )
                 added_external_users.append(login)
             
@@ -274,9 +312,148 @@ def get_latest_configuration(configuration: Optional[StoredConfiguration] = None
             configuration.last_check[ConfigurationFileNames.credentials] = configuration_checks[ConfigurationFileNames.credentials]
         except Exception as err:
             raise InvalidConfigurationValueError(f"Invalid credentials in file {configuration_files[ConfigurationFileNames.credentials].absolute()}: {err}")
-        
+
+    # Only now that the whole configuration is valid (otherwise the previous one is kept, with its variables)
+    if ConfigurationFileNames.configuration in configuration_values:
+        configuration.apply_variables()
+
+    # Only store it if the files did not change while they were parsed
+    if snapshot_key is not None and _get_snapshot_key(configuration_files)[0] == snapshot_key:
+        _store_snapshot(directory, snapshot_key, configuration)
+
     return configuration
 
+def _read_configuration_file(configuration_file_path: pathlib.Path) -> Tuple[Dict, datetime.datetime]:
+    """
+    Read a configuration file. Returns its contents and its modification time
+    """
+    # By default one day in the future
+    modification_time_after_reading = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    modification_time_before_reading = datetime.datetime.utcfromtimestamp(configuration_file_path.stat().st_mtime)
+
+    # If the the file has potentially been modified after it was read, read again just in case.
+    while modification_time_after_reading > modification_time_before_reading:
+
+        modification_time_before_reading = datetime.datetime.utcfromtimestamp(configuration_file_path.stat().st_mtime)
+        with configuration_file_path.open() as f:
+            try:
+                file_data = load_yaml(f)
+            except Exception as err:
+                raise InvalidConfigurationFoundError(f"Invalid configuration in file {configuration_file_path.absolute()}: {err}")
+
+        modification_time_after_reading = datetime.datetime.utcfromtimestamp(configuration_file_path.stat().st_mtime)
+
+    return file_data or {}, modification_time_before_reading
+
+# Increase it whenever the format of StoredConfiguration changes
+_SNAPSHOT_FORMAT = 2
+_SNAPSHOT_DIRECTORY = '.lde-cache'
+# Variables of current_app.config used while parsing the files (if not in configuration.yml)
+_SNAPSHOT_DEFAULTS = ('DEFAULT_MAX_TIME', 'DEFAULT_RESOURCE_LOGIN', 'DEFAULT_RESOURCE_PASSWORD')
+
+def _get_snapshot_key(configuration_files: Dict[str, pathlib.Path]):
+    """
+    Return the key of the configuration snapshot (a hash of the contents of the
+    configuration files and of the code parsing them), and the modification times
+    of the files when they were hashed.
+    """
+    modification_times: Dict[str, datetime.datetime] = {}
+    key = hashlib.sha256()
+    key.update(f"{_SNAPSHOT_FORMAT}:{pickle.HIGHEST_PROTOCOL}".encode())
+
+    # If LabDiscoveryEngine is upgraded, the snapshot must not be used
+    for module_file in (__file__, pathlib.Path(__file__).parent.parent / 'data.py'):
+        module_stat = os.stat(module_file)
+        key.update(f"{module_stat.st_mtime}:{module_stat.st_size}".encode())
+
+    for configuration_type, configuration_file_path in configuration_files.items():
+        if not configuration_file_path.exists():
+            raise ConfigurationFileNotFoundError(f"File does not exist: {configuration_file_path.absolute()}")
+        modification_times[configuration_type] = datetime.datetime.utcfromtimestamp(configuration_file_path.stat().st_mtime)
+        key.update(configuration_type.encode())
+        key.update(configuration_file_path.read_bytes())
+
+    return key.hexdigest(), modification_times
+
+def _load_snapshot(directory: pathlib.Path, snapshot_key: str, modification_times: Dict[str, datetime.datetime]) -> Optional[StoredConfiguration]:
+    snapshot_path = directory / _SNAPSHOT_DIRECTORY / f"configuration-{snapshot_key}.pickle"
+    try:
+        with snapshot_path.open('rb') as f:
+            used_defaults, configuration = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        # e.g., a corrupted file: parse the configuration again
+        current_app.logger.warning(f"Ignoring invalid configuration snapshot {snapshot_path}: {err}")
+        return None
+
+    if not isinstance(configuration, StoredConfiguration):
+        return None
+
+    # e.g., DEFAULT_RESOURCE_PASSWORD was changed in an environment variable
+    for default_name, default_value in used_defaults.items():
+        if current_app.config.get(default_name) != default_value:
+            return None
+
+    # The contents are the same, but the files might have been touched since the snapshot was stored
+    configuration.last_check.update(modification_times)
+    return configuration
+
+def _store_snapshot(directory: pathlib.Path, snapshot_key: str, configuration: StoredConfiguration):
+    snapshot_directory = directory / _SNAPSHOT_DIRECTORY
+    snapshot_filename = f"configuration-{snapshot_key}.pickle"
+    used_defaults = {
+        default_name: current_app.config.get(default_name)
+        for default_name in _SNAPSHOT_DEFAULTS
+        if default_name not in configuration.variables
+    }
+    try:
+        snapshot_directory.mkdir(exist_ok=True)
+        # Write it in a temporary file and rename it, so other processes never see a partial snapshot
+        with tempfile.NamedTemporaryFile('wb', dir=snapshot_directory, prefix='.tmp-', delete=False) as f:
+            pickle.dump((used_defaults, configuration), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, snapshot_directory / snapshot_filename)
+
+        for previous_snapshot in snapshot_directory.glob('configuration-*.pickle'):
+            if previous_snapshot.name != snapshot_filename:
+                previous_snapshot.unlink()
+    except OSError as err:
+        # e.g., a read-only deployment directory. The snapshot is just an optimization.
+        current_app.logger.warning(f"Could not store the configuration snapshot in {snapshot_directory}: {err}")
+
+class ConfigurationReloader:
+    """
+    Reload the configuration of a Flask app (LDE_CONFIG) if the files changed, checking
+    at most once every CONFIGURATION_RELOAD_INTERVAL seconds. It is meant to be called
+    before every request of the web processes (e.g., every gunicorn worker), where it
+    costs a timestamp comparison most of the time, and four stat calls otherwise.
+
+    The new configuration replaces the previous one in a single assignment, so
+    requests see either the previous one or the new one.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.last_check = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reload_if_needed(self):
+        interval = self.app.config.get('CONFIGURATION_RELOAD_INTERVAL')
+        if not interval or time.monotonic() - self.last_check < interval:
+            return
+
+        # If another thread is already reloading it, do not wait for it
+        if not self.lock.acquire(blocking=False):
+            return
+
+        try:
+            self.last_check = time.monotonic()
+            try:
+                self.app.config['LDE_CONFIG'] = get_latest_configuration(self.app.config['LDE_CONFIG'])
+            except ConfigurationError as err:
+                current_app.logger.error(f"Error reloading the configuration (keeping the previous one): {err}")
+        finally:
+            self.lock.release()
+
 def _parse_healthchecks_config(config: Optional[dict]) -> List[Healthcheck]:
     """
     For a configuration such as:
@@ -286,6 +463,13 @@ def _parse_healthchecks_config(config: Optional[dict]) -> List[Healthcheck]:
             url: http://192.168.0.101/status
             # other properties, such as code or something more comples
             # or even type: (and a complete different type of check)
+        test-fpga2:
+            url: http://192.168.0.102/status
+            expected_status: 200
+            body_regex: "ready"
+            json_path: devices.0.status
+            json_value: ok
+            max_latency: 2
     """
     result = []
     if config is None:
@@ -293,18 +477,34 @@ def _parse_healthchecks_config(config: Optional[dict]) -> List[Healthcheck]:
     
     for healthcheck_identifier, healthcheck_properties in config.items():
         if isinstance(healthcheck_properties, str):
-            healthcheck_url = healthcheck_properties
-            healthcheck_type = 'http'
-            timeout = 10
-        else:
-            healthcheck_type = healthcheck_properties.get('type') or 'http'
-            healthcheck_url = healthcheck_properties.get('url')
-            timeout = float(healthcheck_properties.get('timeout') or 10)
+            healthcheck_properties = { 'url': healthcheck_properties }
+
+        healthcheck_type = healthcheck_properties.get('type') or 'http'
+        healthcheck_url = healthcheck_properties.get('url')
+        timeout = float(healthcheck_properties.get('timeout') or 10)
+
+        if not healthcheck_url:
+            raise InvalidConfigurationValueError(f"Healthcheck {healthcheck_identifier} has no 'url' defined")
 
         if healthcheck_type == 'robotchecker':
             result.append(RobotcheckerHealthcheck(identifier=healthcheck_identifier, url=healthcheck_url, timeout=timeout))
         else:
-            result.append(HttpHealthcheck(identifier=healthcheck_identifier, url=healthcheck_url, timeout=timeout))
+            body_regex = healthcheck_properties.get('body_regex')
+            if body_regex is not None:
+                try:
+                    re.compile(body_regex)
+                except re.error as err:
+                    raise InvalidConfigurationValueError(f"Healthcheck {healthcheck_identifier} has an invalid body_regex: {err}")
+
+            max_latency = healthcheck_properties.get('max_latency')
+            result.append(HttpHealthcheck(
+                identifier=healthcheck_identifier, url=healthcheck_url, timeout=timeout,
+                expected_status=int(healthcheck_properties.get('expected_status') or 200),
+                body_regex=body_regex,
+                json_path=healthcheck_properties.get('json_path'),
+                json_value=healthcheck_properties.get('json_value'),
+                max_latency=float(max_latency) if max_latency else None,
+            ))
 
     return result
 
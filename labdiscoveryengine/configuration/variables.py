@@ -23,6 +23,74 @@ class Config:
     SQLALCHEMY_DATABASE_URI: Optional[str] = os.environ.get('SQLALCHEMY_DATABASE_URI')
     MONGO_URI: Optional[str] = os.environ.get('MONGO_URI')
 
+    # Store a snapshot of the parsed configuration files in the .lde-cache directory of the deployment,
+    # so processes starting with the same configuration files do not parse them again
+    CONFIGURATION_CACHE: bool = (os.environ.get('CONFIGURATION_CACHE') or 'true').lower() not in ('0', 'false', 'no')
+
+    # How often (in seconds) the worker and each web process check if the configuration files changed (0 to disable)
+    CONFIGURATION_RELOAD_INTERVAL: float = float(os.environ.get('CONFIGURATION_RELOAD_INTERVAL') or '5')
+
+    # Sessions older than SESSIONS_RETENTION_DAYS are moved to the archive (by default, never).
+    # The archive is either the sessions_archive collection or gzipped files in SESSIONS_ARCHIVE_DIRECTORY
+    # (by default, the archive directory of the deployment). Archived sessions are deleted after
+    # SESSIONS_ARCHIVE_TTL_DAYS (by default, never).
+    SESSIONS_RETENTION_DAYS: Optional[float] = float(os.environ['SESSIONS_RETENTION_DAYS']) if os.environ.get('SESSIONS_RETENTION_DAYS') else None
+    SESSIONS_ARCHIVE_MODE: str = os.environ.get('SESSIONS_ARCHIVE_MODE') or 'collection'
+    SESSIONS_ARCHIVE_TTL_DAYS: Optional[float] = float(os.environ['SESSIONS_ARCHIVE_TTL_DAYS']) if os.environ.get('SESSIONS_ARCHIVE_TTL_DAYS') else None
+    SESSIONS_ARCHIVE_DIRECTORY: Optional[str] = os.environ.get('SESSIONS_ARCHIVE_DIRECTORY')
+    # How often (in seconds) the worker applies the retention policy
+    SESSIONS_ARCHIVE_INTERVAL: float = float(os.environ.get('SESSIONS_ARCHIVE_INTERVAL') or '3600')
+
+    # Number of worker processes (`lde worker run --processes` overrides it). Resources are
+    # distributed among them by consistent hashing (see scheduling/sharding.py)
+    WORKER_PROCESSES: int = int(os.environ.get('WORKER_PROCESSES') or '1')
+
+    # A worker only manages the resources whose lease it holds in Redis, renewed every third of
+    # WORKER_LEASE_TTL seconds. If a worker (e.g., in another host) stops, other workers take its
+    # resources over once its leases expire. 0 disables the leases (a single worker per Redis).
+    WORKER_LEASE_TTL: float = float(os.environ.get('WORKER_LEASE_TTL') or '15')
+
+    # On SIGTERM, the worker stops taking reservations and waits up to WORKER_DRAIN_TIMEOUT seconds
+    # for the running sessions to reach a point where another worker can continue them
+    WORKER_DRAIN_TIMEOUT: float = float(os.environ.get('WORKER_DRAIN_TIMEOUT') or '30')
+
+    # Maximum concurrent operations of each worker process on Redis, MongoDB and the laboratories (in
+    # total and per laboratory host). Operations over the limit wait for their turn. 0 means no limit.
+    WORKER_MAX_REDIS_OPERATIONS: int = int(os.environ.get('WORKER_MAX_REDIS_OPERATIONS') or '50')
+    WORKER_MAX_MONGO_OPERATIONS: int = int(os.environ.get('WORKER_MAX_MONGO_OPERATIONS') or '20')
+    WORKER_MAX_HTTP_REQUESTS: int = int(os.environ.get('WORKER_MAX_HTTP_REQUESTS') or '100')
+    WORKER_MAX_REQUESTS_PER_HOST: int = int(os.environ.get('WORKER_MAX_REQUESTS_PER_HOST') or '10')
+
+    # If Redis is flushed (e.g., restarted), rebuild the reservations of the last hour from MongoDB
+    # and continue. If disabled (or without MongoDB), the worker stops instead.
+    REDIS_RECOVERY: bool = (os.environ.get('REDIS_RECOVERY') or 'true').lower() not in ('0', 'false', 'no')
+
+    # After PASSIVE_HEALTH_FAILURES consecutive failures starting or finishing sessions on a resource,
+    # no reservation is sent to it for PASSIVE_HEALTH_PROBATION seconds (doubled each time it fails
+    # again after the probation). 0 disables it.
+    PASSIVE_HEALTH_FAILURES: int = int(os.environ.get('PASSIVE_HEALTH_FAILURES') or '3')
+    PASSIVE_HEALTH_PROBATION: float = float(os.environ.get('PASSIVE_HEALTH_PROBATION') or '60')
+
+    # If a session cannot be started in a resource, the reservation is queued again (first) in the other
+    # resources of the reservation, up to START_FAILOVER_ATTEMPTS resources in total. 1 disables it.
+    START_FAILOVER_ATTEMPTS: int = int(os.environ.get('START_FAILOVER_ATTEMPTS') or '3')
+
+    # Status requests tell the clients how long to wait before polling again (retry_after), longer the
+    # further down the queue they are (up to STATUS_MAX_RETRY_AFTER seconds). When more than
+    # STATUS_TARGET_POLLERS requests are waiting for a change at the same time, all clients are asked
+    # to back off proportionally.
+    STATUS_MAX_RETRY_AFTER: int = int(os.environ.get('STATUS_MAX_RETRY_AFTER') or '30')
+    STATUS_TARGET_POLLERS: int = int(os.environ.get('STATUS_TARGET_POLLERS') or '200')
+
+    # New reservations are rate limited (token buckets refilled at this rate per minute, with bursts
+    # of up to the same number) per external system, per student and per laboratory; and rejected if
+    # the queues of all their resources have MAX_QUEUE_DEPTH reservations. Rejected reservations get a
+    # 429 response with Retry-After. 0 disables each limit.
+    RESERVATIONS_PER_MINUTE_PER_EXTERNAL_USER: float = float(os.environ.get('RESERVATIONS_PER_MINUTE_PER_EXTERNAL_USER') or '600')
+    RESERVATIONS_PER_MINUTE_PER_USER: float = float(os.environ.get('RESERVATIONS_PER_MINUTE_PER_USER') or '10')
+    RESERVATIONS_PER_MINUTE_PER_LABORATORY: float = float(os.environ.get('RESERVATIONS_PER_MINUTE_PER_LABORATORY') or '300')
+    MAX_QUEUE_DEPTH: int = int(os.environ.get('MAX_QUEUE_DEPTH') or '1000')
+
     # These two variables are set on the create_app depening on whether we have SQLALCHEMY_DATABASE_URI or MONGO_URI or not
     USING_MONGO = None
     USING_SQLALCHEMY = None
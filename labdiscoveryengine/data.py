@@ -1,5 +1,5 @@
 import abc
-from typing import Iterable, List, NamedTuple, Optional, Dict, Set, Union
+from typing import FrozenSet, Iterable, List, NamedTuple, Optional, Dict, Set, Tuple, Union
 
 from flask import current_app
 from werkzeug.security import check_password_hash
@@ -32,7 +32,7 @@ class ExternalUser(NamedTuple):
     name: str
     email: Optional[str]
     hashed_password: str
-    laboratories: Iterable[str]
+    laboratories: FrozenSet[str]
 
     def check_password_hash(self, password: str) -> bool:
         """
@@ -40,45 +40,104 @@ class ExternalUser(NamedTuple):
         """
         return check_password_hash(self.hashed_password, password)    
 
-class Healthcheck:
+class ConfigurationItem:
+    """
+    Immutable object defined in the configuration files (e.g., a healthcheck or a camera).
+    Attributes are declared in __slots__, in the same order as the arguments of __init__.
+    Two items are equal if they have the same type and attributes.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def _fields(cls):
+        fields = []
+        for klass in reversed(cls.__mro__):
+            fields.extend(klass.__dict__.get('__slots__', ()))
+        return fields
+
+    def _values(self):
+        return tuple(getattr(self, field) for field in self._fields())
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __eq__(self, other):
+        # Compared when the configuration is reloaded, to detect changed resources
+        return type(self) is type(other) and self._values() == other._values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self),) + self._values())
+
+    def __reduce__(self):
+        # __setattr__ is disabled, so rebuild it with the constructor (e.g., when unpickling)
+        return (type(self), self._values())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{field}={value!r}' for field, value in zip(self._fields(), self._values()))})"
+
+class Healthcheck(ConfigurationItem):
     __meta__ = abc.ABCMeta
+    __slots__ = ('identifier',)
 
     def __init__(self, identifier: str):
-        self.identifier: str = identifier
+        object.__setattr__(self, 'identifier', identifier)
 
 class HttpHealthcheck(Healthcheck):
     """
     A healthcheck is a HTTP call to the laboratory.
-    """
-    def __init__(self, identifier: str, url: str, timeout: float = 10):
-        self.identifier: str = identifier
-        self.url: str = url
-        self.timeout: float = timeout
+
+    The resource is healthy if the response has the expected_status and, if
+    provided, the body matches body_regex, the value in json_path (e.g.,
+    ``devices.0.status``) is json_value (or anything true if json_value is
+    None) and the response took less than max_latency seconds.
+    """
+    __slots__ = ('url', 'timeout', 'expected_status', 'body_regex', 'json_path', 'json_value', 'max_latency')
+
+    def __init__(self, identifier: str, url: str, timeout: float = 10, expected_status: int = 200,
+                 body_regex: Optional[str] = None, json_path: Optional[str] = None,
+                 json_value: Optional[Union[str, int, float, bool]] = None, max_latency: Optional[float] = None):
+        super().__init__(identifier)
+        object.__setattr__(self, 'url', url)
+        object.__setattr__(self, 'timeout', timeout)
+        object.__setattr__(self, 'expected_status', expected_status)
+        object.__setattr__(self, 'body_regex', body_regex)
+        object.__setattr__(self, 'json_path', json_path)
+        object.__setattr__(self, 'json_value', json_value)
+        object.__setattr__(self, 'max_latency', max_latency)
 
 class RobotcheckerHealthcheck(HttpHealthcheck):
     """
     A healthcheck that understands the robotchecker /status/<name>/ JSON shape.
     """
-    pass
+    __slots__ = ()
 
-class Camera:
+class Camera(ConfigurationItem):
     """
     A camera is a webcam that is connected to the laboratory.
 
     There can be an image camera and more options (timeout, etc.)
     """
     __meta__ = abc.ABCMeta
+    __slots__ = ('identifier',)
 
     def __init__(self, identifier: str):
-        self.identifier: str = identifier
+        object.__setattr__(self, 'identifier', identifier)
 
 class ImageCamera(Camera):
     """
     This represents a webcam that uses imgage refresh (e.g., jpg's)
     """
+    __slots__ = ('url',)
+
     def __init__(self, identifier: str, url: str):
-        self.identifier = identifier
-        self.url = url
+        super().__init__(identifier)
+        object.__setattr__(self, 'url', url)
 
 class Resource(NamedTuple):
     """
@@ -89,10 +148,10 @@ class Resource(NamedTuple):
     url: str
     login: str
     password: str
-    features: List[str]
+    features: FrozenSet[str]
 
-    cameras: List[Camera]
-    healthchecks: List[Healthcheck]
+    cameras: Tuple[Camera, ...]
+    healthchecks: Tuple[Healthcheck, ...]
 
     # Also acceptable: weblablib-v1.0
     api: str = "labdiscoverylib-v1.0"
@@ -108,9 +167,11 @@ class Laboratory(NamedTuple):
     display_name: str
     description: Optional[str]
     category: Optional[str]
-    keywords: List[str]
+    keywords: Tuple[str, ...]
     max_time: float
-    resources: Set[str]
+    resources: FrozenSet[str]
     image: str
-    features: Set[str]
+    features: FrozenSet[str]
     bypass_resource_health: bool = False
+    # Number of idle resources kept prepared for the next session (see ResourceWorker.prewarm)
+    prewarm: int = 0
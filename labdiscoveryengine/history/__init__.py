@@ -0,0 +1 @@
+# so find_packages() finds this package
@@ -0,0 +1,8 @@
+from labdiscoveryengine.exc import LabDiscoveryEngineError
+
+
+class HistoryError(LabDiscoveryEngineError):
+    pass
+
+class ExportFormatNotAvailableError(HistoryError):
+    pass
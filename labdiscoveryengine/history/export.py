@@ -0,0 +1,199 @@
+"""
+Streaming export of the session history (the sessions collection in MongoDB).
+
+Sessions are read with a server-side cursor, a projection and a bounded batch
+size, and they are written as they arrive, so exporting millions of sessions
+does not require keeping them in memory.
+"""
+import csv
+import io
+import datetime
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, TextIO
+
+from labdiscoveryengine.history.exc import ExportFormatNotAvailableError
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+class ExportFormats:
+    csv = 'csv'
+    parquet = 'parquet'
+
+    all_formats = [csv, parquet]
+
+# Fields exported (and the only ones requested to MongoDB)
+EXPORT_FIELDS: List[str] = [
+    'reservation_id', 'user', 'user_role', 'group', 'laboratory', 'assigned_resource', 'resources', 'features', 'priority',
+    'start_reservation', 'start', 'end_reservation', 'queue_duration', 'min_duration', 'max_duration',
+]
+
+_LIST_FIELDS = ('resources', 'features')
+_DATETIME_FIELDS = ('start_reservation', 'start', 'end_reservation')
+_FLOAT_FIELDS = ('queue_duration', 'min_duration', 'max_duration')
+
+def is_format_available(export_format: str) -> bool:
+    if export_format == ExportFormats.parquet:
+        return pyarrow is not None
+    return export_format in ExportFormats.all_formats
+
+def parse_export_date(value: Optional[str]) -> Optional[datetime.datetime]:
+    """
+    Parse dates such as 2024-03-01 or 2024-03-01T10:00:00 (UTC)
+    """
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value)
+
+def build_sessions_query(since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None,
+                         laboratories: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """
+    Build the MongoDB filter of the sessions to export. Dates refer to the moment
+    the reservation was requested (start_reservation).
+    """
+    query: Dict[str, Any] = {}
+
+    date_filter = {}
+    if since is not None:
+        date_filter['$gte'] = since
+    if until is not None:
+        date_filter['$lt'] = until
+    if date_filter:
+        query['start_reservation'] = date_filter
+
+    laboratories = list(laboratories or [])
+    if len(laboratories) == 1:
+        query['laboratory'] = laboratories[0]
+    elif laboratories:
+        query['laboratory'] = { '$in': laboratories }
+
+    return query
+
+def iter_sessions(collection, since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None,
+                  laboratories: Optional[Iterable[str]] = None, batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate over the sessions of a pymongo collection, fetching batch_size documents at a time.
+    """
+    projection = { field: 1 for field in EXPORT_FIELDS }
+    projection['_id'] = 0
+
+    cursor = collection.find(build_sessions_query(since, until, laboratories), projection=projection, batch_size=batch_size)
+    cursor = cursor.sort('start_reservation', 1)
+    try:
+        for session in cursor:
+            yield session
+    finally:
+        cursor.close()
+
+def _csv_value(field: str, value: Any) -> Any:
+    if value is None:
+        return ''
+    if field in _LIST_FIELDS:
+        return ';'.join(str(item) for item in value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+def iter_csv_chunks(sessions: Iterable[Dict[str, Any]], rows_per_chunk: int = 500) -> Iterator[str]:
+    """
+    Generate the CSV (header included) in chunks of rows_per_chunk rows. Useful for
+    streaming HTTP responses.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+
+    rows = 0
+    for session in sessions:
+        writer.writerow([ _csv_value(field, session.get(field)) for field in EXPORT_FIELDS ])
+        rows += 1
+        if rows % rows_per_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def write_csv(sessions: Iterable[Dict[str, Any]], fileobj: TextIO) -> int:
+    """
+    Write the sessions in CSV format. Returns the number of exported sessions.
+    """
+    counter = _Counter(sessions)
+    for chunk in iter_csv_chunks(counter):
+        fileobj.write(chunk)
+    return counter.count
+
+def _parquet_schema():
+    fields = []
+    for field in EXPORT_FIELDS:
+        if field in _LIST_FIELDS:
+            field_type = pyarrow.list_(pyarrow.string())
+        elif field in _DATETIME_FIELDS:
+            field_type = pyarrow.timestamp('ms', tz='UTC')
+        elif field in _FLOAT_FIELDS:
+            field_type = pyarrow.float64()
+        elif field == 'priority':
+            field_type = pyarrow.int64()
+        else:
+            field_type = pyarrow.string()
+        fields.append(pyarrow.field(field, field_type))
+    return pyarrow.schema(fields)
+
+def _parquet_value(field: str, value: Any) -> Any:
+    if value is None:
+        return None
+    if field in _DATETIME_FIELDS and isinstance(value, datetime.datetime) and value.tzinfo is None:
+        # pymongo returns naive UTC datetimes
+        return value.replace(tzinfo=datetime.timezone.utc)
+    if field in _LIST_FIELDS:
+        return [ str(item) for item in value ]
+    if field in _FLOAT_FIELDS:
+        return float(value)
+    if field == 'priority':
+        return int(value)
+    if field not in _DATETIME_FIELDS:
+        return str(value)
+    return value
+
+def write_parquet(sessions: Iterable[Dict[str, Any]], fileobj: BinaryIO, rows_per_group: int = 10000) -> int:
+    """
+    Write the sessions in Parquet format, one row group every rows_per_group sessions.
+    Returns the number of exported sessions. It requires pyarrow.
+    """
+    if pyarrow is None:
+        raise ExportFormatNotAvailableError("Exporting to Parquet requires pyarrow (pip install pyarrow)")
+
+    schema = _parquet_schema()
+    total = 0
+    columns: Dict[str, list] = { field: [] for field in EXPORT_FIELDS }
+
+    with pyarrow.parquet.ParquetWriter(fileobj, schema) as writer:
+        for session in sessions:
+            for field in EXPORT_FIELDS:
+                columns[field].append(_parquet_value(field, session.get(field)))
+            total += 1
+
+            if total % rows_per_group == 0:
+                writer.write_table(pyarrow.table(columns, schema=schema))
+                columns = { field: [] for field in EXPORT_FIELDS }
+
+        if columns[EXPORT_FIELDS[0]]:
+            writer.write_table(pyarrow.table(columns, schema=schema))
+
+    return total
+
+class _Counter:
+    """
+    Count the elements of an iterable while it is consumed
+    """
+    def __init__(self, iterable: Iterable):
+        self.iterable = iterable
+        self.count = 0
+
+    def __iter__(self):
+        for element in self.iterable:
+            self.count += 1
+            yield element
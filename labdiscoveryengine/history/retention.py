@@ -0,0 +1,197 @@
+"""
+Retention policy of the session history.
+
+Sessions older than SESSIONS_RETENTION_DAYS are moved out of the sessions
+collection, so its indexes (and therefore insert latency) stay bounded. Usage
+rollups (see rollups.py) are not affected, so the Administration Panel keeps
+its statistics.
+
+Archived sessions go either to the sessions_archive collection (one compressed
+BSON document per session, with a TTL index on archived_at) or to gzipped JSON
+lines files in the deployment directory (one file per month).
+"""
+import os
+import gzip
+import zlib
+import datetime
+from typing import Any, Dict, List, Optional
+
+import bson
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+class ArchiveModes:
+    collection = 'collection'
+    files = 'files'
+
+    all_modes = [collection, files]
+
+# MongoDB error code for duplicate keys
+_DUPLICATE_KEY_ERROR = 11000
+
+def get_retention_cutoff(retention_days: float, now: Optional[datetime.datetime] = None) -> datetime.datetime:
+    """
+    Sessions requested before the returned moment (naive UTC, as pymongo stores it) must be archived
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return now - datetime.timedelta(days=retention_days)
+
+def encode_archived_session(session: Dict[str, Any], archived_at: datetime.datetime) -> Dict[str, Any]:
+    """
+    Build the document stored in sessions_archive: only a few fields are kept
+    uncompressed, to be able to look sessions up.
+    """
+    return {
+        '_id': session['_id'],
+        'reservation_id': session.get('reservation_id'),
+        'laboratory': session.get('laboratory'),
+        'start_reservation': session.get('start_reservation'),
+        'archived_at': archived_at,
+        'payload': bson.Binary(zlib.compress(bson.encode(session))),
+    }
+
+def decode_archived_session(document: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return the original session of a sessions_archive document
+    """
+    return bson.decode(zlib.decompress(document['payload']))
+
+def ensure_archive_indexes(archive_collection, ttl_days: Optional[float]):
+    """
+    Create the indexes of the archive collection. If ttl_days is provided,
+    archived sessions are removed by MongoDB ttl_days after being archived.
+    """
+    archive_collection.create_index('reservation_id')
+    archive_collection.create_index('start_reservation')
+
+    existing_index = archive_collection.index_information().get('archived_at_1')
+    if ttl_days is None:
+        if existing_index is not None and 'expireAfterSeconds' in existing_index:
+            archive_collection.drop_index('archived_at_1')
+        archive_collection.create_index('archived_at')
+        return
+
+    expire_after_seconds = int(ttl_days * 24 * 3600)
+    if existing_index is not None and existing_index.get('expireAfterSeconds') != expire_after_seconds:
+        if 'expireAfterSeconds' in existing_index:
+            # The TTL changed in the configuration: update it without rebuilding the index
+            archive_collection.database.command('collMod', archive_collection.name,
+                                                index={'keyPattern': {'archived_at': 1}, 'expireAfterSeconds': expire_after_seconds})
+            return
+        archive_collection.drop_index('archived_at_1')
+
+    archive_collection.create_index('archived_at', expireAfterSeconds=expire_after_seconds)
+
+def _archive_to_collection(sessions: List[Dict[str, Any]], archive_collection, archived_at: datetime.datetime):
+    documents = [ encode_archived_session(session, archived_at) for session in sessions ]
+    try:
+        archive_collection.insert_many(documents, ordered=False)
+    except BulkWriteError as err:
+        # If a previous run was interrupted after inserting but before deleting,
+        # some sessions might already be in the archive. That's fine.
+        other_errors = [ error for error in err.details.get('writeErrors', []) if error.get('code') != _DUPLICATE_KEY_ERROR ]
+        if other_errors:
+            raise
+
+def _archive_to_files(sessions: List[Dict[str, Any]], directory: str):
+    sessions_per_file: Dict[str, List[Dict[str, Any]]] = {}
+    for session in sessions:
+        start_reservation = session.get('start_reservation') or datetime.datetime.utcnow()
+        filename = os.path.join(directory, f"sessions-{start_reservation:%Y-%m}.jsonl.gz")
+        sessions_per_file.setdefault(filename, []).append(session)
+
+    os.makedirs(directory, exist_ok=True)
+    for filename, file_sessions in sessions_per_file.items():
+        # Appending to a gzip file creates a new gzip member, which is still a valid gzip file
+        with gzip.open(filename, 'at', encoding='utf8') as archive_file:
+            for session in file_sessions:
+                archive_file.write(json_util.dumps(session) + '\n')
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+
+def archive_sessions(sessions_collection, cutoff: datetime.datetime, mode: str,
+                     archive_collection = None, directory: Optional[str] = None,
+                     batch_size: int = 1000, max_batches: Optional[int] = None) -> int:
+    """
+    Move the sessions requested before cutoff from sessions_collection to the archive,
+    batch_size sessions at a time. Sessions are only deleted once they have been
+    archived, so an interrupted run can be safely repeated (in files mode, the last
+    batch might then appear twice in the files). Returns the number of archived sessions.
+    """
+    if mode not in ArchiveModes.all_modes:
+        raise ValueError(f"Invalid archive mode: {mode}. Use one of {ArchiveModes.all_modes}")
+    if mode == ArchiveModes.collection and archive_collection is None:
+        raise ValueError("archive_collection is required to archive in a collection")
+    if mode == ArchiveModes.files and directory is None:
+        raise ValueError("directory is required to archive in files")
+
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        sessions = list(sessions_collection.find({'start_reservation': {'$lt': cutoff}})
+                                           .sort('start_reservation', 1)
+                                           .limit(batch_size))
+        if not sessions:
+            break
+
+        if mode == ArchiveModes.collection:
+            _archive_to_collection(sessions, archive_collection, datetime.datetime.utcnow())
+        else:
+            _archive_to_files(sessions, directory)
+
+        sessions_collection.delete_many({'_id': {'$in': [ session['_id'] for session in sessions ]}})
+
+        total += len(sessions)
+        batches += 1
+        if len(sessions) < batch_size:
+            break
+
+    return total
+
+def prune_archive_files(directory: str, ttl_days: float, now: Optional[float] = None) -> List[str]:
+    """
+    Delete the archive files not modified in the last ttl_days (the files
+    equivalent of the TTL index). Returns the deleted files.
+    """
+    if not os.path.isdir(directory):
+        return []
+
+    if now is None:
+        now = datetime.datetime.now().timestamp()
+
+    deleted = []
+    for filename in sorted(os.listdir(directory)):
+        if not (filename.startswith('sessions-') and filename.endswith('.jsonl.gz')):
+            continue
+        path = os.path.join(directory, filename)
+        if now - os.path.getmtime(path) > ttl_days * 24 * 3600:
+            os.remove(path)
+            deleted.append(path)
+    return deleted
+
+def apply_retention_policy(config: Dict[str, Any], db, max_batches: Optional[int] = None) -> int:
+    """
+    Apply the retention policy configured in the Flask config (SESSIONS_RETENTION_DAYS,
+    SESSIONS_ARCHIVE_MODE, SESSIONS_ARCHIVE_TTL_DAYS and SESSIONS_ARCHIVE_DIRECTORY)
+    on a pymongo database. Returns the number of archived sessions.
+    """
+    retention_days = config.get('SESSIONS_RETENTION_DAYS')
+    if retention_days is None:
+        return 0
+
+    mode = config.get('SESSIONS_ARCHIVE_MODE') or ArchiveModes.collection
+    ttl_days = config.get('SESSIONS_ARCHIVE_TTL_DAYS')
+    directory = get_archive_directory(config)
+    cutoff = get_retention_cutoff(retention_days)
+
+    if mode == ArchiveModes.collection:
+        return archive_sessions(db.sessions, cutoff, mode, archive_collection=db.sessions_archive, max_batches=max_batches)
+
+    archived = archive_sessions(db.sessions, cutoff, mode, directory=directory, max_batches=max_batches)
+    if ttl_days is not None:
+        prune_archive_files(directory, ttl_days)
+    return archived
+
+def get_archive_directory(config: Dict[str, Any]) -> str:
+    return config.get('SESSIONS_ARCHIVE_DIRECTORY') or os.path.join(config.get('LABDISCOVERYENGINE_DIRECTORY') or '.', 'archive')
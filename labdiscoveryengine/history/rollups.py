@@ -0,0 +1,150 @@
+"""
+Pre-aggregated usage rollups of the sessions collection.
+
+The worker updates a single document per laboratory, resource and hour whenever
+a session finishes. The administration panel reads those documents instead of
+scanning the whole sessions history, so its cost depends on the time window
+shown and not on how many sessions were ever stored.
+
+Rollups are stored in the session_rollups collection.
+"""
+import math
+import bisect
+import datetime
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# Upper bounds (in seconds) of the histogram buckets used to estimate percentiles.
+# Anything above the last bound goes to an overflow bucket.
+DURATION_BUCKETS: List[float] = [
+    1, 2, 5, 10, 15, 30, 45, 60, 90, 120, 180, 240, 300, 450, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200,
+]
+
+class UsageSummary(NamedTuple):
+    """
+    Usage of a resource of a laboratory during a period of time
+    """
+    laboratory: str
+    resource: Optional[str]
+    sessions: int
+    average_queue_duration: Optional[float]
+    queue_duration_p50: Optional[float]
+    queue_duration_p95: Optional[float]
+    average_session_duration: Optional[float]
+    session_duration_p50: Optional[float]
+    session_duration_p95: Optional[float]
+
+    @staticmethod
+    def format_percentile(value: Optional[float]) -> str:
+        """
+        Percentiles are upper bounds of buckets (math.inf for the overflow bucket)
+        """
+        if value is None:
+            return ''
+        if math.isinf(value):
+            return f'> {DURATION_BUCKETS[-1]} s'
+        return f'\u2264 {value} s'
+
+def duration_bucket(seconds: float) -> str:
+    """
+    Return the histogram bucket of a duration. MongoDB does not accept dots in field
+    names, so buckets are identified by their index.
+    """
+    return str(bisect.bisect_left(DURATION_BUCKETS, seconds))
+
+def rollup_hour(moment: datetime.datetime) -> datetime.datetime:
+    """
+    Return the beginning of the hour of moment (in naive UTC, as pymongo returns it)
+    """
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+def build_rollup_update(laboratory: str, resource: str, finished_at: datetime.datetime,
+                        queue_duration: Optional[float], session_duration: Optional[float]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Return the (filter, update) pair that adds a finished session to its hourly rollup
+    document. It is meant to be used with update_one(..., upsert=True).
+    """
+    increments: Dict[str, Any] = {
+        'count': 1,
+    }
+
+    if queue_duration is not None:
+        increments['queue_count'] = 1
+        increments['total_queue_duration'] = queue_duration
+        increments[f'queue_histogram.{duration_bucket(queue_duration)}'] = 1
+
+    if session_duration is not None:
+        increments['session_count'] = 1
+        increments['total_session_duration'] = session_duration
+        increments[f'session_histogram.{duration_bucket(session_duration)}'] = 1
+
+    rollup_filter = {
+        'laboratory': laboratory,
+        'resource': resource,
+        'hour': rollup_hour(finished_at),
+    }
+    return rollup_filter, { '$inc': increments }
+
+def histogram_percentile(histogram: Dict[str, int], fraction: float) -> Optional[float]:
+    """
+    Estimate a percentile (e.g., fraction=0.95) from a bucket histogram. The upper
+    bound of the bucket is returned, so the estimation is pessimistic. If it falls in
+    the overflow bucket (above the last bound), there is no upper bound: math.inf.
+    """
+    total = sum(histogram.values())
+    if not total:
+        return None
+
+    target = fraction * total
+    accumulated = 0
+    for bucket in sorted(histogram, key=int):
+        accumulated += histogram[bucket]
+        if accumulated >= target:
+            index = int(bucket)
+            if index >= len(DURATION_BUCKETS):
+                return math.inf
+            return DURATION_BUCKETS[index]
+
+    return math.inf
+
+def _merge_histogram(target: Dict[str, int], source: Optional[Dict[str, int]]):
+    for bucket, value in (source or {}).items():
+        target[bucket] = target.get(bucket, 0) + value
+
+def summarize_rollups(documents: Iterable[Dict[str, Any]], by_resource: bool = True) -> List[UsageSummary]:
+    """
+    Merge hourly rollup documents into a summary per laboratory (and resource, if
+    by_resource is True).
+    """
+    aggregated: Dict[Tuple[str, Optional[str]], Dict[str, Any]] = {}
+    for document in documents:
+        key = (document['laboratory'], document.get('resource') if by_resource else None)
+        current = aggregated.setdefault(key, {
+            'count': 0,
+            'queue_count': 0,
+            'total_queue_duration': 0.0,
+            'queue_histogram': {},
+            'session_count': 0,
+            'total_session_duration': 0.0,
+            'session_histogram': {},
+        })
+        for field in ('count', 'queue_count', 'total_queue_duration', 'session_count', 'total_session_duration'):
+            current[field] += document.get(field) or 0
+        _merge_histogram(current['queue_histogram'], document.get('queue_histogram'))
+        _merge_histogram(current['session_histogram'], document.get('session_histogram'))
+
+    summaries = []
+    for (laboratory, resource), current in sorted(aggregated.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+        summaries.append(UsageSummary(
+            laboratory=laboratory,
+            resource=resource,
+            sessions=current['count'],
+            average_queue_duration=current['total_queue_duration'] / current['queue_count'] if current['queue_count'] else None,
+            queue_duration_p50=histogram_percentile(current['queue_histogram'], 0.5),
+            queue_duration_p95=histogram_percentile(current['queue_histogram'], 0.95),
+            average_session_duration=current['total_session_duration'] / current['session_count'] if current['session_count'] else None,
+            session_duration_p50=histogram_percentile(current['session_histogram'], 0.5),
+            session_duration_p95=histogram_percentile(current['session_histogram'], 0.95),
+        ))
+    return summaries
@@ -0,0 +1,36 @@
+-------------------------------------
+-- Acquire or renew the leases of
+-- several resources
+--
+-- A lease is taken if nobody holds it
+-- (or it expired) and renewed if the
+-- owner already holds it. Leases held
+-- by other owners are not touched.
+--
+-- Parameters:
+--
+-- * owner: str (identifier of the worker)
+-- * ttl: int (milliseconds)
+-- * resource1, resource2...: str
+--
+-- return: one element per resource,
+-- 1 if the owner holds the lease, 0 if not
+-------------------------------------
+
+local owner = ARGV[1]
+local ttl = tonumber(ARGV[2])
+
+local results = {}
+
+for i = 3, #ARGV do
+    local lease_key = "lde:resources:" .. ARGV[i] .. ":lease"
+    local current_owner = redis.call("get", lease_key)
+    if current_owner == false or current_owner == owner then
+        redis.call("set", lease_key, owner, "PX", ttl)
+        results[#results + 1] = 1
+    else
+        results[#results + 1] = 0
+    end
+end
+
+return results
@@ -0,0 +1,95 @@
+-------------------------------------
+-- Decide whether a new reservation is
+-- admitted (before storing it)
+--
+-- 1. Load shedding: if the queues of
+--    all the resources of the reservation
+--    already have max_queue_depth
+--    reservations, it is rejected.
+--
+-- 2. Rate limiting: each bucket (e.g.,
+--    the external user, the student, the
+--    laboratory) is a token bucket that
+--    refills rate tokens per minute, up to
+--    capacity. A reservation takes one
+--    token of each bucket, and only if
+--    all of them have one.
+--
+-- Parameters:
+--
+-- * now: float (seconds)
+-- * max_queue_depth: int (0 to disable it)
+-- * number of resources: int
+-- * resources: List[str]
+-- * buckets (onwards, 4 parameters each):
+--   scope: str, identifier: str,
+--   rate: float (per minute), capacity: int
+--
+-- Returns admitted (1 or 0), the reason
+-- (queue-full or the scope of the bucket)
+-- and the milliseconds until a token is
+-- available (0 if not applicable)
+-------------------------------------
+
+local now = tonumber(ARGV[1])
+local max_queue_depth = tonumber(ARGV[2])
+local resources_length = tonumber(ARGV[3])
+
+local stats_key = "lde:admission:stats"
+
+-------------------------------------
+-- Load shedding
+-------------------------------------
+if max_queue_depth > 0 and resources_length > 0 then
+    local min_depth = nil
+    for i = 4, 3 + resources_length do
+        local queue_base_key = "lde:resources:" .. ARGV[i] .. ":queues:"
+        local depth = 0
+        for _, priority in ipairs(redis.call("zrange", queue_base_key .. "priorities", 0, -1)) do
+            depth = depth + redis.call("llen", queue_base_key .. priority)
+        end
+        if min_depth == nil or depth < min_depth then
+            min_depth = depth
+        end
+    end
+
+    if min_depth >= max_queue_depth then
+        redis.call("hincrby", stats_key, "shed", 1)
+        return { 0, "queue-full", 0 }
+    end
+end
+
+-------------------------------------
+-- Rate limiting
+-------------------------------------
+local buckets = {}
+for i = 4 + resources_length, #ARGV, 4 do
+    local bucket = {
+        scope = ARGV[i],
+        key = "lde:admission:buckets:" .. ARGV[i] .. ":" .. ARGV[i + 1],
+        rate = tonumber(ARGV[i + 2]) / 60,
+        capacity = tonumber(ARGV[i + 3]),
+    }
+
+    local state = redis.call("hmget", bucket.key, "tokens", "updated")
+    local tokens = tonumber(state[1]) or bucket.capacity
+    local updated = tonumber(state[2]) or now
+    bucket.tokens = math.min(bucket.capacity, tokens + math.max(0, now - updated) * bucket.rate)
+
+    if bucket.tokens < 1 then
+        redis.call("hincrby", stats_key, "rejected:" .. bucket.scope, 1)
+        local retry_after = math.ceil((1 - bucket.tokens) / bucket.rate * 1000)
+        return { 0, bucket.scope, retry_after }
+    end
+
+    table.insert(buckets, bucket)
+end
+
+for _, bucket in ipairs(buckets) do
+    redis.call("hset", bucket.key, "tokens", tostring(bucket.tokens - 1), "updated", tostring(now))
+    -- Once full again, the bucket is the same as no bucket
+    redis.call("expire", bucket.key, math.ceil(bucket.capacity / bucket.rate) + 1)
+end
+
+redis.call("hincrby", stats_key, "admitted", 1)
+return { 1, false, 0 }
@@ -4,7 +4,13 @@
 -- arguments: reservation_id
 --
 -- return:
--- status, external_session_id, position, url
+-- status, external_session_id, position, url, message, estimated_wait
+--
+-- estimated_wait (seconds, only if queued) assumes that
+-- the resources of the reservation serve the queue at
+-- the average session duration of the laboratory (or
+-- max_time of the reservation, if there are no sessions
+-- yet): (position + 1) * duration / resources
 --
 ------------------------------------------
 
@@ -14,6 +20,7 @@ local external_session_id = nil
 local position = nil
 local url = nil
 local message = nil
+local estimated_wait = nil
 
 local reservation_key = "lde:reservations:" .. reservation_id
 
@@ -54,6 +61,22 @@ if status == "pending" or status == "queued" then
     if min_position then
         position = min_position
         status = "queued"
+
+        local laboratory = redis.call("hget", reservation_key, "laboratory")
+        local duration = nil
+        if laboratory then
+            duration = tonumber(redis.call("hget", "lde:laboratories:" .. laboratory .. ":stats", "mean_duration"))
+        end
+        if duration == nil then
+            local metadata = redis.call("hget", reservation_key, "metadata")
+            if metadata then
+                duration = tonumber(cjson.decode(metadata)["max_time"])
+            end
+        end
+        if duration ~= nil and #resources > 0 then
+            -- Lua numbers are converted to integers by Redis: round it
+            estimated_wait = math.floor((position + 1) * duration / #resources + 0.5)
+        end
     else
         -- A worker may have dequeued the reservation just before this status
         -- lookup runs, while the reservation hash still says pending/queued.
@@ -70,4 +93,4 @@ elseif status == "ready" or status == "cancelling" or status == "finishing" then
 end
 
 
-return { status or false, external_session_id or false, position or false, url or false, message or false }
+return { status or false, external_session_id or false, position or false, url or false, message or false, estimated_wait or false }
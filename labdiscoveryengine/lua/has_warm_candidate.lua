@@ -0,0 +1,74 @@
+-------------------------------------
+-- Check if the next reservation in
+-- the queues of a resource can be
+-- taken by another resource that is
+-- prepared (pre-warm mode), so this
+-- resource lets it take it first
+--
+-- The other resource must be in the
+-- warm pool of the laboratory of the
+-- reservation, among the resources
+-- of the reservation, not broken and
+-- not on probation.
+--
+-- Parameters:
+--
+-- * resource: str
+-- * now: float (seconds)
+--
+-- Returns the prepared resource (or
+-- false if there is none)
+-------------------------------------
+
+local resource = ARGV[1]
+local now = tonumber(ARGV[2])
+
+-- Only the first reservations still not assigned are checked
+local MAX_CHECKED = 10
+
+local function next_reservation()
+    local queue_base_key = "lde:resources:" .. resource .. ":queues:"
+    local checked = 0
+    for _, priority in ipairs(redis.call("zrange", queue_base_key .. "priorities", 0, -1)) do
+        for _, reservation_id in ipairs(redis.call("lrange", queue_base_key .. priority, 0, MAX_CHECKED - checked - 1)) do
+            if redis.call("hexists", "lde:reservations:" .. reservation_id, ":assigned") == 0 then
+                return reservation_id
+            end
+            checked = checked + 1
+        end
+        if checked >= MAX_CHECKED then
+            return false
+        end
+    end
+    return false
+end
+
+local reservation_id = next_reservation()
+if reservation_id == false then
+    return false
+end
+
+local reservation_key = "lde:reservations:" .. reservation_id
+local laboratory = redis.call("hget", reservation_key, "laboratory")
+if laboratory == false then
+    return false
+end
+
+for _, candidate in ipairs(redis.call("zrangebyscore", "lde:laboratories:" .. laboratory .. ":warm", now, "+inf")) do
+    if candidate ~= resource and redis.call("sismember", reservation_key .. ":resources", candidate) == 1 then
+        local candidate_base = "lde:resources:" .. candidate
+        local healthy = redis.call("hget", candidate_base .. ":health", "status") ~= "broken"
+
+        local passive_health = redis.call("get", candidate_base .. ":health:passive")
+        if healthy and passive_health then
+            local probation_until = tonumber(cjson.decode(passive_health)["probation_until"]) or 0
+            healthy = probation_until <= now
+        end
+
+        if healthy then
+            return candidate
+        end
+    end
+end
+
+return false
@@ -0,0 +1,35 @@
+-------------------------------------
+-- Record the duration of a finished
+-- session in the statistics of its
+-- laboratory (used to estimate the
+-- waiting time in the queues, see
+-- get_reservation_status.lua)
+--
+-- The mean is a moving average: the
+-- first sessions weight the same, then
+-- each new session weights alpha.
+--
+-- Parameters:
+--
+-- * laboratory: str
+-- * duration: float (seconds)
+-- * alpha: float
+--
+-- Returns the new mean (as a string)
+-------------------------------------
+
+local laboratory = ARGV[1]
+local duration = tonumber(ARGV[2])
+local alpha = tonumber(ARGV[3])
+
+local stats_key = "lde:laboratories:" .. laboratory .. ":stats"
+
+local sessions = redis.call("hincrby", stats_key, "sessions", 1)
+local mean = tonumber(redis.call("hget", stats_key, "mean_duration") or duration)
+
+local weight = math.max(alpha, 1 / sessions)
+mean = mean + weight * (duration - mean)
+
+redis.call("hset", stats_key, "mean_duration", tostring(mean))
+
+return tostring(mean)
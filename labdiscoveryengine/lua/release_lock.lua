@@ -0,0 +1,22 @@
+-------------------------------------
+-- Release a lock (taken with SET NX PX)
+-- only if it is still held by the
+-- owner: if it expired, another worker
+-- might hold it now
+--
+-- Keys:
+--
+-- * lock: str
+--
+-- Parameters:
+--
+-- * owner: str (identifier of the worker)
+--
+-- return: 1 if it was released, 0 if not
+-------------------------------------
+
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+
+return 0
@@ -0,0 +1,26 @@
+-------------------------------------
+-- Release the leases of several
+-- resources (only those still held
+-- by the owner)
+--
+-- Parameters:
+--
+-- * owner: str (identifier of the worker)
+-- * resource1, resource2...: str
+--
+-- return: number of released leases
+-------------------------------------
+
+local owner = ARGV[1]
+
+local released = 0
+
+for i = 2, #ARGV do
+    local lease_key = "lde:resources:" .. ARGV[i] .. ":lease"
+    if redis.call("get", lease_key) == owner then
+        redis.call("del", lease_key)
+        released = released + 1
+    end
+end
+
+return released
@@ -0,0 +1,72 @@
+-------------------------------------
+-- Requeue a reservation that could not
+-- be started in a resource
+--
+-- The reservation is put at the head of
+-- the queues of the resources of the
+-- reservation not tried yet, so the first
+-- one available takes it.
+--
+-- Parameters:
+--
+-- * reservation_id: str
+-- * failed_resource: str
+-- * priority: int
+-- * max_attempts: int (resources tried)
+--
+-- Returns the number of resources where
+-- it was queued (0 if it was not)
+-------------------------------------
+
+local reservation_id = ARGV[1]
+local failed_resource = ARGV[2]
+local priority = tonumber(ARGV[3])
+local max_attempts = tonumber(ARGV[4])
+
+local reservation_key = "lde:reservations:" .. reservation_id
+local tried_key = reservation_key .. ":tried"
+
+-- e.g., the user cancelled it meanwhile
+local status = redis.call("hget", reservation_key, "status")
+if status ~= "initializing" and status ~= "pending" and status ~= "queued" then
+    return 0
+end
+
+redis.call("sadd", tried_key, failed_resource)
+redis.call("expire", tried_key, 3600)
+
+if redis.call("scard", tried_key) >= max_attempts then
+    return 0
+end
+
+local candidates = {}
+for _, resource in ipairs(redis.call("smembers", reservation_key .. ":resources")) do
+    if redis.call("sismember", tried_key, resource) == 0 then
+        table.insert(candidates, resource)
+    end
+end
+
+if #candidates == 0 then
+    return 0
+end
+
+-- So the next resource that finds it can take it (see assign_reservation_to_resource.lua)
+redis.call("hdel", reservation_key, ":assigned")
+redis.call("hset", reservation_key, "status", "queued")
+
+for _, resource in ipairs(candidates) do
+    local resource_base = "lde:resources:" .. resource
+    local queue_base_key = resource_base .. ":queues:"
+
+    -- It might still be in the queue (not popped yet by that resource): move it to the head
+    redis.call("lrem", queue_base_key .. priority, 0, reservation_id)
+    redis.call("lpush", queue_base_key .. priority, reservation_id)
+    redis.call("zadd", queue_base_key .. "priorities", priority, priority)
+    redis.call("expire", queue_base_key .. priority, 3600)
+    redis.call("expire", queue_base_key .. "priorities", 3600)
+    redis.call("publish", resource_base .. ":channel", reservation_id)
+end
+
+redis.call("publish", reservation_key .. ":channel", "queued")
+
+return #candidates
@@ -0,0 +1,124 @@
+"""
+Redis channels of the worker.
+
+Every ResourceWorker waits for the messages of the channel of its resource, and every
+ResourceReservationProcessor for the ones of its reservation while the session runs.
+With a PubSub each, a worker process with hundreds of resources holds hundreds of Redis
+connections (plus one per running session), outside of any limit.
+
+Instead, a single connection per process subscribes to the channels of all the resources
+and reservations (with patterns), and the ChannelListener forwards each message to the
+subscriptions of that process. Subscribing and unsubscribing is local: no Redis command.
+"""
+import asyncio
+import logging
+
+from typing import Any, Dict, Optional, Set
+
+from redis.asyncio.client import Redis
+
+from labdiscoveryengine.scheduling.keys import ReservationKeys, ResourceKeys
+
+logger = logging.getLogger(__name__)
+
+RESOURCE_CHANNELS = ResourceKeys('*').channel()
+RESERVATION_CHANNELS = ReservationKeys('*').channel()
+
+class Subscription:
+    """
+    Messages of a channel, with the same get_message as PubSub. Messages are coalesced:
+    subscribers only need to know that something changed since they last checked.
+    """
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.event = asyncio.Event()
+        self.last_message: Optional[Dict[str, Any]] = None
+
+    def deliver(self, message: Optional[Dict[str, Any]]):
+        self.last_message = message
+        self.event.set()
+
+    async def get_message(self, timeout: float) -> Optional[Dict[str, Any]]:
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout=max(0, timeout))
+        except asyncio.TimeoutError:
+            return None
+        self.event.clear()
+        return self.last_message
+
+class ChannelListener:
+    # Seconds between checks of the connection (and before listening again after an error)
+    listen_timeout = 1
+
+    def __init__(self):
+        self.redis_obj: Optional[Redis] = None
+        self.pubsub = None
+        self.task: Optional[asyncio.Task] = None
+        self.subscriptions: Dict[str, Set[Subscription]] = {
+            # channel: subscriptions
+        }
+
+    async def start(self, redis_obj: Redis):
+        """
+        Listen with redis_obj (which should not be the bounded client of aioredis_store:
+        this connection is held while the worker runs)
+        """
+        await self.close()
+        self.redis_obj = redis_obj
+        self.pubsub = redis_obj.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.psubscribe(RESOURCE_CHANNELS, RESERVATION_CHANNELS)
+        self.task = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+            self.pubsub = None
+
+        if self.redis_obj is not None:
+            await self.redis_obj.aclose()
+            self.redis_obj = None
+
+    def subscribe(self, channel: str) -> Subscription:
+        subscription = Subscription(channel)
+        self.subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self.subscriptions.get(subscription.channel)
+        if subscriptions is None:
+            return
+
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            self.subscriptions.pop(subscription.channel)
+
+    def deliver(self, channel: str, message: Optional[Dict[str, Any]]):
+        for subscription in list(self.subscriptions.get(channel, ())):
+            subscription.deliver(message)
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=self.listen_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.warning(f"Error listening to the Redis channels: {err}")
+                # Messages might have been lost: every subscriber checks again
+                for channel in list(self.subscriptions):
+                    self.deliver(channel, None)
+                await asyncio.sleep(self.listen_timeout)
+                continue
+
+            if message is not None and message['type'] == 'pmessage':
+                self.deliver(message['channel'], message)
+
+channel_listener = ChannelListener()
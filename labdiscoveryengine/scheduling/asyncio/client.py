@@ -7,7 +7,8 @@ from labdiscoveryengine.data import Resource
 from labdiscoveryengine.scheduling.data import ReservationRequest
 from labdiscoveryengine.scheduling.keys import ResourceKeys
 
-from labdiscoveryengine.utils import lde_config
+from labdiscoveryengine.scheduling.asyncio.config import worker_config
+from labdiscoveryengine.scheduling.asyncio.governor import governor
 
 class AbstractResourceClient:
     """
@@ -58,8 +59,9 @@ class AbstractResourceClient:
 
         body = self._get_start_body(reservation_request)
 
-        async with self.client_session.post(url, json=body) as response:
-            result: dict = await response.json()
+        async with governor.http_request(url):
+            async with self.client_session.post(url, json=body) as response:
+                result: dict = await response.json()
         
         if result.get('error') or result.get('success', True) == False:
             raise Exception(f"Error starting reservation {reservation_request.identifier}: {result}")
@@ -68,14 +70,31 @@ class AbstractResourceClient:
         ldl_session_id = result.get('session_id')
         return url, ldl_session_id
     
+    async def prepare(self) -> bool:
+        """
+        Ask the laboratory to get ready for the next session (e.g., power on and initialize
+        the device), so starting it takes less time. Returns False if the laboratory does
+        not support it.
+        """
+        url = self._get_url("/sessions/prepare")
+
+        async with governor.http_request(url):
+            async with self.client_session.post(url, json={}) as response:
+                if response.status in (404, 405):
+                    return False
+                response.raise_for_status()
+
+        return True
+
     async def get_should_finish(self, session_id: str) -> int:
         """
         Return the time left in the lab
         """
         url = self._get_url(f"/sessions/{session_id}/status")
 
-        async with self.client_session.get(url) as response:
-            result: dict = await response.json()
+        async with governor.http_request(url):
+            async with self.client_session.get(url) as response:
+                result: dict = await response.json()
 
         return result.get('should_finish') or 0
     
@@ -90,15 +109,16 @@ class AbstractResourceClient:
         """
         url = self._get_url(f"/sessions/{session_id}")
 
-        if self.delete_on_finish:
-            async with self.client_session.delete(url) as response:
-                result: dict = await response.json()
-        else:
-            body = {
-                "action": "delete"
-            }
-            async with self.client_session.post(url, json=body) as response:
-                result: dict = await response.json()
+        async with governor.http_request(url):
+            if self.delete_on_finish:
+                async with self.client_session.delete(url) as response:
+                    result: dict = await response.json()
+            else:
+                body = {
+                    "action": "delete"
+                }
+                async with self.client_session.post(url, json=body) as response:
+                    result: dict = await response.json()
 
         return result.get('should_finish', -1)
         
@@ -111,7 +131,7 @@ class LabDiscoveryLibResourceClient(AbstractResourceClient):
     
     def _get_start_body(self, reservation_request: ReservationRequest) -> dict:
         now = datetime.datetime.now(datetime.timezone.utc)
-        laboratory = lde_config.laboratories[reservation_request.laboratory]
+        laboratory = worker_config.current.laboratories[reservation_request.laboratory]
         return {
             'request': {
                 'locale': reservation_request.locale,
@@ -151,7 +171,7 @@ class WebLabLibResourceClient(AbstractResourceClient):
 
     def _get_start_body(self, reservation_request: ReservationRequest) -> dict:
         now = datetime.datetime.now(datetime.timezone.utc)
-        laboratory = lde_config.laboratories[reservation_request.laboratory]
+        laboratory = worker_config.current.laboratories[reservation_request.laboratory]
         client_initial_data = dict(reservation_request.client_initial_data or {})
         client_initial_data.setdefault('back', reservation_request.back_url)
         client_initial_data.setdefault('back_url', reservation_request.back_url)
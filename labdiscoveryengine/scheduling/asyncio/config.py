@@ -0,0 +1,60 @@
+"""
+Direct access to the configuration in the worker.
+
+In the web processes, lde_config (a LocalProxy resolving current_app.config['LDE_CONFIG'])
+is convenient, but the worker reads the configuration constantly from the same
+asyncio loop and the same app. Here the current snapshot is kept in a plain attribute,
+which is replaced at once when the configuration is reloaded (snapshots are never
+modified, see get_latest_configuration).
+"""
+from typing import Any, Dict, Optional
+
+from flask import current_app
+
+from labdiscoveryengine.configuration.storage import StoredConfiguration
+from labdiscoveryengine.utils import get_lde_config
+
+class WorkerConfiguration:
+    def __init__(self):
+        self._configuration: Optional[StoredConfiguration] = None
+        self._app_config: Optional[Dict[str, Any]] = None
+
+    def initialize(self, app_config: Dict[str, Any]):
+        """
+        Bind the Flask app config (e.g., current_app.config) of the worker
+        """
+        self._app_config = app_config
+        self._configuration = app_config['LDE_CONFIG']
+
+    @property
+    def current(self) -> StoredConfiguration:
+        """
+        Current configuration snapshot
+        """
+        if self._configuration is None:
+            # Not initialized (e.g., in tests): use the app context
+            return get_lde_config()
+        return self._configuration
+
+    @property
+    def app_config(self) -> Dict[str, Any]:
+        """
+        Flask app config (e.g., for variables such as CONFIGURATION_RELOAD_INTERVAL)
+        """
+        if self._app_config is None:
+            return current_app.config
+        return self._app_config
+
+    def update(self, configuration: StoredConfiguration):
+        """
+        Replace the current configuration snapshot (also in the Flask app config)
+        """
+        self.app_config['LDE_CONFIG'] = configuration
+        if self._app_config is not None:
+            self._configuration = configuration
+
+    def reset(self):
+        self._configuration = None
+        self._app_config = None
+
+worker_config = WorkerConfiguration()
@@ -0,0 +1,82 @@
+"""
+Limits on the concurrent operations of the worker.
+
+With hundreds of resources, a burst (e.g., a whole class starting at the same time)
+makes every ResourceWorker, ResourceReservationProcessor and healthcheck talk to
+Redis, MongoDB and the laboratories at once. The governor caps the concurrent
+operations per backend and per laboratory host (WORKER_MAX_* in configuration.yml);
+the rest wait for their turn instead of opening more connections. For Redis, the
+connection pool itself is also bounded by the same limit (see create_redis_client),
+so commands not wrapped in governor.limit wait as well.
+"""
+import asyncio
+import contextlib
+
+from typing import Any, AsyncIterator, Dict, Optional
+from urllib.parse import urlparse
+
+class Backends:
+    redis = 'redis'
+    mongo = 'mongo'
+    http = 'http'
+
+class ConcurrencyGovernor:
+    def __init__(self):
+        self.limits: Dict[str, int] = {}
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.host_limit: int = 0
+        self.host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def configure(self, app_config: Dict[str, Any]):
+        """
+        Set the limits from the Flask app config (0 or None means no limit). Not configured, nothing is limited.
+        """
+        self.limits = {
+            Backends.redis: app_config.get('WORKER_MAX_REDIS_OPERATIONS') or 0,
+            Backends.mongo: app_config.get('WORKER_MAX_MONGO_OPERATIONS') or 0,
+            Backends.http: app_config.get('WORKER_MAX_HTTP_REQUESTS') or 0,
+        }
+        self.semaphores = { backend: asyncio.Semaphore(limit) for backend, limit in self.limits.items() if limit > 0 }
+        self.host_limit = app_config.get('WORKER_MAX_REQUESTS_PER_HOST') or 0
+        self.host_semaphores = {}
+
+    @contextlib.asynccontextmanager
+    async def limit(self, backend: str) -> AsyncIterator[None]:
+        """
+        async with governor.limit(Backends.mongo):
+            await async_mongo.sessions.update_one(...)
+        """
+        semaphore = self.semaphores.get(backend)
+        if semaphore is None:
+            yield
+            return
+
+        async with semaphore:
+            yield
+
+    @contextlib.asynccontextmanager
+    async def http_request(self, url: str) -> AsyncIterator[None]:
+        """
+        Limit both the HTTP requests in general and the ones to the host of url
+        """
+        host_semaphore = self._get_host_semaphore(urlparse(url).netloc)
+        if host_semaphore is None:
+            async with self.limit(Backends.http):
+                yield
+            return
+
+        # The host slot first: waiting for a busy laboratory must not hold a global slot
+        async with host_semaphore:
+            async with self.limit(Backends.http):
+                yield
+
+    def _get_host_semaphore(self, host: str) -> Optional[asyncio.Semaphore]:
+        if self.host_limit <= 0:
+            return None
+
+        semaphore = self.host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = self.host_semaphores[host] = asyncio.Semaphore(self.host_limit)
+        return semaphore
+
+governor = ConcurrencyGovernor()
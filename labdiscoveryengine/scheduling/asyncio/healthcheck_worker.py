@@ -1,16 +1,22 @@
+import re
+import json
+import time
 import asyncio
 import ast
+import random
 import datetime
 import logging
-from typing import Optional
+from collections import deque
+from typing import Any, Deque, Dict, NamedTuple, Optional
 import aiohttp
 
-from labdiscoveryengine.data import Resource, RobotcheckerHealthcheck
+from labdiscoveryengine.data import HttpHealthcheck, Resource, RobotcheckerHealthcheck
 from labdiscoveryengine.scheduling.data import ResourceHealth
 from labdiscoveryengine.scheduling.asyncio.redis import aioredis_store
 from labdiscoveryengine.scheduling.keys import ResourceKeys
 
-from labdiscoveryengine.utils import lde_config
+from labdiscoveryengine.scheduling.asyncio.config import worker_config
+from labdiscoveryengine.scheduling.asyncio.governor import Backends, governor
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +48,102 @@ def format_robotchecker_message(message: Optional[str]) -> Optional[str]:
     return message
 
 
+def _sources(states) -> str:
+    return ",".join(sorted({ state.source for state in states if state.source })) or "healthcheck"
+
+class JsonPathNotFound(Exception):
+    pass
+
+def resolve_json_path(payload: Any, json_path: str) -> Any:
+    """
+    Value of a dotted path (e.g., devices.0.status) in a JSON document
+    """
+    value = payload
+    for part in json_path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.lstrip('-').isdigit() and -len(value) <= int(part) < len(value):
+            value = value[int(part)]
+        else:
+            raise JsonPathNotFound(json_path)
+    return value
+
+class HealthcheckHttpPool:
+    """
+    A single aiohttp session (and therefore connection pool) shared by the healthchecks
+    of every resource of the worker, instead of one per healthcheck
+    """
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+healthcheck_http_pool = HealthcheckHttpPool()
+
+class ProbeResponse(NamedTuple):
+    status: Optional[int]
+    body: str = ""
+    latency: float = 0 # seconds
+    # The request failed (e.g., connection refused or timeout)
+    error: Optional[str] = None
+    fetched_at: float = 0 # time.monotonic()
+
+class HealthcheckProbeRegistry:
+    """
+    Many resources often point their healthchecks to the same URL (e.g., a checker
+    reporting several devices). The registry fetches each URL at most once every
+    max_age seconds, whatever the number of resources using it, and concurrent
+    checks of the same URL wait for the same request.
+    """
+    def __init__(self):
+        self.responses: Dict[str, ProbeResponse] = {}
+        self.pending: Dict[str, asyncio.Future] = {}
+
+    async def fetch(self, url: str, timeout: float, max_age: float) -> ProbeResponse:
+        response = self.responses.get(url)
+        if response is not None and time.monotonic() - response.fetched_at < max_age:
+            return response
+
+        pending = self.pending.get(url)
+        if pending is None:
+            pending = self.pending[url] = asyncio.ensure_future(self._fetch(url, timeout))
+            pending.add_done_callback(lambda _: self.pending.pop(url, None))
+
+        # Cancelling one of the checks (e.g., its resource was removed) must not cancel the others
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, url: str, timeout: float) -> ProbeResponse:
+        try:
+            async with governor.http_request(url):
+                start_time = time.monotonic()
+                async with healthcheck_http_pool.session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as http_response:
+                    body = await http_response.text()
+                latency = time.monotonic() - start_time
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            response = ProbeResponse(status=None, error=str(err) or type(err).__name__, fetched_at=time.monotonic())
+        else:
+            response = ProbeResponse(status=http_response.status, body=body, latency=latency, fetched_at=time.monotonic())
+
+        self.responses[url] = response
+        return response
+
+    async def close(self):
+        for pending in list(self.pending.values()):
+            pending.cancel()
+        self.pending.clear()
+        self.responses.clear()
+
+healthcheck_probes = HealthcheckProbeRegistry()
+
 class ResourceHealthchecksWorker:
     """
     A healthcheck worker task represents a worker, which handles exclusively the healthchecks
@@ -49,40 +151,95 @@ class ResourceHealthchecksWorker:
 
     This means that no other process or thread elsewhere representing or managing
     this resource.
+
+    The time between checks adapts to the resource: it grows while the resource is
+    stably healthy (up to max_interval) and it is min_interval while the resource is
+    broken, unknown or flapping. It is always jittered, so the healthchecks of hundreds
+    of resources do not run at the same time.
     """
+    min_interval = 10 # seconds
+    base_interval = 30
+    max_interval = 300
+    interval_growth = 1.5
+    jitter = 0.2
+    # Number of recent results considered to detect flapping
+    history_size = 6
+    # Flap damping: a different status is only published after this many consecutive results
+    confirmations = 2
+    # Maximum (approximate) number of results kept in lde:resources:<resource>:health:history
+    history_length = 2000
+
     def __init__(self, resource_name):
         self.task: Optional[asyncio.Task] = None
         self.resource_name: str = resource_name
-        self.resource: Resource = lde_config.resources[resource_name]
-        self.minimum_time_between_checks = 30 # seconds
+        self.resource: Resource = worker_config.current.resources[resource_name]
+        self.interval: float = self.base_interval
+        self.history: Deque[Optional[str]] = deque(maxlen=self.history_size)
+        # Status in lde:resources:<resource>:health, and the different one waiting for confirmation
+        self.published_status: Optional[str] = None
+        self.pending_status: Optional[str] = None
+        self.pending_results: int = 0
         self.resource_keys = ResourceKeys(resource_name)
 
     async def run(self):
+        # Do not check every resource at the same time when the worker starts
+        await asyncio.sleep(random.uniform(0, self.min_interval))
         while True:
             try:
-                await self.check_robotchecker_health()
-                await asyncio.sleep(self.minimum_time_between_checks)
+                status = await self.check_health()
+                await asyncio.sleep(self.next_interval(status))
             except asyncio.CancelledError:
                 break
             except Exception as err:
                 logger.error(f"Error checking health of resource {self.resource_name}: {err}", exc_info=True)
                 await self.mark_as_unknown(str(err), source="healthcheck-worker")
-                await asyncio.sleep(self.minimum_time_between_checks)
+                await asyncio.sleep(self.next_interval(ResourceHealth.states.unknown))
+
+    def next_interval(self, status: Optional[str]) -> float:
+        """
+        Time until the next check, given the status of the last one (None if there is nothing to check)
+        """
+        if status is None:
+            self.interval = self.max_interval
+        else:
+            self.history.append(status)
+            history = list(self.history)
+            changes = sum(1 for previous, current in zip(history, history[1:]) if previous != current)
+            if status != ResourceHealth.states.healthy or changes >= 2:
+                self.interval = self.min_interval
+            elif changes == 0 and len(history) > 1:
+                self.interval = min(self.interval * self.interval_growth, self.max_interval)
+            else:
+                self.interval = self.base_interval
 
-    async def check_robotchecker_health(self):
-        robotchecker_healthchecks = [
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def check_health(self) -> Optional[str]:
+        """
+        Run every healthcheck of the resource (concurrently) and store the result in
+        lde:resources:<resource>:health, which the web checks before queueing reservations
+        on the resource. Returns the resulting status, or None if the resource has no
+        healthcheck to run.
+        """
+        healthchecks = [
             healthcheck
             for healthcheck in self.resource.healthchecks
-            if isinstance(healthcheck, RobotcheckerHealthcheck)
+            if isinstance(healthcheck, HttpHealthcheck)
         ]
 
-        if not robotchecker_healthchecks:
-            await self.mark_as_unknown(source="no-robotchecker")
-            return
+        if not healthchecks:
+            await self.mark_as_unknown(source="no-healthchecks")
+            return None
 
-        states = []
-        for healthcheck in robotchecker_healthchecks:
-            states.append(await self._run_robotchecker_healthcheck(healthcheck))
+        states = await asyncio.gather(*[
+            self._run_robotchecker_healthcheck(healthcheck)
+            if isinstance(healthcheck, RobotcheckerHealthcheck)
+            else self._run_http_healthcheck(healthcheck)
+            for healthcheck in healthchecks
+        ])
+
+        latencies = [state.latency for state in states if state.latency is not None]
+        latency = max(latencies) if latencies else None
 
         broken_states = [state for state in states if state.status == ResourceHealth.states.broken]
         if broken_states:
@@ -90,38 +247,92 @@ class ResourceHealthchecksWorker:
                 state.message or "checker reported the resource as broken"
                 for state in broken_states
             )
-            await self.mark_as_broken(message, source="robotchecker")
-            return
+            await self.mark_as_broken(message, source=_sources(broken_states), latency=latency)
+            return ResourceHealth.states.broken
 
-        if any(state.status == ResourceHealth.states.healthy for state in states):
-            await self.mark_as_fixed(source="robotchecker")
-            return
+        healthy_states = [state for state in states if state.status == ResourceHealth.states.healthy]
+        if healthy_states:
+            await self.mark_as_fixed(source=_sources(healthy_states), latency=latency)
+            return ResourceHealth.states.healthy
 
         messages = [state.message for state in states if state.message]
-        await self.mark_as_unknown("; ".join(messages) or None, source="robotchecker")
+        await self.mark_as_unknown("; ".join(messages) or None, source=_sources(states), latency=latency)
+        return ResourceHealth.states.unknown
+
+    async def _run_http_healthcheck(self, healthcheck: HttpHealthcheck) -> ResourceHealth:
+        """
+        A plain HTTP probe to the device: unlike the robotchecker (a separate service), not
+        getting the expected response means that the device is broken.
+        """
+        response = await self._fetch(healthcheck)
+        if response.error is not None:
+            return self._http_broken(healthcheck, response.error)
+
+        if response.status != healthcheck.expected_status:
+            return self._http_broken(healthcheck, f"HTTP {response.status} (expected {healthcheck.expected_status})")
+
+        if healthcheck.body_regex is not None and re.search(healthcheck.body_regex, response.body) is None:
+            return self._http_broken(healthcheck, f"body does not match {healthcheck.body_regex!r}")
+
+        if healthcheck.json_path is not None:
+            try:
+                value = resolve_json_path(json.loads(response.body), healthcheck.json_path)
+            except ValueError as err:
+                return self._http_broken(healthcheck, f"invalid JSON: {err}")
+            except JsonPathNotFound:
+                return self._http_broken(healthcheck, f"{healthcheck.json_path} not found")
+
+            if healthcheck.json_value is None:
+                valid = bool(value)
+            else:
+                valid = value == healthcheck.json_value or str(value) == str(healthcheck.json_value)
+            if not valid:
+                return self._http_broken(healthcheck, f"{healthcheck.json_path} is {value!r}")
+
+        if healthcheck.max_latency is not None and response.latency > healthcheck.max_latency:
+            return self._http_broken(healthcheck, f"responded in {response.latency:.2f} seconds (maximum: {healthcheck.max_latency})")
+
+        return ResourceHealth(
+            resource=self.resource_name,
+            status=ResourceHealth.states.healthy,
+            source="http",
+            latency=response.latency,
+        )
+
+    def _http_broken(self, healthcheck: HttpHealthcheck, message: str) -> ResourceHealth:
+        return ResourceHealth(
+            resource=self.resource_name,
+            status=ResourceHealth.states.broken,
+            message=f"{healthcheck.identifier}: {message}",
+            source="http",
+        )
+
+    async def _fetch(self, healthcheck: HttpHealthcheck) -> ProbeResponse:
+        # Responses of other resources checking the same URL are reused while they are recent
+        return await healthcheck_probes.fetch(healthcheck.url, healthcheck.timeout, max_age=self.min_interval)
 
     async def _run_robotchecker_healthcheck(self, healthcheck: RobotcheckerHealthcheck) -> ResourceHealth:
-        timeout = aiohttp.ClientTimeout(total=healthcheck.timeout)
-        try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(healthcheck.url) as response:
-                    if response.status != 200:
-                        return ResourceHealth(
-                            resource=self.resource_name,
-                            status=ResourceHealth.states.unknown,
-                            message=f"{healthcheck.identifier}: HTTP {response.status}",
-                            source="robotchecker",
-                        )
-                    payload = await response.json()
-        except Exception as err:
+        response = await self._fetch(healthcheck)
+        if response.error is not None:
+            message = response.error
+        elif response.status != 200:
+            message = f"HTTP {response.status}"
+        else:
+            try:
+                payload = json.loads(response.body)
+                message = None
+            except ValueError as err:
+                message = f"invalid JSON: {err}"
+
+        if message is not None:
             return ResourceHealth(
                 resource=self.resource_name,
                 status=ResourceHealth.states.unknown,
-                message=f"{healthcheck.identifier}: {err}",
+                message=f"{healthcheck.identifier}: {message}",
                 source="robotchecker",
             )
 
-        if payload.get("found") is not True:
+        if not isinstance(payload, dict) or payload.get("found") is not True:
             return ResourceHealth(
                 resource=self.resource_name,
                 status=ResourceHealth.states.unknown,
@@ -134,6 +345,7 @@ class ResourceHealthchecksWorker:
                 resource=self.resource_name,
                 status=ResourceHealth.states.healthy,
                 source="robotchecker",
+                latency=response.latency,
             )
 
         return ResourceHealth(
@@ -141,24 +353,68 @@ class ResourceHealthchecksWorker:
             status=ResourceHealth.states.broken,
             message=format_robotchecker_message(payload.get("message")) or f"{healthcheck.identifier}: checker reported failure",
             source="robotchecker",
+            latency=response.latency,
         )
 
-    async def mark_as_broken(self, error_message: str, source: str = "healthcheck"):
-        await self._write_health(ResourceHealth.states.broken, error_message, source=source)
+    async def mark_as_broken(self, error_message: str, source: str = "healthcheck", latency: Optional[float] = None):
+        await self._write_health(ResourceHealth.states.broken, error_message, source=source, latency=latency)
+
+    async def mark_as_fixed(self, source: str = "healthcheck", latency: Optional[float] = None):
+        await self._write_health(ResourceHealth.states.healthy, None, source=source, latency=latency)
+
+    async def mark_as_unknown(self, message: Optional[str] = None, source: str = "healthcheck", latency: Optional[float] = None):
+        await self._write_health(ResourceHealth.states.unknown, message, source=source, latency=latency)
+
+    def _confirm_status(self, status: str) -> bool:
+        """
+        Flap damping: a status different from the published one is only published once
+        it is the result of `confirmations` consecutive checks
+        """
+        if self.published_status is None or status == self.published_status:
+            self.published_status = status
+            self.pending_status = None
+            self.pending_results = 0
+            return True
+
+        if status == self.pending_status:
+            self.pending_results += 1
+        else:
+            self.pending_status = status
+            self.pending_results = 1
+
+        if self.pending_results >= self.confirmations:
+            logger.info(f"Resource {self.resource_name} is now {status} (it was {self.published_status})")
+            self.published_status = status
+            self.pending_status = None
+            self.pending_results = 0
+            return True
+
+        return False
+
+    async def _write_health(self, status: str, message: Optional[str], source: str, latency: Optional[float] = None):
+        async with governor.limit(Backends.redis):
+            pipeline = aioredis_store.pipeline()
+            # Every result is kept in the history (it is the time of the entry)
+            pipeline.xadd(self.resource_keys.health_history(), {
+                "status": status,
+                "latency": f"{latency:.3f}" if latency is not None else "",
+            }, maxlen=self.history_length, approximate=True)
 
-    async def mark_as_fixed(self, source: str = "healthcheck"):
-        await self._write_health(ResourceHealth.states.healthy, None, source=source)
+            if self._confirm_status(status):
+                pipeline.hset(self.resource_keys.health(), mapping={
+                    "status": status,
+                    "message": message or "",
+                    "source": source,
+                    "checked_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    "latency": f"{latency:.3f}" if latency is not None else "",
+                })
+            await pipeline.execute()
 
-    async def mark_as_unknown(self, message: Optional[str] = None, source: str = "healthcheck"):
-        await self._write_health(ResourceHealth.states.unknown, message, source=source)
+    def update_resource(self, resource: Resource):
+        self.resource = resource
 
-    async def _write_health(self, status: str, message: Optional[str], source: str):
-        await aioredis_store.hset(self.resource_keys.health(), mapping={
-            "status": status,
-            "message": message or "",
-            "source": source,
-            "checked_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
-        })
+    def running(self):
+        return self.task is not None and not self.task.done()
 
     async def start(self):
         if self.task is not None:
@@ -0,0 +1,82 @@
+"""
+Ownership of the resources among several workers (e.g., in different hosts).
+
+A worker only runs the ResourceWorker of a resource while it holds its lease: a
+Redis key (lde:resources:<resource>:lease) with the identifier of the worker and
+a short TTL (WORKER_LEASE_TTL). The worker renews its leases every third of the
+TTL. If it stops renewing them (e.g., the host is down), the leases expire and
+another worker takes the resources over, continuing the reservation in progress
+(see ResourceWorker.process_unfinished_reservation).
+"""
+import os
+import time
+import asyncio
+import socket
+import secrets
+import logging
+
+from typing import Iterable, Set
+
+from labdiscoveryengine.scheduling.asyncio.redis import async_lua_scripts
+
+logger = logging.getLogger(__name__)
+
+def generate_owner_identifier() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+class ResourceLeases:
+    def __init__(self, ttl: float, owner: str = None):
+        self.ttl = ttl
+        self.owner: str = owner or generate_owner_identifier()
+        self.held: Set[str] = set()
+        self.last_renewal = 0
+        # Operations are serialized, so a renewal never takes back a lease being released
+        self._lock = asyncio.Lock()
+
+    @property
+    def ttl_ms(self) -> int:
+        return int(self.ttl * 1000)
+
+    async def acquire(self, resource_names: Iterable[str]) -> Set[str]:
+        """
+        Try to acquire the leases of the resources. Returns the ones acquired.
+        """
+        async with self._lock:
+            resource_names = [ resource_name for resource_name in resource_names if resource_name not in self.held ]
+            acquired = set(await async_lua_scripts.acquire_resource_leases(self.owner, self.ttl_ms, resource_names))
+            self.held.update(acquired)
+            return acquired
+
+    def renewal_needed(self) -> bool:
+        return time.monotonic() - self.last_renewal >= self.ttl / 3
+
+    async def renew(self) -> Set[str]:
+        """
+        Renew every lease held. Returns the leases lost (they expired and another
+        worker took them), whose resources must not be managed anymore.
+        """
+        async with self._lock:
+            self.last_renewal = time.monotonic()
+            renewed = set(await async_lua_scripts.acquire_resource_leases(self.owner, self.ttl_ms, sorted(self.held)))
+            lost = self.held - renewed
+            self.held = renewed
+        if lost:
+            logger.warning(f"Leases lost (taken by other workers): {', '.join(sorted(lost))}")
+        return lost
+
+    async def release(self, resource_names: Iterable[str]):
+        """
+        Release the leases, so other workers can take the resources immediately
+        """
+        async with self._lock:
+            resource_names = [ resource_name for resource_name in resource_names if resource_name in self.held ]
+            self.held.difference_update(resource_names)
+            await async_lua_scripts.release_resource_leases(self.owner, resource_names)
+
+    async def keep_renewing(self):
+        """
+        Renew the leases until cancelled (e.g., while handing the resources over)
+        """
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            await self.renew()
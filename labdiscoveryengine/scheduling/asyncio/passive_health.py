@@ -0,0 +1,185 @@
+"""
+Passive health of the resources, inferred from the reservations themselves.
+
+The healthchecks only run every few seconds (or minutes), and many resources have
+none. Meanwhile, every reservation tells us something: if starting (or finishing)
+sessions on a resource fails several times in a row, or starting them suddenly
+takes much longer than usual, the device is probably failing right now.
+
+After PASSIVE_HEALTH_FAILURES consecutive failures, the resource is put on probation
+for PASSIVE_HEALTH_PROBATION seconds: the web stops queueing reservations on it (see
+get_resource_health) and its worker stops taking them. Once the probation is over,
+the next reservation is a trial: if it works, the resource recovers; if it fails, it
+goes back to probation for twice as long (up to max_probation_factor times).
+"""
+import time
+import json
+import logging
+
+from typing import Any, Dict, Optional
+
+from labdiscoveryengine.scheduling.keys import ResourceKeys
+from labdiscoveryengine.scheduling.asyncio.redis import aioredis_store
+from labdiscoveryengine.scheduling.asyncio.governor import Backends, governor
+
+logger = logging.getLogger(__name__)
+
+class PassiveHealthSignals:
+    start_failed = 'start-failed'
+    finish_failed = 'finish-failed'
+    slow_start = 'slow-start'
+
+class ResourcePassiveHealth:
+    """
+    Signals of a single resource. Only the worker holding the resource writes them.
+    """
+    # Start latencies needed before detecting outliers
+    min_latency_samples = 10
+    # A start is an outlier if it takes more than mean + outlier_deviations * deviation...
+    outlier_deviations = 4
+    # ...and more than this many seconds (so fast devices are not flagged for small variations)
+    min_outlier_latency = 5.0
+    # Weight of each new latency in the moving average and deviation
+    latency_alpha = 0.1
+    max_probation_factor = 32
+
+    def __init__(self, resource_name: str, failures: int = 3, probation: float = 60):
+        self.resource_name = resource_name
+        self.failures = failures
+        self.probation = probation
+        self.consecutive_failures: int = 0
+        self.probations: int = 0
+        self.probation_until: float = 0
+        self.last_signal: Optional[str] = None
+        self.last_message: Optional[str] = None
+        self.latency_samples: int = 0
+        self.latency_mean: float = 0
+        self.latency_variance: float = 0
+
+    def in_probation(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) < self.probation_until
+
+    def is_latency_outlier(self, latency: float) -> bool:
+        if self.latency_samples < self.min_latency_samples:
+            return False
+        threshold = self.latency_mean + self.outlier_deviations * self.latency_variance ** 0.5
+        return latency > max(threshold, self.min_outlier_latency)
+
+    def _add_latency(self, latency: float):
+        self.latency_samples += 1
+        if self.latency_samples == 1:
+            self.latency_mean = latency
+            return
+        # Exponentially weighted mean and variance
+        difference = latency - self.latency_mean
+        increment = self.latency_alpha * difference
+        self.latency_mean += increment
+        self.latency_variance = (1 - self.latency_alpha) * (self.latency_variance + difference * increment)
+
+    def record_success(self, latency: Optional[float] = None) -> bool:
+        """
+        A session was started (with its latency) or finished correctly. Returns True if
+        the state changed (and must be published).
+        """
+        if latency is not None:
+            outlier = self.is_latency_outlier(latency)
+            usual_latency = self.latency_mean
+            # Outliers move the baseline too: a device that becomes permanently slower (e.g.,
+            # new firmware) stops being an outlier after a few sessions, instead of staying on
+            # probation forever
+            self._add_latency(latency)
+            if outlier:
+                return self.record_failure(PassiveHealthSignals.slow_start, f"started in {latency:.1f} seconds (usually {usual_latency:.1f})")
+
+        if self.consecutive_failures == 0 and self.probations == 0:
+            return False
+
+        if self.probations:
+            logger.info(f"Resource {self.resource_name} recovered after {self.probations} probation(s)")
+        self.consecutive_failures = 0
+        self.probations = 0
+        self.probation_until = 0
+        return True
+
+    def record_failure(self, signal: str, message: str, now: Optional[float] = None) -> bool:
+        """
+        A session could not be started or finished (or was too slow). Returns True if the
+        state changed (and must be published).
+        """
+        now = now or time.time()
+        self.consecutive_failures += 1
+        self.last_signal = signal
+        self.last_message = message
+
+        # After a probation, a single failure of the trial is enough
+        threshold = 1 if self.probations else self.failures
+        if self.consecutive_failures >= threshold:
+            factor = min(2 ** self.probations, self.max_probation_factor)
+            self.probations += 1
+            self.consecutive_failures = 0
+            self.probation_until = now + self.probation * factor
+            logger.warning(f"Resource {self.resource_name} on probation for {self.probation * factor:.0f} seconds: {signal}: {message}")
+
+        return True
+
+    def todict(self) -> Dict[str, Any]:
+        return {
+            'consecutive_failures': self.consecutive_failures,
+            'probations': self.probations,
+            'probation_until': self.probation_until,
+            'last_signal': self.last_signal or '',
+            'last_message': self.last_message or '',
+        }
+
+class PassiveHealthTracker:
+    def __init__(self):
+        self.failures: int = 3
+        self.probation: float = 60
+        self.resources: Dict[str, ResourcePassiveHealth] = {}
+
+    def configure(self, app_config: Dict[str, Any]):
+        """
+        Set the thresholds from the Flask app config (PASSIVE_HEALTH_FAILURES 0 disables it)
+        """
+        self.failures = app_config.get('PASSIVE_HEALTH_FAILURES', self.failures) or 0
+        self.probation = app_config.get('PASSIVE_HEALTH_PROBATION', self.probation) or 0
+        self.resources = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.failures > 0 and self.probation > 0
+
+    def get(self, resource_name: str) -> ResourcePassiveHealth:
+        resource_health = self.resources.get(resource_name)
+        if resource_health is None:
+            resource_health = self.resources[resource_name] = ResourcePassiveHealth(resource_name, failures=self.failures, probation=self.probation)
+        return resource_health
+
+    def in_probation(self, resource_name: str) -> bool:
+        return self.enabled and resource_name in self.resources and self.resources[resource_name].in_probation()
+
+    async def record_success(self, resource_name: str, latency: Optional[float] = None):
+        if self.enabled and self.get(resource_name).record_success(latency):
+            await self._publish(resource_name)
+
+    async def record_failure(self, resource_name: str, signal: str, message: str):
+        if self.enabled and self.get(resource_name).record_failure(signal, message):
+            await self._publish(resource_name)
+
+    async def _publish(self, resource_name: str):
+        """
+        Store the state in lde:resources:<resource>:health:passive, where the web reads it
+        """
+        resource_health = self.get(resource_name)
+        key = ResourceKeys(resource_name).passive_health()
+        try:
+            async with governor.limit(Backends.redis):
+                if resource_health.consecutive_failures == 0 and resource_health.probations == 0:
+                    await aioredis_store.delete(key)
+                else:
+                    await aioredis_store.set(key, json.dumps(resource_health.todict()), ex=int(self.probation * ResourcePassiveHealth.max_probation_factor) + 3600)
+        except Exception as err:
+            # Passive health is a hint: never fail a reservation because of it
+            logger.warning(f"Could not store the passive health of {resource_name}: {err}")
+
+passive_health = PassiveHealthTracker()
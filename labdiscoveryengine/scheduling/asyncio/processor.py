@@ -8,6 +8,7 @@ from typing import Optional, Tuple
 import aiohttp.web
 import aiohttp.client_exceptions
 
+from labdiscoveryengine.history.rollups import build_rollup_update
 from labdiscoveryengine.scheduling.data import ReservationRequest
 from labdiscoveryengine.utils import is_mongo_active
 
@@ -16,11 +17,12 @@ logger = logging.getLogger(__name__)
 from labdiscoveryengine.data import Resource
 from labdiscoveryengine.scheduling.asyncio.client import AbstractResourceClient, LabDiscoveryLibResourceClient, WebLabLibResourceClient
 from labdiscoveryengine.scheduling.keys import ReservationKeys, ResourceKeys
-from labdiscoveryengine.scheduling.asyncio.redis import aioredis_store
+from labdiscoveryengine.scheduling.asyncio.redis import aioredis_store, async_lua_scripts
 from labdiscoveryengine.scheduling.asyncio.mongodb import async_mongo
-
-# TODO: what to do when fail
-# TODO: check if the user has cancelled the reservation
+from labdiscoveryengine.scheduling.asyncio.governor import Backends, governor
+from labdiscoveryengine.scheduling.asyncio.channels import channel_listener
+from labdiscoveryengine.scheduling.asyncio.passive_health import PassiveHealthSignals, passive_health
+from labdiscoveryengine.scheduling.asyncio.config import worker_config
 
 
 def _coerce_should_finish(value) -> float:
@@ -46,6 +48,17 @@ class ResourceReservationProcessor:
         self.max_cleanup_finish_sleep = 30
         self.status_poll_max_attempts = 3
         self.status_poll_retry_delay = 1.0
+        # If requested (e.g., the worker is shutting down), stop processing at the next safe point
+        self.handover_requested = False
+
+    def request_handover(self):
+        """
+        Stop processing once the session is running (the safe point: everything needed
+        to continue is in Redis), without finishing it. The reservation stays assigned
+        to the resource, so whoever manages the resource next continues it (see
+        ResourceWorker.process_unfinished_reservation).
+        """
+        self.handover_requested = True
 
     def get_client(self) -> AbstractResourceClient:
         """
@@ -57,11 +70,11 @@ class ResourceReservationProcessor:
         """
         Mark the reservation as failed
         """
-        # TODO: what to do? should we pass it to another resource, if available? How do we know which ones have already been tested?
-        # TODO: BUT WATCHOUT: we don't want to deassign if the problem was 
+        # If it could not be started, it is passed to other resources first (see requeue)
         await self.deassign(reservation_request)
         await aioredis_store.hset(self.reservation_keys.base(), ReservationKeys.parameters.status, ReservationKeys.states.broken)
         await aioredis_store.publish(self.reservation_keys.channel(), ReservationKeys.states.broken)
+        await self.store_end_reservation(ReservationKeys.states.broken)
 
     async def fail_closed(self, reason: str):
         """
@@ -71,8 +84,49 @@ class ResourceReservationProcessor:
         could expose hardware that may still be restoring or running user code.
         """
         logger.error(f"[{self.resource.identifier}] Reservation {self.reservation_id} failed closed: {reason}")
+        await passive_health.record_failure(self.resource.identifier, PassiveHealthSignals.finish_failed, reason)
         await aioredis_store.hset(self.reservation_keys.base(), ReservationKeys.parameters.status, ReservationKeys.states.broken)
         await aioredis_store.publish(self.reservation_keys.channel(), ReservationKeys.states.broken)
+        await self.store_end_reservation(ReservationKeys.states.broken)
+
+    async def store_end_reservation(self, status: str):
+        """
+        Store in MongoDB that the reservation is over, so it is not restored if Redis is
+        flushed (see recovery.py). finish stores it (with the durations) otherwise.
+        """
+        if not is_mongo_active():
+            return
+
+        async with governor.limit(Backends.mongo):
+            await async_mongo.sessions.update_one({
+                "reservation_id": self.reservation_id,
+            }, {
+                "$set": {
+                    "end_reservation": datetime.datetime.now(datetime.timezone.utc),
+                    "status": status,
+                }
+            })
+
+    async def requeue(self, reservation_request: ReservationRequest) -> bool:
+        """
+        The reservation could not be started in this resource: queue it again (at the head)
+        in the other resources of the reservation not tried yet, up to START_FAILOVER_ATTEMPTS
+        resources in total. Returns False if it was not queued again (and it must fail).
+        """
+        max_attempts = worker_config.app_config.get('START_FAILOVER_ATTEMPTS') or 0
+        if max_attempts <= 1:
+            return False
+
+        candidates = await async_lua_scripts.requeue_reservation(
+            self.reservation_id, self.resource.identifier,
+            priority=reservation_request.priority, max_attempts=max_attempts,
+        )
+        if not candidates:
+            return False
+
+        logger.warning(f"[{self.resource.identifier}] Reservation {self.reservation_id} queued again in {candidates} other resource(s)")
+        await self.deassign(reservation_request)
+        return True
 
     async def did_user_cancel(self) -> bool:
         """
@@ -96,21 +150,22 @@ class ResourceReservationProcessor:
         try:
             logger.info(f"[{self.resource.identifier}] Starting to process reservation: {self.reservation_id}")
             if is_mongo_active():
-                existing_reservation = await async_mongo.sessions.find_one({
-                    "reservation_id": self.reservation_id,
-                })
-                if existing_reservation is not None:
-                    record = {
-                        "assigned_resource": self.resource.identifier,
-                    }
-                    if existing_reservation.get('start_reservation'):
-                        record['queue_duration'] = (datetime.datetime.utcnow() - existing_reservation['start_reservation']).total_seconds()
-
-                    await async_mongo.sessions.update_one({
+                async with governor.limit(Backends.mongo):
+                    existing_reservation = await async_mongo.sessions.find_one({
                         "reservation_id": self.reservation_id,
-                    }, {
-                        "$set": record
                     })
+                    if existing_reservation is not None:
+                        record = {
+                            "assigned_resource": self.resource.identifier,
+                        }
+                        if existing_reservation.get('start_reservation'):
+                            record['queue_duration'] = (datetime.datetime.utcnow() - existing_reservation['start_reservation']).total_seconds()
+
+                        await async_mongo.sessions.update_one({
+                            "reservation_id": self.reservation_id,
+                        }, {
+                            "$set": record
+                        })
 
             status: Optional[str] = await aioredis_store.hget(self.reservation_keys.base(), ReservationKeys.parameters.status)
             metadata_str: Optional[str] = await aioredis_store.hget(self.reservation_keys.base(), ReservationKeys.parameters.metadata)
@@ -144,16 +199,21 @@ class ResourceReservationProcessor:
                 if await self.did_user_cancel():
                     return await self.cancelled(reservation_request=reservation_request, session_id=session_id)
 
-                if status == ReservationKeys.states.ready:
+                if status in (ReservationKeys.states.ready, ReservationKeys.states.finishing) and session_id is None:
+                    # Started before (e.g., the worker restarted or Redis was recovered)
+                    session_id = await aioredis_store.hget(self.reservation_keys.base(), ReservationKeys.parameters.session_id)
 
-                    if session_id is None:
-                        session_id = await aioredis_store.hget(self.reservation_keys.base(), ReservationKeys.parameters.session_id)
+                if status == ReservationKeys.states.ready:
 
                     while status == ReservationKeys.states.ready:
 
                         if await self.did_user_cancel():
                             return await self.cancelled(reservation_request=reservation_request, session_id=session_id)
 
+                        if self.handover_requested:
+                            logger.info(f"[{self.resource.identifier}] Handing over reservation {self.reservation_id}")
+                            return
+
                         status = await self.wait_for_reservation_being_over(session_id, max_time=10)
                     
                     if status == ReservationKeys.states.cancelling:
@@ -167,6 +227,7 @@ class ResourceReservationProcessor:
                 await self.finish(reservation_request, session_id)
         except (aiohttp.web.HTTPException, aiohttp.client_exceptions.ClientError) as err:
             logger.error(f"[{self.resource.identifier}] Error: failed to process reservation {self.reservation_id}: {err}", exc_info=True)
+            await passive_health.record_failure(self.resource.identifier, PassiveHealthSignals.finish_failed, str(err) or type(err).__name__)
             return await self.fail()
 
     async def initialize_laboratory(self, reservation_request: ReservationRequest) -> Optional[Tuple[str, str]]:
@@ -184,22 +245,36 @@ class ResourceReservationProcessor:
         initialization_pipeline.publish(self.reservation_keys.channel(), status)
         await initialization_pipeline.execute()
 
+        start_time = time.monotonic()
         try:
             url, session_id = await self.client.start(reservation_request)
         except Exception as err:
             logger.error(f"[{self.resource.identifier}] Error: failed to start reservation {self.reservation_id}: {err}", exc_info=True)
+            await passive_health.record_failure(self.resource.identifier, PassiveHealthSignals.start_failed, str(err) or type(err).__name__)
+            if await self.requeue(reservation_request):
+                return None
+            if await self.did_user_cancel():
+                # Not requeued because the user cancelled while it was starting: not broken
+                await self.cancelled(reservation_request=reservation_request, session_id=None)
+                return None
             return await self.fail()
 
+        await passive_health.record_success(self.resource.identifier, latency=time.monotonic() - start_time)
+
         logger.info(f"[{self.resource.identifier}] Successfully started reservation {self.reservation_id}: url {url} and session id {session_id}")
 
         if is_mongo_active():
-            await async_mongo.sessions.update_one({
-                "reservation_id": self.reservation_id,
-            }, {
-                "$set": {
-                    "start": datetime.datetime.now(datetime.timezone.utc),
-                }
-            })
+            async with governor.limit(Backends.mongo):
+                await async_mongo.sessions.update_one({
+                    "reservation_id": self.reservation_id,
+                }, {
+                    "$set": {
+                        "start": datetime.datetime.now(datetime.timezone.utc),
+                        # To continue the session if Redis is flushed (see recovery.py)
+                        "session_id": session_id,
+                        "url": url,
+                    }
+                })
         
         status = ReservationKeys.states.ready
 
@@ -207,6 +282,7 @@ class ResourceReservationProcessor:
         initialized_pipeline.hset(self.reservation_keys.base(), ReservationKeys.parameters.resource, self.resource.identifier)
         initialized_pipeline.hset(self.reservation_keys.base(), ReservationKeys.parameters.url, url)
         initialized_pipeline.hset(self.reservation_keys.base(), ReservationKeys.parameters.session_id, session_id)
+        initialized_pipeline.hset(self.reservation_keys.base(), ReservationKeys.parameters.started_at, time.time())
         initialized_pipeline.hset(self.reservation_keys.base(), ReservationKeys.parameters.status, ReservationKeys.states.ready)
         # Notify potential clients
         initialized_pipeline.publish(self.reservation_keys.channel(), status)
@@ -231,14 +307,16 @@ class ResourceReservationProcessor:
         # (e.g., cancellation), so we wait in a different way.
         t0 = time.time()
 
-        async with aioredis_store.pubsub() as pubsub:
-            await pubsub.subscribe(self.reservation_keys.channel())
+        subscription = channel_listener.subscribe(self.reservation_keys.channel())
+        try:
             elapsed = time.time() - t0
             while elapsed <= waiting_time:
-                message = await pubsub.get_message(timeout=waiting_time - elapsed)
+                message = await subscription.get_message(timeout=waiting_time - elapsed)
                 elapsed = time.time() - t0
                 if await self.did_user_cancel():
                     return ReservationKeys.states.cancelling
+        finally:
+            channel_listener.unsubscribe(subscription)
         
         return ReservationKeys.states.ready
 
@@ -285,6 +363,9 @@ class ResourceReservationProcessor:
                 await asyncio.sleep(min(float(sleep_for), self.max_cleanup_finish_sleep))
                 should_finish = _coerce_should_finish(await self.client.finish(session_id))
 
+            await passive_health.record_success(self.resource.identifier)
+            await self.record_session_duration(reservation_request)
+
         # Then mark that we are indeed finished
         status = ReservationKeys.states.finished
         await aioredis_store.hset(self.reservation_keys.base(), ReservationKeys.parameters.status, status)
@@ -294,27 +375,57 @@ class ResourceReservationProcessor:
         logger.info(f"[{self.resource.identifier}] Reservation {self.reservation_id} finished")
 
         if is_mongo_active():
-            existing_record = await async_mongo.sessions.find_one({
-                "reservation_id": self.reservation_id,
-            })
-
-            if existing_record is not None:
-                now = datetime.datetime.now(datetime.timezone.utc)
-                utcnow = datetime.datetime.utcnow()
-                record = {
-                    "end_reservation": now,
-                }
-                if existing_record.get("start") is not None:
-                    record['min_duration'] = (utcnow - existing_record['start']).total_seconds()
-                    record['max_duration'] = (utcnow - existing_record['start']).total_seconds()
-                await async_mongo.sessions.update_one({
+            async with governor.limit(Backends.mongo):
+                existing_record = await async_mongo.sessions.find_one({
                     "reservation_id": self.reservation_id,
-                }, {
-                    "$set": record
                 })
-        
+
+                if existing_record is not None:
+                    now = datetime.datetime.now(datetime.timezone.utc)
+                    utcnow = datetime.datetime.utcnow()
+                    record = {
+                        "end_reservation": now,
+                        "status": ReservationKeys.states.finished,
+                    }
+                    session_duration: Optional[float] = None
+                    if existing_record.get("start") is not None:
+                        session_duration = (utcnow - existing_record['start']).total_seconds()
+                        record['min_duration'] = session_duration
+                        record['max_duration'] = session_duration
+                    await async_mongo.sessions.update_one({
+                        "reservation_id": self.reservation_id,
+                    }, {
+                        "$set": record
+                    })
+
+                    # Keep the hourly usage rollups up to date, so the admin panel does not need to scan sessions
+                    rollup_filter, rollup_update = build_rollup_update(
+                        laboratory=existing_record.get('laboratory') or (reservation_request.laboratory if reservation_request else None),
+                        resource=self.resource.identifier,
+                        finished_at=utcnow,
+                        queue_duration=existing_record.get('queue_duration'),
+                        session_duration=session_duration,
+                    )
+                    await async_mongo.session_rollups.update_one(rollup_filter, rollup_update, upsert=True)
+
         await self.deassign(reservation_request)
 
+    async def record_session_duration(self, reservation_request: Optional[ReservationRequest]):
+        """
+        Keep the average session duration of the laboratory, to estimate how long the
+        reservations in the queues will wait
+        """
+        if reservation_request is None:
+            return
+
+        started_at = await aioredis_store.hget(self.reservation_keys.base(), ReservationKeys.parameters.started_at)
+        if not started_at:
+            # e.g., restored from MongoDB
+            return
+
+        duration = time.time() - float(started_at)
+        await async_lua_scripts.record_session_duration(reservation_request.laboratory, duration)
+
     async def deassign(self, reservation_request: Optional[ReservationRequest]):
         """
         At resource level, make sure that the laboratory does not have this
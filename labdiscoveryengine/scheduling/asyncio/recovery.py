@@ -0,0 +1,159 @@
+"""
+Recovery of the Redis state after Redis is flushed (e.g., restarted without
+persistence or failed over to an empty replica).
+
+The sessions collection in MongoDB is used as the durable log: every reservation
+is stored there when it is requested (with its metadata) and updated when it
+starts (with the session in the laboratory) and when it finishes. Reservations
+not finished in the last hour (the expiration of the Redis keys) are restored:
+
+ - the ones not started yet are queued again in their resources (unless the user
+   cancelled them)
+ - the ones started are assigned again to their resource, after asking the
+   laboratory (get_should_finish) if the session is still running. If it is, the
+   reservation is restored as ready, so the student does not notice anything. If
+   not, it is restored as finishing, so the worker disposes it.
+"""
+import json
+import asyncio
+import logging
+import datetime
+
+from typing import Any, Dict, NamedTuple, Optional
+
+import aiohttp
+
+from labdiscoveryengine.data import Resource
+from labdiscoveryengine.scheduling.data import ReservationRequest
+from labdiscoveryengine.scheduling.keys import ReservationKeys, ResourceKeys, UserKeys
+from labdiscoveryengine.scheduling.asyncio.redis import aioredis_store, async_lua_scripts
+from labdiscoveryengine.scheduling.asyncio.mongodb import async_mongo
+from labdiscoveryengine.scheduling.asyncio.governor import Backends, governor
+from labdiscoveryengine.scheduling.asyncio.client import AbstractResourceClient
+from labdiscoveryengine.scheduling.asyncio.config import worker_config
+
+logger = logging.getLogger(__name__)
+
+# Same expiration as the Redis keys of the reservations (see store_reservation.lua)
+RESERVATION_MAX_AGE = 3600
+
+RECOVERY_LOCK_KEY = "lde:recovery"
+
+class RecoveryResult(NamedTuple):
+    queued: int = 0
+    running: int = 0
+    finishing: int = 0
+    skipped: int = 0
+
+async def acquire_recovery_lock(owner: str, timeout: float) -> bool:
+    """
+    Only one worker rebuilds the Redis state; the rest wait for it (see wait_for_recovery)
+    """
+    return bool(await aioredis_store.set(RECOVERY_LOCK_KEY, owner, nx=True, px=int(timeout * 1000)))
+
+async def release_recovery_lock(owner: str):
+    await async_lua_scripts.release_lock(RECOVERY_LOCK_KEY, owner)
+
+async def wait_for_recovery(timeout: float) -> bool:
+    """
+    Wait until another worker finishes the recovery (lde:running is set again)
+    """
+    deadline = asyncio.get_event_loop().time() + timeout
+    while asyncio.get_event_loop().time() < deadline:
+        if await aioredis_store.get('lde:running') == 'true':
+            return True
+        await asyncio.sleep(1)
+    return False
+
+async def is_session_running(resource: Resource, session_id: str) -> Optional[bool]:
+    """
+    Ask the laboratory if the session is still running (None if it could not be checked)
+    """
+    try:
+        async with AbstractResourceClient.create(resource) as client:
+            return await client.get_should_finish(session_id) >= 0
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+        logger.warning(f"[{resource.identifier}] Could not check session {session_id}: {err}")
+        return None
+
+async def restore_started_reservation(session: Dict[str, Any], reservation_request: ReservationRequest, metadata: str, status: str):
+    reservation_id = session['reservation_id']
+    resource_name = session['assigned_resource']
+    reservation_keys = ReservationKeys(reservation_id)
+    user_reservations_key = UserKeys(reservation_request.user_identifier).reservations()
+
+    pipeline = aioredis_store.pipeline()
+    pipeline.hset(reservation_keys.base(), mapping={
+        ReservationKeys.parameters.status: status,
+        ReservationKeys.parameters.laboratory: reservation_request.laboratory,
+        ReservationKeys.parameters.metadata: metadata,
+        ReservationKeys.parameters.resource: resource_name,
+        ReservationKeys.parameters.url: session.get('url') or '',
+        ReservationKeys.parameters.session_id: session['session_id'],
+        # So no other resource takes it (see assign_reservation_to_resource.lua)
+        ':assigned': 1,
+    })
+    pipeline.expire(reservation_keys.base(), RESERVATION_MAX_AGE)
+    pipeline.sadd(f"{reservation_keys.base()}:resources", *reservation_request.resources)
+    pipeline.expire(f"{reservation_keys.base()}:resources", RESERVATION_MAX_AGE)
+    pipeline.sadd(user_reservations_key, reservation_id)
+    pipeline.expire(user_reservations_key, RESERVATION_MAX_AGE)
+    # The worker of the resource continues it (see ResourceWorker.process_unfinished_reservation)
+    pipeline.setex(ResourceKeys(resource_name).assigned(), RESERVATION_MAX_AGE, reservation_id)
+    await pipeline.execute()
+
+async def recover_from_mongodb(now: Optional[datetime.datetime] = None) -> RecoveryResult:
+    """
+    Rebuild the reservations of the last hour in Redis from the sessions collection
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    since = now - datetime.timedelta(seconds=RESERVATION_MAX_AGE)
+    configuration = worker_config.current
+
+    queued = running = finishing = skipped = 0
+
+    async with governor.limit(Backends.mongo):
+        sessions = await async_mongo.sessions.find({
+            'end_reservation': None,
+            # e.g., broken: the user was already told
+            'status': {'$nin': ReservationKeys.states.finished_states},
+            'start_reservation': {'$gte': since},
+        }).sort('start_reservation', 1).to_list(None)
+
+    for session in sessions:
+        metadata = session.get('metadata')
+        if not metadata:
+            # Stored before the metadata was kept in MongoDB
+            skipped += 1
+            continue
+
+        reservation_request = ReservationRequest.fromdict(json.loads(metadata))
+
+        cancelled = session.get('status') == ReservationKeys.states.cancelling
+
+        if session.get('start') is None:
+            if cancelled:
+                skipped += 1
+                continue
+            await async_lua_scripts.store_reservation(reservation_request)
+            queued += 1
+            continue
+
+        resource = configuration.resources.get(session.get('assigned_resource'))
+        if resource is None or not session.get('session_id'):
+            logger.warning(f"Reservation {session['reservation_id']} cannot be restored: resource {session.get('assigned_resource')} or its session not found")
+            skipped += 1
+            continue
+
+        session_running = False if cancelled else await is_session_running(resource, session['session_id'])
+        if session_running is False:
+            await restore_started_reservation(session, reservation_request, metadata, ReservationKeys.states.finishing)
+            finishing += 1
+        else:
+            # If the laboratory could not be checked, the worker will check it again
+            await restore_started_reservation(session, reservation_request, metadata, ReservationKeys.states.ready)
+            running += 1
+
+    return RecoveryResult(queued=queued, running=running, finishing=finishing, skipped=skipped)
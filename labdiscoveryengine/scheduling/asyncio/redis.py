@@ -1,9 +1,15 @@
-from typing import List
+import json
+import time
+from typing import List, Optional
 
 from flask import current_app
 from redis.asyncio.client import Redis
+from redis.asyncio.connection import BlockingConnectionPool
 
 from labdiscoveryengine.scheduling.redis_scripts import ScriptNames, SCRIPT_FILES
+from labdiscoveryengine.scheduling.asyncio.governor import Backends, governor
+from labdiscoveryengine.scheduling.asyncio.channels import channel_listener
+from labdiscoveryengine.scheduling.data import ReservationRequest
 from labdiscoveryengine.utils import create_proxied_instance
 
 aioredis_store: Redis = create_proxied_instance(Redis)
@@ -16,13 +22,37 @@ async def is_redis_flushed():
     """
     return await aioredis_store.get('lde:running') != 'true'
 
+def create_redis_client(url: str, max_connections: int = 0) -> Redis:
+    """
+    With max_connections, every command (including pipelines and Lua scripts, and the ones
+    not wrapped in governor.limit) waits for one of max_connections connections, so a burst
+    (e.g., a whole class starting at the same time) cannot exhaust the connections of Redis.
+    """
+    if max_connections <= 0:
+        return Redis.from_url(url, decode_responses=True)
+
+    connection_pool = BlockingConnectionPool.from_url(url, max_connections=max_connections, timeout=None, decode_responses=True)
+    return Redis(connection_pool=connection_pool)
+
 async def initialize_redis():
-    redis_obj = await Redis.from_url(current_app.config['REDIS_URL'], decode_responses=True)
+    redis_url = current_app.config['REDIS_URL']
+    redis_obj = create_redis_client(redis_url, max_connections=governor.limits.get(Backends.redis, 0))
     aioredis_store.set_proxied_object(redis_obj)
 
-    await aioredis_store.set("lde:running", "true")
+    # The subscriptions of all the workers share a single connection, outside of the bounded pool
+    await channel_listener.start(create_redis_client(redis_url))
+
+    if not (current_app.config.get('REDIS_RECOVERY') and current_app.config.get('USING_MONGO')):
+        await mark_redis_running()
+    # Otherwise, if Redis was flushed while no worker was running, the WorkerAggregator recovers it first
     await async_lua_scripts.initialize_asyncio_lua_scripts()
 
+async def mark_redis_running():
+    """
+    Mark that Redis has the state of the reservations (see is_redis_flushed)
+    """
+    await aioredis_store.set("lde:running", "true")
+
 class AsyncLuaScripts:
     """
     Here we have the Lua scripts that can be called from asyncio context
@@ -45,7 +75,8 @@ class AsyncLuaScripts:
         if args is None:
             args = []
 
-        return await script_instance(keys=keys, args=args)
+        async with governor.limit(Backends.redis):
+            return await script_instance(keys=keys, args=args)
     
     async def initialize_asyncio_lua_scripts(self):
         """
@@ -63,4 +94,59 @@ class AsyncLuaScripts:
         """
         return await self._run_lua_script(ScriptNames.assign_reservation_to_resource, args=[resource_name])
 
+    async def release_lock(self, key: str, owner: str) -> bool:
+        """
+        Release a lock taken with SET NX PX, only if owner still holds it
+        """
+        return bool(await self._run_lua_script(ScriptNames.release_lock, keys=[key], args=[owner]))
+
+    async def has_warm_candidate(self, resource_name: str) -> Optional[str]:
+        """
+        Another resource prepared (pre-warm mode), healthy and not on probation that can take
+        the next reservation of the queues of this resource (None if there is none)
+        """
+        return await self._run_lua_script(ScriptNames.has_warm_candidate, args=[resource_name, time.time()])
+
+    async def store_reservation(self, reservation_request: ReservationRequest):
+        """
+        Queue a reservation in its resources (same as in the web, but used to restore them, see recovery.py)
+        """
+        args = [
+            reservation_request.identifier, json.dumps(reservation_request.todict()), reservation_request.laboratory,
+            reservation_request.priority, reservation_request.user_identifier,
+        ]
+        args.extend(reservation_request.resources)
+        return await self._run_lua_script(ScriptNames.store_reservation, args=args)
+
+    async def requeue_reservation(self, reservation_id: str, failed_resource: str, priority: int, max_attempts: int) -> int:
+        """
+        Queue again a reservation that could not be started in failed_resource, at the head of the
+        queues of the resources not tried yet. Returns in how many resources it was queued (0 if none).
+        """
+        return int(await self._run_lua_script(ScriptNames.requeue_reservation, args=[reservation_id, failed_resource, priority, max_attempts]))
+
+    async def record_session_duration(self, laboratory: str, duration: float, alpha: float = 0.1) -> float:
+        """
+        Update the average session duration of the laboratory (used to estimate waiting times).
+        Returns the new average.
+        """
+        return float(await self._run_lua_script(ScriptNames.record_session_duration, args=[laboratory, duration, alpha]))
+
+    async def acquire_resource_leases(self, owner: str, ttl_ms: int, resource_names: List[str]) -> List[str]:
+        """
+        Acquire (or renew) the leases of the resources. Returns the resources whose lease is held by owner
+        """
+        if not resource_names:
+            return []
+        results = await self._run_lua_script(ScriptNames.acquire_resource_leases, args=[owner, ttl_ms] + list(resource_names))
+        return [ resource_name for resource_name, result in zip(resource_names, results) if result == 1 ]
+
+    async def release_resource_leases(self, owner: str, resource_names: List[str]) -> int:
+        """
+        Release the leases of the resources held by owner
+        """
+        if not resource_names:
+            return 0
+        return await self._run_lua_script(ScriptNames.release_resource_leases, args=[owner] + list(resource_names))
+
 async_lua_scripts = AsyncLuaScripts()
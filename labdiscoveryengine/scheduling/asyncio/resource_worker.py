@@ -2,16 +2,19 @@
 Methods that should called from the worker (running in asyncio, and using asyncio libraries)
 """
 
+import time
 import asyncio
 import logging
 
-from typing import Optional
-from labdiscoveryengine.data import Resource
+from typing import Any, Callable, Dict, List, Optional
+from labdiscoveryengine.data import Laboratory, Resource
+from labdiscoveryengine.scheduling.asyncio.client import AbstractResourceClient
 from labdiscoveryengine.scheduling.asyncio.mongodb import initialize_mongodb
 from labdiscoveryengine.scheduling.asyncio.processor import ResourceReservationProcessor
 from labdiscoveryengine.scheduling.asyncio.redis import initialize_redis, aioredis_store
+from labdiscoveryengine.scheduling.asyncio.channels import channel_listener
 
-from labdiscoveryengine.scheduling.keys import ResourceKeys
+from labdiscoveryengine.scheduling.keys import LaboratoryKeys, ResourceKeys
 
 from labdiscoveryengine.scheduling.asyncio.redis import async_lua_scripts
 
@@ -19,15 +22,27 @@ logger = logging.getLogger(__name__)
 
 from flask import current_app
 
-from labdiscoveryengine.utils import lde_config
+from labdiscoveryengine.scheduling.asyncio.config import worker_config
+from labdiscoveryengine.scheduling.asyncio.governor import governor
+from labdiscoveryengine.scheduling.asyncio.passive_health import passive_health
 
 async def initialize_worker():
     """
     Initialize worker
     """
+    worker_config.initialize(current_app.config)
+    governor.configure(current_app.config)
+    passive_health.configure(current_app.config)
     await initialize_redis()
     await initialize_mongodb()
 
+class ResourceWorkerStates:
+    idle = 'idle' # waiting for reservations
+    processing = 'processing'
+    draining = 'draining'
+    stopped = 'stopped'
+    failed = 'failed' # stopped by an error (the WorkerAggregator restarts it)
+
 class ResourceWorker:
     """
     A worker task represents a worker, which handles exclusively a resource of
@@ -48,29 +63,51 @@ class ResourceWorker:
     Given that reservations are assigned to multiple reservations, much of the process is
     just to reject reservations in other resources.
     """
+    # Pre-warm mode: seconds a prepared resource is considered ready (it is prepared again before)
+    prewarm_ttl = 300
+    # Seconds a prepared resource stays in the warm pool unless its worker confirms it again
+    # (every time it wakes up), so the resources of stopped workers leave it soon
+    warm_pool_liveness = 30
+    # Seconds a resource not prepared waits before taking a reservation that a prepared
+    # resource can take, so that one takes it first
+    cold_assignment_delay = 2
+
     def __init__(self, resource_name):
         self.task: Optional[asyncio.Task] = None
         self.resource_name: str = resource_name
-        self.resource: Resource = lde_config.resources[resource_name]
+        self.resource: Resource = worker_config.current.resources[resource_name]
         self.minimum_time_between_checks = 10 # seconds
+        # When draining, the worker finishes the current reservation (if any) but does not take new ones
+        self.draining: bool = False
+        self.processing: bool = False
+        self.processor: Optional[ResourceReservationProcessor] = None
+        self.state: str = ResourceWorkerStates.stopped
+        self.state_since: float = time.time()
+        self.error: Optional[str] = None
+        # Called with the resource name when the state changes (see WorkerAggregator.report_states)
+        self.on_state_change: Optional[Callable[[str], None]] = None
+        # Until when this resource is prepared (time.time()), 0 if it is not
+        self.warm_until: float = 0
+        # Set to False if the laboratory does not support being prepared
+        self.prepare_supported: bool = True
+        # Task preparing the resource (see start_prewarm)
+        self.prewarm_task: Optional[asyncio.Task] = None
 
     async def run(self):
-        pubsub = aioredis_store.pubsub()
-
-        channel_name = ResourceKeys(self.resource_name).channel()
+        subscription = channel_listener.subscribe(ResourceKeys(self.resource_name).channel())
 
         logger.info(f"Starting worker for resource {self.resource_name}")
+        self.set_state(ResourceWorkerStates.idle)
         try:
-            await pubsub.subscribe(channel_name)
-
             # Retrieve existing reservations (e.g., in a restart process)
             await self.process_unfinished_reservation()
 
             # Process any reservation in case there were reservations before we subscribed...
             await self.process_all_existing_reservations()
 
-            while True:
-                message = await pubsub.get_message(timeout=self.minimum_time_between_checks)
+            while not self.draining:
+                self.start_prewarm()
+                message = await subscription.get_message(timeout=self.minimum_time_between_checks)
                 logger.debug(f"got message for {self.resource_name}: {message}")
                 # The message does not matter. Whenever there is an event there was a change, and we have to check it.
                 await self.process_all_existing_reservations()
@@ -79,12 +116,35 @@ class ResourceWorker:
             logger.info(f"Stopping worker for resource {self.resource_name}")
         except Exception as err:
             logger.error(f"Error in worker of {self.resource_name}: {err}", exc_info=True)
+            self.error = str(err)
+            self.set_state(ResourceWorkerStates.failed)
         finally:
-            await pubsub.unsubscribe(channel_name)
+            await self.cancel_prewarm()
+            if self.state != ResourceWorkerStates.failed:
+                self.set_state(ResourceWorkerStates.stopped)
+            channel_listener.unsubscribe(subscription)
 
     def running(self):
         return self.task is not None and not self.task.done()
 
+    def set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            self.state_since = time.time()
+            if self.on_state_change is not None:
+                self.on_state_change(self.resource_name)
+
+    def get_state(self) -> Dict[str, Any]:
+        """
+        State of the worker, as reported by the WorkerAggregator (see lde worker status)
+        """
+        return {
+            'state': self.state,
+            'since': self.state_since,
+            'reservation': self.processor.reservation_id if self.processor is not None else None,
+            'error': self.error if self.state == ResourceWorkerStates.failed else None,
+        }
+
     async def start(self):
         if self.task is not None:
             self.task.cancel()
@@ -97,6 +157,54 @@ class ResourceWorker:
             await self.task
             self.task = None
 
+    async def drain(self, timeout: Optional[float] = None, handover: bool = False):
+        """
+        Stop taking reservations. If a reservation is being processed, wait until it
+        finishes instead of cancelling it (e.g., the resource was removed from the
+        configuration).
+
+        If handover is True (e.g., the worker is shutting down), only wait until the
+        reservation reaches a safe point, so another worker can continue it. If it
+        takes longer than timeout seconds, it is cancelled.
+        """
+        self.draining = True
+        if self.task is None:
+            return
+
+        self.set_state(ResourceWorkerStates.draining)
+
+        if not self.processing:
+            await self.stop()
+            return
+
+        if handover and self.processor is not None:
+            self.processor.request_handover()
+            logger.info(f"Draining worker for resource {self.resource_name}: waiting for the current reservation to reach a safe point")
+        else:
+            logger.info(f"Draining worker for resource {self.resource_name}: waiting for the current reservation to finish")
+
+        try:
+            done, _ = await asyncio.wait({ self.task }, timeout=timeout)
+        except asyncio.CancelledError:
+            self.task.cancel()
+            raise
+
+        if not done:
+            logger.warning(f"Worker for resource {self.resource_name} did not finish draining in {timeout} seconds. Cancelling it")
+            await self.stop()
+        self.task = None
+
+    def update_resource(self, resource: Resource):
+        """
+        The resource changed in the configuration (e.g., new URL or credentials). The
+        reservation being processed (if any) keeps the previous one, the next ones
+        will use the new one.
+        """
+        if resource.url != self.resource.url:
+            # It might be another laboratory server, which might support being prepared
+            self.prepare_supported = True
+        self.resource = resource
+
     async def process_unfinished_reservation(self):
         """
         Check if a reservation was being processed before (maybe we restarted or similar),
@@ -107,17 +215,149 @@ class ResourceWorker:
         reservation_id = await aioredis_store.get(ResourceKeys(self.resource_name).assigned())
         if reservation_id is None:
             return
+        await self._process(reservation_id)
+
+    def get_prewarm_laboratories(self) -> List[Laboratory]:
+        """
+        Laboratories of this resource with a warm pool (prewarm in laboratories.yml)
+        """
+        return [
+            laboratory
+            for laboratory in worker_config.current.laboratories.values()
+            if laboratory.prewarm > 0 and self.resource_name in laboratory.resources
+        ]
+
+    async def prewarm(self):
+        """
+        While idle, keep the resource prepared for the next session if any of its laboratories
+        has fewer than `prewarm` resources prepared. The pool of each laboratory is a sorted
+        set in Redis (shared by all the workers), where each prepared resource expires after
+        prewarm_ttl seconds unless it is prepared again.
+        """
+        if not self.prepare_supported or self.draining:
+            return
+
+        if passive_health.in_probation(self.resource_name):
+            # It is not confirmed in the pool, so it leaves it soon: other resources are prepared
+            return
+
+        laboratories = self.get_prewarm_laboratories()
+        if not laboratories:
+            return
+
+        now = time.time()
+        try:
+            if self.warm_until > now:
+                await self.join_warm_pool(laboratories)
+                if self.warm_until - now > self.prewarm_ttl / 3:
+                    # Prepared recently
+                    return
+            else:
+                # Not in the pool: only if any pool is not full
+                pool_sizes = []
+                for laboratory in laboratories:
+                    pool_sizes.append(await aioredis_store.zcount(LaboratoryKeys(laboratory.identifier).warm(), now, '+inf'))
+                if all(pool_size >= laboratory.prewarm for pool_size, laboratory in zip(pool_sizes, laboratories)):
+                    return
+
+            async with AbstractResourceClient.create(self.resource) as client:
+                if not await client.prepare():
+                    logger.info(f"Resource {self.resource_name} does not support being prepared (pre-warm mode)")
+                    self.prepare_supported = False
+                    return
+
+            self.warm_until = time.time() + self.prewarm_ttl
+            await self.join_warm_pool(laboratories)
+        except Exception as err:
+            # It will be tried again later; the reservations are not affected
+            logger.warning(f"Could not prepare resource {self.resource_name}: {err}")
+
+    async def join_warm_pool(self, laboratories: List[Laboratory]):
+        """
+        Add (or confirm) the resource in the warm pool of the laboratories, for warm_pool_liveness
+        seconds (up to warm_until)
+        """
+        now = time.time()
+        pipeline = aioredis_store.pipeline()
+        for laboratory in laboratories:
+            pipeline.zadd(LaboratoryKeys(laboratory.identifier).warm(), { self.resource_name: min(self.warm_until, now + self.warm_pool_liveness) })
+            pipeline.zremrangebyscore(LaboratoryKeys(laboratory.identifier).warm(), '-inf', now)
+        await pipeline.execute()
+
+    def start_prewarm(self):
+        """
+        Prepare the resource (see prewarm) in another task: a slow prepare must not delay
+        taking new reservations
+        """
+        if self.prewarm_task is None or self.prewarm_task.done():
+            self.prewarm_task = asyncio.create_task(self.prewarm())
+
+    async def cancel_prewarm(self):
+        if self.prewarm_task is not None and not self.prewarm_task.done():
+            self.prewarm_task.cancel()
+            try:
+                await self.prewarm_task
+            except asyncio.CancelledError:
+                pass
+        self.prewarm_task = None
+
+    async def should_defer_to_warm_resource(self) -> bool:
+        """
+        Whether this resource is not prepared but the next reservation of its queues can be
+        taken by another prepared resource (healthy and not on probation)
+        """
+        if self.warm_until > time.time() or not self.get_prewarm_laboratories():
+            return False
+
+        return await async_lua_scripts.has_warm_candidate(self.resource_name) is not None
+
+    async def leave_warm_pool(self):
+        """
+        The resource is taking a reservation: other idle resources can be prepared instead
+        """
+        # If it was being prepared, it will not be in the pool
+        await self.cancel_prewarm()
+        if self.warm_until == 0:
+            return
+
+        self.warm_until = 0
+        pipeline = aioredis_store.pipeline()
+        for laboratory in self.get_prewarm_laboratories():
+            pipeline.zrem(LaboratoryKeys(laboratory.identifier).warm(), self.resource_name)
+        await pipeline.execute()
+
+    async def _process(self, reservation_id: str):
+        await self.leave_warm_pool()
         processor = ResourceReservationProcessor(self.resource, reservation_id)
-            
+
         # Now wait until the process is over
-        await processor.process()
+        self.processing = True
+        self.processor = processor
+        self.set_state(ResourceWorkerStates.processing)
+        try:
+            await processor.process()
+        finally:
+            self.processing = False
+            self.processor = None
+            if not self.draining:
+                self.set_state(ResourceWorkerStates.idle)
 
     async def process_all_existing_reservations(self):
         """
         Process all existing reservations. We might have missed some reservations and we
         want to make sure we process them all.        
         """
-        while True:
+        if await self.should_defer_to_warm_resource():
+            # The prepared resource was notified too: let it take the reservation first. If it
+            # does not (e.g., its worker stopped), this one takes it afterwards
+            await asyncio.sleep(self.cold_assignment_delay)
+
+        while not self.draining:
+            if passive_health.in_probation(self.resource_name):
+                # The reservations stay in the queues for other resources (or until the probation is over)
+                logger.debug(f"Resource {self.resource_name} on probation: not taking reservations")
+                break
+
             reservation_id = await async_lua_scripts.assign_reservation_to_resource(self.resource_name)
             logging.info(f"{self.resource_name} - {reservation_id}")
             if reservation_id is None:
@@ -125,7 +365,4 @@ class ResourceWorker:
             
             logger.info(f"Reservation {reservation_id} assigned to resource {self.resource_name}")
 
-            processor = ResourceReservationProcessor(self.resource, reservation_id)
-            
-            # Now wait until the process is over
-            await processor.process()
+            await self._process(reservation_id)
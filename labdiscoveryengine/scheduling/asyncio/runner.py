@@ -1,29 +1,96 @@
+import json
 import signal
 import asyncio
 import logging
 
-from typing import Dict
+from typing import AbstractSet, Dict, FrozenSet, Optional, Set
 
 logger = logging.getLogger(__name__)
 
 from labdiscoveryengine.scheduling.asyncio.resource_worker import ResourceWorker, initialize_worker
-from labdiscoveryengine.scheduling.asyncio.healthcheck_worker import ResourceHealthchecksWorker
-from labdiscoveryengine.scheduling.asyncio.redis import is_redis_flushed
+from labdiscoveryengine.scheduling.asyncio.healthcheck_worker import ResourceHealthchecksWorker, healthcheck_http_pool, healthcheck_probes
+from labdiscoveryengine.scheduling.asyncio.redis import aioredis_store, async_lua_scripts, is_redis_flushed, mark_redis_running
+from labdiscoveryengine.scheduling.asyncio.recovery import acquire_recovery_lock, recover_from_mongodb, release_recovery_lock, wait_for_recovery
+from labdiscoveryengine.scheduling.asyncio.governor import Backends, governor
+from labdiscoveryengine.scheduling.asyncio.channels import channel_listener
+from labdiscoveryengine.scheduling.keys import WorkerKeys
 
-from labdiscoveryengine.utils import lde_config
+from labdiscoveryengine.configuration.exc import ConfigurationError
+from labdiscoveryengine.configuration.storage import StoredConfiguration, get_latest_configuration
+from labdiscoveryengine.history.retention import apply_retention_policy
+from labdiscoveryengine.scheduling.asyncio.config import worker_config
+from labdiscoveryengine.scheduling.asyncio.leases import ResourceLeases, generate_owner_identifier
+from labdiscoveryengine.scheduling.sharding import HashRing, describe_shard
 import time
 
+# Only one worker (in any host) archives sessions at a time (see check_retention_policy)
+RETENTION_LOCK_KEY = "lde:retention"
+
 class WorkerAggregator:
-    def __init__(self):
+    """
+    Supervise the workers of the resources. The main loop wakes up every second (or
+    as soon as a worker stops), but it only goes through all the resources when the
+    configuration changed or there are leases to acquire: the rest is driven by events
+    (e.g., a worker that stops is restarted from its done callback) and by timers.
+    """
+    # How often (in seconds) the changes in the state of the workers are reported in Redis,
+    # and how often all of them are reported again (so stale reports can be detected)
+    state_report_interval = 5
+    state_refresh_interval = 60
+    # How often (in seconds) to check if Redis was flushed, and how long to wait for the recovery
+    flush_check_interval = 10
+    recovery_timeout = 300
+    # Delay before restarting a worker that stopped, doubled every time it stops again
+    # before running stable_time seconds
+    min_restart_delay = 1
+    max_restart_delay = 60
+    stable_time = 60
+    # Longer than any run of the retention policy (a limited number of batches, see check_retention_policy)
+    retention_lock_timeout = 3600
+
+    def __init__(self, shard: Optional[int] = None, shards: int = 1, leases: Optional[ResourceLeases] = None):
+        """
+        If shard is provided, only the resources assigned to that shard (out of shards)
+        are handled by this aggregator (see scheduling/sharding.py). If leases is provided,
+        only the resources whose lease is acquired are handled (see leases.py).
+        """
+        self.leases = leases
+        self.owner: str = leases.owner if leases is not None else generate_owner_identifier()
+        self.last_state_report = 0
+        self.last_state_refresh = 0
+        self.changed_states: Set[str] = set()
+        self.last_flush_check = 0
+        # Configuration snapshot the workers were last updated for
+        self._workers_configuration: Optional[StoredConfiguration] = None
+        # Resources of this aggregator whose lease is held by another worker
+        self.resources_without_lease: Set[str] = set()
+        self.restart_at: Dict[str, float] = {
+            # resource: when to restart its worker
+        }
+        self.restart_delays: Dict[str, float] = {}
+        self.started_at: Dict[str, float] = {}
+        self.wakeup = asyncio.Event()
+        self.shard = shard
+        self.ring = HashRing(shards) if shard is not None else None
+        self._owned_resources: FrozenSet[str] = frozenset()
+        self._owned_resources_configuration: Optional[StoredConfiguration] = None
         self.resource_workers: Dict[str, ResourceWorker] = {
             # resource: task
         }
         self.healthcheck_workers: Dict[str, ResourceHealthchecksWorker] = {
             # resource: task
         }
+        self.draining_workers: Dict[str, asyncio.Task] = {
+            # resource: task waiting for the current reservation to finish
+        }
         self.stopping = False
+        # Graceful shutdown requested: hand the resources over instead of cancelling everything
+        self.handing_over = False
         self.stopped = True
         self.task = None
+        self.retention_task = None
+        self.last_retention = 0
+        self.last_configuration_check = time.time()
 
     async def run(self):
         """
@@ -32,70 +99,458 @@ class WorkerAggregator:
         self.stopped = False
         try:
             while not self.stopping:
-                for resource in lde_config.resources:
-                    if resource not in self.resource_workers:
-                        self.resource_workers[resource] = ResourceWorker(resource)
-                        await self.resource_workers[resource].start()
-                        self.healthcheck_workers[resource] = ResourceHealthchecksWorker(resource)
-                        await self.healthcheck_workers[resource].start()
-                    
-                    elif not self.resource_workers[resource].running() and not self.stopping:
-                        logger.info(f"Resource {resource} was stopped. Restarting it...")
-                        await self.resource_workers[resource].start()
-
-                for resource in list(self.resource_workers):
-                    if resource not in lde_config.resources:
-                        await self.resource_workers[resource].stop()
-                        await self.healthcheck_workers[resource].stop()
-                        del self.resource_workers[resource]
-                        del self.healthcheck_workers[resource]
-
-                flushed = await is_redis_flushed()
-                if flushed:
-                    logger.error("Redis has been flushed. It might have been restarted, but the database now is inconsistent. Stopping worker")
-                    self.stop()
-                    break
-
-                await asyncio.sleep(1)
+                if await self.check_redis_flushed():
+                    if not await self.recover_redis():
+                        logger.error("Redis has been flushed. It might have been restarted, but the database now is inconsistent. Stopping worker")
+                        self.stop()
+                        break
+
+                await self.check_configuration()
+
+                lease_renewal = await self.renew_leases()
+
+                if self._workers_configuration is not worker_config.current or (lease_renewal and self.resources_without_lease):
+                    await self.update_workers()
+
+                await self.restart_stopped_workers()
+
+                self.check_retention_policy()
+
+                await self.report_states()
+
+                # Sleep until the next second or until a worker stops
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
 
         except asyncio.CancelledError:
             pass
 
         finally:
+            if self.handing_over:
+                try:
+                    await self.hand_over_workers()
+                except asyncio.CancelledError:
+                    logger.warning("Handover interrupted")
+
             logger.info("Stopping every worker...")
 
             for resource in list(self.resource_workers):
                 await self.resource_workers[resource].stop()
             for resource in list(self.healthcheck_workers):
                 await self.healthcheck_workers[resource].stop()
+            for draining_task in list(self.draining_workers.values()):
+                draining_task.cancel()
+            await healthcheck_probes.close()
+            await healthcheck_http_pool.close()
+
+            if self.leases is not None:
+                try:
+                    await self.leases.release(list(self.leases.held))
+                except Exception as err:
+                    logger.warning(f"Could not release the leases (they will expire): {err}")
 
             self.stopped = True
 
+    async def update_workers(self):
+        """
+        Start the workers of new resources, restart the ones that stopped and drain
+        the ones of resources that are not in the configuration anymore
+        """
+        if self.stopping:
+            return
+
+        self._workers_configuration = worker_config.current
+        resources = self.get_owned_resources()
+
+        if self.leases is not None and not self.stopping:
+            new_resources = [ resource for resource in resources
+                              if resource not in self.resource_workers and resource not in self.draining_workers ]
+            acquired = await self.leases.acquire(new_resources) if new_resources else set()
+            self.resources_without_lease = set(new_resources) - acquired
+        else:
+            acquired = None
+
+        for resource in resources:
+            if resource in self.draining_workers:
+                # It was removed and added again: wait until the previous worker is over
+                continue
+
+            if resource not in self.resource_workers:
+                if acquired is not None and resource not in acquired:
+                    # Another worker holds the lease
+                    continue
+
+                resource_worker = ResourceWorker(resource)
+                resource_worker.on_state_change = self.changed_states.add
+                self.resource_workers[resource] = resource_worker
+                await self.start_worker(resource, resource_worker)
+                self.healthcheck_workers[resource] = ResourceHealthchecksWorker(resource)
+                await self.healthcheck_workers[resource].start()
+
+        for resource in list(self.resource_workers):
+            if resource not in resources:
+                if resource in worker_config.current.resources:
+                    logger.info(f"Resource {resource} moved to another shard. Draining it...")
+                else:
+                    logger.info(f"Resource {resource} removed from the configuration. Draining it...")
+                await self.healthcheck_workers.pop(resource).stop()
+                self.drain_worker(resource, self.resource_workers.pop(resource))
+
+    def get_owned_resources(self) -> AbstractSet[str]:
+        """
+        Names of the resources handled by this aggregator. Recalculated only
+        when the configuration snapshot changes.
+        """
+        configuration = worker_config.current
+        if self.ring is None:
+            return configuration.resources.keys()
+
+        if configuration is not self._owned_resources_configuration:
+            self._owned_resources = frozenset(self.ring.filter(configuration.resources, self.shard))
+            self._owned_resources_configuration = configuration
+            logger.info(f"{describe_shard(self.shard, self.ring.shards)}: handling {len(self._owned_resources)} of {len(configuration.resources)} resources")
+        return self._owned_resources
+
+    async def check_configuration(self):
+        """
+        Every CONFIGURATION_RELOAD_INTERVAL seconds, reload the configuration files
+        that changed (if any) and update the workers of the resources that changed.
+        Added and removed resources are handled in the main loop.
+        """
+        interval = worker_config.app_config.get('CONFIGURATION_RELOAD_INTERVAL')
+        if not interval or time.time() - self.last_configuration_check < interval:
+            return
+
+        self.last_configuration_check = time.time()
+
+        try:
+            configuration = get_latest_configuration(worker_config.current)
+        except ConfigurationError as err:
+            logger.error(f"Error reloading the configuration (keeping the previous one): {err}")
+            return
+
+        if configuration is worker_config.current:
+            return
+
+        worker_config.update(configuration)
+
+        for resource_name, resource_worker in self.resource_workers.items():
+            resource = configuration.resources.get(resource_name)
+            if resource is None or resource == resource_worker.resource:
+                continue
+
+            logger.info(f"Resource {resource_name} changed in the configuration. Updating its workers...")
+            resource_worker.update_resource(resource)
+
+            healthcheck_worker = self.healthcheck_workers[resource_name]
+            healthchecks_changed = resource.healthchecks != healthcheck_worker.resource.healthchecks
+            healthcheck_worker.update_resource(resource)
+            if healthchecks_changed:
+                await healthcheck_worker.start()
+
+    async def start_worker(self, resource: str, resource_worker: ResourceWorker):
+        """
+        Start (or restart) a worker, watching when it stops
+        """
+        await resource_worker.start()
+        self.started_at[resource] = time.monotonic()
+        resource_worker.task.add_done_callback(lambda task: self.worker_stopped(resource, resource_worker))
+
+    def worker_stopped(self, resource: str, resource_worker: ResourceWorker):
+        """
+        Done callback of the workers: if the worker was not stopped on purpose (e.g., an
+        error), schedule its restart, waiting longer if it keeps stopping
+        """
+        if self.stopping or resource_worker.draining or self.resource_workers.get(resource) is not resource_worker:
+            return
+
+        now = time.monotonic()
+        if now - self.started_at.get(resource, now) >= self.stable_time:
+            delay = self.min_restart_delay
+        else:
+            delay = min(self.restart_delays.get(resource, self.min_restart_delay / 2) * 2, self.max_restart_delay)
+        self.restart_delays[resource] = delay
+        self.restart_at[resource] = now + delay
+        logger.info(f"Resource {resource} was stopped. Restarting it in {delay} seconds...")
+        self.wakeup.set()
+
+    async def restart_stopped_workers(self):
+        if not self.restart_at:
+            return
+
+        now = time.monotonic()
+        for resource, restart_at in list(self.restart_at.items()):
+            if restart_at > now:
+                continue
+
+            del self.restart_at[resource]
+            resource_worker = self.resource_workers.get(resource)
+            if resource_worker is None or resource_worker.running() or self.stopping:
+                continue
+
+            logger.info(f"Restarting worker of resource {resource}...")
+            await self.start_worker(resource, resource_worker)
+
+    async def check_redis_flushed(self) -> bool:
+        """
+        Every flush_check_interval seconds, check if Redis was flushed
+        """
+        now = time.monotonic()
+        if now - self.last_flush_check < self.flush_check_interval:
+            return False
+        self.last_flush_check = now
+        return await is_redis_flushed()
+
+    async def recover_redis(self) -> bool:
+        """
+        Redis was flushed: stop every worker, rebuild the reservations from MongoDB (only
+        one worker does it, the rest wait for it) and let update_workers start everything
+        again. Returns False if the recovery is not possible (e.g., REDIS_RECOVERY is
+        disabled or MongoDB is not used).
+        """
+        app_config = worker_config.app_config
+        if not app_config.get('REDIS_RECOVERY') or not app_config.get('USING_MONGO'):
+            return False
+
+        logger.warning("Redis has been flushed. Stopping every worker to recover the reservations from MongoDB...")
+        for resource in list(self.resource_workers):
+            await self.resource_workers.pop(resource).stop()
+        for resource in list(self.healthcheck_workers):
+            await self.healthcheck_workers.pop(resource).stop()
+        for draining_task in list(self.draining_workers.values()):
+            draining_task.cancel()
+        self.restart_at.clear()
+        if self.leases is not None:
+            # They were in Redis
+            self.leases.held.clear()
+
+        if await acquire_recovery_lock(self.owner, self.recovery_timeout):
+            try:
+                result = await recover_from_mongodb()
+                logger.warning(f"Redis recovered: {result.queued} reservations queued again, {result.running} running sessions "
+                               f"restored, {result.finishing} finished sessions to dispose, {result.skipped} skipped")
+                await mark_redis_running()
+            finally:
+                await release_recovery_lock(self.owner)
+        else:
+            logger.warning("Another worker is recovering Redis. Waiting for it...")
+            if not await wait_for_recovery(self.recovery_timeout):
+                logger.error("Redis was not recovered in time")
+                return False
+
+        # Start every worker again
+        self._workers_configuration = None
+        return True
+
+    async def report_states(self):
+        """
+        Every state_report_interval seconds, store the states of the workers that changed
+        in Redis (one field per resource, see lde worker status), and all of them every
+        state_refresh_interval seconds
+        """
+        now = time.time()
+        if now - self.last_state_report < self.state_report_interval:
+            return
+        self.last_state_report = now
+
+        if now - self.last_state_refresh >= self.state_refresh_interval:
+            self.last_state_refresh = now
+            resources = list(self.resource_workers)
+        else:
+            resources = [ resource for resource in self.changed_states if resource in self.resource_workers ]
+        self.changed_states.clear()
+
+        states = {}
+        for resource in resources:
+            resource_worker = self.resource_workers[resource]
+            healthcheck_worker = self.healthcheck_workers.get(resource)
+            state = resource_worker.get_state()
+            state.update({
+                'healthchecks': healthcheck_worker is not None and healthcheck_worker.running(),
+                'owner': self.owner,
+                'updated_at': now,
+            })
+            states[resource] = json.dumps(state)
+
+        if states:
+            async with governor.limit(Backends.redis):
+                await aioredis_store.hset(WorkerKeys.resources(), mapping=states)
+
+    async def renew_leases(self) -> bool:
+        """
+        Renew the leases of the resources (every third of WORKER_LEASE_TTL). If a lease
+        was lost (e.g., this worker could not renew it on time and another worker took
+        it), the workers of that resource are stopped immediately. Returns whether the
+        leases were renewed.
+        """
+        if self.leases is None or not self.leases.renewal_needed():
+            return False
+
+        lost = await self.leases.renew()
+        for resource in lost:
+            if resource in self.resource_workers:
+                logger.warning(f"Lease of resource {resource} lost. Stopping its workers...")
+                await self.resource_workers.pop(resource).stop()
+                await self.healthcheck_workers.pop(resource).stop()
+            draining_task = self.draining_workers.get(resource)
+            if draining_task is not None:
+                draining_task.cancel()
+
+        # They might be acquired again (e.g., from the worker that took them)
+        self.resources_without_lease.update(lost)
+        return True
+
+    async def _drain_and_release(self, resource: str, resource_worker: ResourceWorker, timeout: Optional[float] = None, handover: bool = False):
+        await resource_worker.drain(timeout=timeout, handover=handover)
+        if self.leases is not None:
+            await self.leases.release([resource])
+
+    async def hand_over_workers(self):
+        """
+        Graceful shutdown: stop taking reservations, let the reservations being processed
+        reach a safe point (up to WORKER_DRAIN_TIMEOUT seconds) and release the lease of each
+        resource as soon as it is free, so other workers take it over (and continue its
+        reservation) without waiting for the rest.
+        """
+        timeout = worker_config.app_config.get('WORKER_DRAIN_TIMEOUT')
+        logger.info(f"Handing over {len(self.resource_workers)} resources (waiting up to {timeout} seconds)...")
+
+        for resource in list(self.healthcheck_workers):
+            await self.healthcheck_workers.pop(resource).stop()
+
+        # The leases of the resources still being processed must not expire meanwhile
+        renewal_task = asyncio.create_task(self.leases.keep_renewing()) if self.leases is not None else None
+        try:
+            handovers = [
+                self._drain_and_release(resource, self.resource_workers.pop(resource), timeout=timeout, handover=True)
+                for resource in list(self.resource_workers)
+            ]
+            results = await asyncio.gather(*handovers, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"Error handing over a resource: {result}", exc_info=result)
+
+            # Resources removed from the configuration (still finishing their reservation)
+            if self.draining_workers:
+                await asyncio.wait(list(self.draining_workers.values()), timeout=timeout)
+        finally:
+            if renewal_task is not None:
+                renewal_task.cancel()
+
+    def drain_worker(self, resource: str, resource_worker: ResourceWorker):
+        """
+        Stop a worker without interrupting the reservation it is processing (if any),
+        and without blocking the main loop. Its lease (if any) is released afterwards.
+        """
+        draining_task = asyncio.create_task(self._drain_and_release(resource, resource_worker))
+        self.draining_workers[resource] = draining_task
+        draining_task.add_done_callback(lambda task: self.draining_workers.pop(resource, None))
+
+    def check_retention_policy(self):
+        """
+        Every SESSIONS_ARCHIVE_INTERVAL seconds, archive the old sessions (if
+        SESSIONS_RETENTION_DAYS is configured). pymongo is blocking, so it runs
+        in a thread, a limited number of batches at a time.
+        """
+        if self.shard not in (None, 0):
+            # With several processes, only the first one tries (and other hosts are
+            # excluded by the lock, see run_retention_policy)
+            return
+
+        app_config = worker_config.app_config
+        if app_config.get('SESSIONS_RETENTION_DAYS') is None or not app_config.get('USING_MONGO'):
+            return
+
+        if self.retention_task is not None and not self.retention_task.done():
+            return
+
+        if time.time() - self.last_retention < app_config['SESSIONS_ARCHIVE_INTERVAL']:
+            return
+
+        self.last_retention = time.time()
+
+        self.retention_task = asyncio.create_task(self.run_retention_policy(dict(app_config)))
+        self.retention_task.add_done_callback(_log_retention_result)
+
+    async def run_retention_policy(self, app_config: dict) -> int:
+        """
+        Apply the retention policy if no other worker (in this or other hosts) is applying it:
+        two of them would archive the same batches. Returns the number of sessions archived.
+        """
+        async with governor.limit(Backends.redis):
+            acquired = await aioredis_store.set(RETENTION_LOCK_KEY, self.owner, nx=True, px=int(self.retention_lock_timeout * 1000))
+        if not acquired:
+            logger.debug("Another worker is applying the sessions retention policy")
+            return 0
+
+        from labdiscoveryengine import mongo
+
+        try:
+            return await asyncio.get_event_loop().run_in_executor(None, apply_retention_policy, app_config, mongo.db, 100)
+        finally:
+            await async_lua_scripts.release_lock(RETENTION_LOCK_KEY, self.owner)
+
     def start(self):
         self.task = asyncio.create_task(self.run())
         return self.task
 
     def stop(self):
         self.stopping = True
-        self.task.cancel()
+        if self.task is not None:
+            self.task.cancel()
+
+    def request_handover(self):
+        """
+        Finish the main loop and hand the resources over (see hand_over_workers)
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        self.handing_over = True
+        self.wakeup.set()
+
+def _log_retention_result(future: asyncio.Future):
+    if future.cancelled():
+        return
+
+    error = future.exception()
+    if error is not None:
+        logger.error(f"Error applying the sessions retention policy: {error}", exc_info=error)
+    elif future.result():
+        logger.info(f"{future.result()} sessions archived")
 
 aggregator = WorkerAggregator()
 
-async def main():
+async def main(shard: Optional[int] = None, shards: int = 1):
     """
+    Run the worker. If shard is provided, this process only handles the
+    resources of that shard (see scheduling/supervisor.py).
     """
     asyncio.get_event_loop().add_signal_handler(signal.SIGINT, lambda : signal_handler(signal.SIGINT))
     asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, lambda : signal_handler(signal.SIGTERM))
 
-    logger.info("WorkerAggregator running forever...")
+    logger.info(f"WorkerAggregator running forever ({describe_shard(shard, shards)})...")
 
     await initialize_worker()
 
+    lease_ttl = worker_config.app_config.get('WORKER_LEASE_TTL')
+    leases = ResourceLeases(lease_ttl) if lease_ttl else None
+
     global aggregator
+    aggregator = WorkerAggregator(shard=shard, shards=shards, leases=leases)
     await aggregator.start()
+    await channel_listener.close()
 
     logger.info(f"WorkerAggregator stopped...")
 
-def signal_handler(signal):
-    logger.info(f"Received signal {signal}, requesting stop")
-    aggregator.stop()
+def signal_handler(signum):
+    if signum == signal.SIGTERM:
+        # e.g., supervisor or a rolling deploy: do not interrupt the running sessions
+        logger.info(f"Received signal {signum}, handing the resources over")
+        aggregator.request_handover()
+    else:
+        logger.info(f"Received signal {signum}, requesting stop")
+        aggregator.stop()
@@ -1,5 +1,6 @@
 import abc
-from typing import Any, Dict, NamedTuple, Optional, List
+import datetime
+from typing import Any, Dict, NamedTuple, Optional, List, Tuple
 
 from labdiscoveryengine.scheduling.keys import ReservationKeys
 
@@ -91,6 +92,12 @@ class ReservationStatus(NamedTuple):
     position: Optional[int] = None
     url: Optional[str] = None
     message: Optional[str] = None
+    # Seconds, only while queued (see get_reservation_status.lua)
+    estimated_wait: Optional[int] = None
+    # Suggested by the server to the clients polling the status: wait retry_after
+    # seconds, and then ask again with max_time=suggested_max_time (see suggest_polling)
+    retry_after: Optional[int] = None
+    suggested_max_time: Optional[int] = None
 
     def has_changed_from(self, previous_status: 'ReservationStatus') -> bool:
         # We only care of this two really
@@ -104,6 +111,8 @@ class ReservationStatus(NamedTuple):
 
         if self.status in (ReservationKeys.states.queued,):
             result['position'] = self.position
+            if self.estimated_wait is not None:
+                result['estimated_wait'] = self.estimated_wait
 
         if self.status in (ReservationKeys.states.ready, ReservationKeys.states.cancelling, ReservationKeys.states.finishing):
             result['url'] = self.url
@@ -112,6 +121,10 @@ class ReservationStatus(NamedTuple):
         if self.message:
             result['message'] = self.message
 
+        if self.retry_after is not None:
+            result['retry_after'] = self.retry_after
+            result['suggested_max_time'] = self.suggested_max_time
+
         return result
     
     @staticmethod
@@ -123,14 +136,44 @@ class ReservationStatus(NamedTuple):
             position=data.get('position'),
             url=data.get('url'),
             message=data.get('message'),
+            estimated_wait=data.get('estimated_wait'),
+            retry_after=data.get('retry_after'),
+            suggested_max_time=data.get('suggested_max_time'),
         )
 
+class AdmissionScopes:
+    """
+    Rate limits applied to new reservations (see admit_reservation.lua)
+    """
+    external = 'external' # External system (e.g., a federated LabsLand)
+    user = 'user' # Student, either local or from an external system
+    laboratory = 'laboratory'
+
+    # Not a rate limit: the queues are full
+    queue_full = 'queue-full'
+
+class AdmissionDecision(NamedTuple):
+    admitted: bool
+    # One of AdmissionScopes, if not admitted
+    reason: Optional[str] = None
+    # Seconds until it makes sense to try again
+    retry_after: Optional[int] = None
+
+    @property
+    def message(self) -> str:
+        if self.admitted:
+            return 'Admitted'
+        if self.reason == AdmissionScopes.queue_full:
+            return 'Too many reservations waiting, try again later'
+        return f'Too many reservations ({self.reason} limit), try again later'
+
 class ResourceHealth(NamedTuple):
     resource: str
     status: str
     message: Optional[str] = None
     source: Optional[str] = None
     checked_at: Optional[str] = None
+    latency: Optional[float] = None # seconds
 
     class states:
         healthy = 'healthy'
@@ -148,6 +191,7 @@ class ResourceHealth(NamedTuple):
             'message': self.message,
             'source': self.source,
             'checked_at': self.checked_at,
+            'latency': self.latency,
         }
 
     @staticmethod
@@ -161,4 +205,41 @@ class ResourceHealth(NamedTuple):
             message=data.get('message') or None,
             source=data.get('source') or None,
             checked_at=data.get('checked_at') or None,
+            latency=float(data['latency']) if data.get('latency') else None,
         )
+
+class ResourceUptime(NamedTuple):
+    resource: str
+    # Percentage of the time healthy (unknown periods are not counted), None if there is no data
+    uptime: Optional[float]
+    # Oldest result considered (the history is capped, so it might be more recent than requested)
+    since: Optional[datetime.datetime] = None
+    # Number of times the status changed
+    changes: int = 0
+
+    @staticmethod
+    def fromhistory(resource: str, entries: List[Tuple[str, Dict[str, str]]], now: datetime.datetime) -> 'ResourceUptime':
+        """
+        Entries as returned by XRANGE on ResourceKeys.health_history(), oldest first.
+        Each status lasts until the next result (or now, for the last one).
+        """
+        results = []
+        for entry_id, fields in entries:
+            timestamp = datetime.datetime.utcfromtimestamp(int(entry_id.split('-')[0]) / 1000)
+            results.append((timestamp, fields.get('status') or ResourceHealth.states.unknown))
+
+        if not results:
+            return ResourceUptime(resource=resource, uptime=None)
+
+        durations = { ResourceHealth.states.healthy: 0.0, ResourceHealth.states.broken: 0.0 }
+        changes = 0
+        for position, (timestamp, status) in enumerate(results):
+            until = results[position + 1][0] if position + 1 < len(results) else now
+            if status in durations:
+                durations[status] += max((until - timestamp).total_seconds(), 0)
+            if position > 0 and status != results[position - 1][1]:
+                changes += 1
+
+        known = durations[ResourceHealth.states.healthy] + durations[ResourceHealth.states.broken]
+        uptime = 100.0 * durations[ResourceHealth.states.healthy] / known if known > 0 else None
+        return ResourceUptime(resource=resource, uptime=uptime, since=results[0][0], changes=changes)
@@ -21,6 +21,8 @@ class ReservationKeys:
         url = 'url'
         session_id = 'session_id'
         message = 'message'
+        # time.time() when the session started in the laboratory
+        started_at = 'started_at'
 
     class states:
         pending = 'pending'
@@ -56,10 +58,76 @@ class ResourceKeys:
 
     def health(self) -> str:
         return f"{self.base()}:health"
+
+    def health_history(self) -> str:
+        """
+        Capped stream with the result of each healthcheck (status and latency)
+        """
+        return f"{self.base()}:health:history"
+
+    def passive_health(self) -> str:
+        """
+        JSON with the failures of the last reservations (see scheduling/asyncio/passive_health.py)
+        """
+        return f"{self.base()}:health:passive"
+
+    def lease(self) -> str:
+        return f"{self.base()}:lease"
     
     def base(self) -> str:
         return f"{Keys.base()}:resources:{self.resource_id}"
     
+class WorkerKeys:
+    @staticmethod
+    def resources() -> str:
+        """
+        Hash with the state of the worker of each resource (JSON), as reported by the workers
+        """
+        return f"{Keys.base()}:worker:resources"
+
+class WebKeys:
+    @staticmethod
+    def pollers() -> str:
+        """
+        Status requests currently waiting for a change: sorted set with one member per request,
+        scored by the time it stops waiting (see get_reservation_status)
+        """
+        return f"{Keys.base()}:web:pollers"
+
+class AdmissionKeys:
+    @staticmethod
+    def bucket(scope: str, identifier: str) -> str:
+        """
+        Token bucket (hash with tokens and updated) of the admission rate limits (see admit_reservation.lua)
+        """
+        return f"{Keys.base()}:admission:buckets:{scope}:{identifier}"
+
+    @staticmethod
+    def stats() -> str:
+        """
+        Hash with the number of reservations admitted, shed and rejected by each rate limit
+        """
+        return f"{Keys.base()}:admission:stats"
+
+class LaboratoryKeys:
+    def __init__(self, laboratory_id: str):
+        self.laboratory_id = laboratory_id
+
+    def warm(self) -> str:
+        """
+        Sorted set with the resources prepared for the next session (score: until when)
+        """
+        return f"{self.base()}:warm"
+
+    def stats(self) -> str:
+        """
+        Hash with the number of sessions and the average duration (see record_session_duration.lua)
+        """
+        return f"{self.base()}:stats"
+
+    def base(self) -> str:
+        return f"{Keys.base()}:laboratories:{self.laboratory_id}"
+
 class UserKeys:
     def __init__(self, user_identifier: str):
         self.user_identifier = user_identifier
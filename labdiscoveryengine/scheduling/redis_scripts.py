@@ -7,6 +7,13 @@ class ScriptNames:
     assign_reservation_to_resource = 'assign_reservation_to_resource'
     store_reservation = 'store_reservation'
     get_reservation_status = 'get_reservation_status'
+    acquire_resource_leases = 'acquire_resource_leases'
+    release_resource_leases = 'release_resource_leases'
+    requeue_reservation = 'requeue_reservation'
+    record_session_duration = 'record_session_duration'
+    admit_reservation = 'admit_reservation'
+    has_warm_candidate = 'has_warm_candidate'
+    release_lock = 'release_lock'
 
 _lde_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -14,5 +21,12 @@ _lde_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 SCRIPT_FILES: Dict[str, str] = {
     ScriptNames.assign_reservation_to_resource: os.path.join(_lde_directory, 'lua/assign_reservation_to_resource.lua'),
     ScriptNames.store_reservation: os.path.join(_lde_directory, 'lua/store_reservation.lua'),
-    ScriptNames.get_reservation_status: os.path.join(_lde_directory, 'lua/get_reservation_status.lua')
+    ScriptNames.get_reservation_status: os.path.join(_lde_directory, 'lua/get_reservation_status.lua'),
+    ScriptNames.acquire_resource_leases: os.path.join(_lde_directory, 'lua/acquire_resource_leases.lua'),
+    ScriptNames.release_resource_leases: os.path.join(_lde_directory, 'lua/release_resource_leases.lua'),
+    ScriptNames.requeue_reservation: os.path.join(_lde_directory, 'lua/requeue_reservation.lua'),
+    ScriptNames.record_session_duration: os.path.join(_lde_directory, 'lua/record_session_duration.lua'),
+    ScriptNames.admit_reservation: os.path.join(_lde_directory, 'lua/admit_reservation.lua'),
+    ScriptNames.has_warm_candidate: os.path.join(_lde_directory, 'lua/has_warm_candidate.lua'),
+    ScriptNames.release_lock: os.path.join(_lde_directory, 'lua/release_lock.lua'),
 }
\ No newline at end of file
@@ -0,0 +1,51 @@
+"""
+Distribution of the resources among several worker processes (shards).
+
+Each worker process only runs the ResourceWorker and ResourceHealthchecksWorker
+of the resources assigned to its shard. Resources are assigned with consistent
+hashing on their identifier, so every process computes the same assignment on
+its own (no coordination is needed), new resources are assigned as soon as each
+process reloads the configuration, and changing the number of processes only
+moves a small part of the resources.
+"""
+import bisect
+import hashlib
+from typing import Iterable, List, Optional, Set
+
+def _hash(key: str) -> int:
+    # hash() is randomized per process, so it cannot be used here
+    return int.from_bytes(hashlib.md5(key.encode('utf8')).digest()[:8], 'big')
+
+class HashRing:
+    """
+    Consistent hashing ring of shards numbered 0 to shards - 1
+    """
+    def __init__(self, shards: int, replicas: int = 64):
+        if shards < 1:
+            raise ValueError(f"Invalid number of shards: {shards}")
+
+        self.shards = shards
+        points = sorted(
+            (_hash(f"shard-{shard}-{replica}"), shard)
+            for shard in range(shards)
+            for replica in range(replicas)
+        )
+        self._hashes: List[int] = [ point_hash for point_hash, _ in points ]
+        self._shards: List[int] = [ shard for _, shard in points ]
+
+    def get_shard(self, key: str) -> int:
+        if self.shards == 1:
+            return 0
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+    def filter(self, keys: Iterable[str], shard: int) -> Set[str]:
+        """
+        Return the keys assigned to shard
+        """
+        return { key for key in keys if self.get_shard(key) == shard }
+
+def describe_shard(shard: Optional[int], shards: int) -> str:
+    if shard is None:
+        return "single process"
+    return f"shard {shard + 1}/{shards}"
@@ -0,0 +1,125 @@
+"""
+Supervisor of the worker processes (lde worker run --processes N).
+
+Each process (shard) runs its own asyncio loop with the resources assigned to it
+(see scheduling/sharding.py). The supervisor only starts the processes, restarts
+the ones that stop (waiting longer each time if they keep crashing) and stops all
+of them when it receives SIGINT or SIGTERM. New resources do not require any
+action from the supervisor: each process reloads the configuration and starts the
+workers of the new resources assigned to it.
+"""
+import os
+import time
+import signal
+import asyncio
+import logging
+import multiprocessing
+
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+def run_shard(shard: int, shards: int, flask_config: str):
+    """
+    Entry point of each worker process
+    """
+    os.environ['LDE_RUNNING_MODE'] = 'worker'
+    logging.basicConfig(level=logging.INFO, format=f'[%(asctime)s][%(levelname)s][shard {shard + 1}/{shards}] %(message)s')
+
+    # Imported here: with the spawn method the process starts from scratch
+    from labdiscoveryengine import create_app
+    from labdiscoveryengine.scheduling.asyncio.runner import main as runner_main
+
+    app = create_app(flask_config)
+    with app.app_context():
+        asyncio.run(runner_main(shard, shards))
+
+class ShardSupervisor:
+    # Delay before restarting a process that stopped, doubled every time it stops
+    # again before running STABLE_TIME seconds
+    MIN_RESTART_DELAY = 1
+    MAX_RESTART_DELAY = 60
+    STABLE_TIME = 60
+
+    def __init__(self, shards: int, flask_config: str, stop_timeout: float = 30, context = None):
+        self.shards = shards
+        self.flask_config = flask_config
+        self.stop_timeout = stop_timeout
+        # spawn: each process starts without the state (e.g., connections) of the supervisor
+        self.context = context or multiprocessing.get_context('spawn')
+        self.processes: Dict[int, multiprocessing.process.BaseProcess] = {
+            # shard: process
+        }
+        self.started_at: Dict[int, float] = {}
+        self.restart_delays: Dict[int, float] = {}
+        self.restart_at: Dict[int, float] = {}
+        self.stopping = False
+
+    def start_shard(self, shard: int):
+        process = self.context.Process(target=run_shard, args=(shard, self.shards, self.flask_config),
+                                       name=f"lde-worker-{shard + 1}")
+        process.start()
+        self.processes[shard] = process
+        self.started_at[shard] = time.monotonic()
+        logger.info(f"Worker process {shard + 1}/{self.shards} started (pid {process.pid})")
+
+    def check_shards(self, now: Optional[float] = None):
+        """
+        Restart the processes that stopped, once their restart delay is over
+        """
+        if now is None:
+            now = time.monotonic()
+
+        for shard in range(self.shards):
+            process = self.processes.get(shard)
+            if process is not None:
+                if process.is_alive():
+                    continue
+
+                self.processes.pop(shard)
+                if now - self.started_at[shard] >= self.STABLE_TIME:
+                    delay = self.MIN_RESTART_DELAY
+                else:
+                    delay = min(self.restart_delays.get(shard, self.MIN_RESTART_DELAY / 2) * 2, self.MAX_RESTART_DELAY)
+                self.restart_delays[shard] = delay
+                self.restart_at[shard] = now + delay
+                logger.error(f"Worker process {shard + 1}/{self.shards} stopped (exit code {process.exitcode}). Restarting it in {delay} seconds")
+
+            if now >= self.restart_at.get(shard, 0):
+                self.start_shard(shard)
+
+    def stop_shards(self):
+        """
+        Ask every process to stop (SIGTERM) and kill the ones still running after stop_timeout seconds
+        """
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + self.stop_timeout
+        for shard, process in self.processes.items():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error(f"Worker process {shard + 1}/{self.shards} did not stop in {self.stop_timeout} seconds. Killing it")
+                process.kill()
+                process.join()
+
+        self.processes.clear()
+
+    def request_stop(self, signum, frame):
+        logger.info(f"Received signal {signum}, stopping every worker process...")
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGTERM, self.request_stop)
+
+        logger.info(f"Starting {self.shards} worker processes...")
+        try:
+            while not self.stopping:
+                self.check_shards()
+                time.sleep(0.5)
+        finally:
+            self.stop_shards()
+
+        logger.info("Every worker process stopped")
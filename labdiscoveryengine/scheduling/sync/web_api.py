@@ -2,21 +2,24 @@
 Methods that should be called from the web interface (not running in asyncio, and not using asyncio libraries)
 """
 
+import math
 import datetime
 import json
+import secrets
 import time
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
-from flask import Flask
+from flask import Flask, current_app
 from flask_redis import FlaskRedis
 
-from labdiscoveryengine.scheduling.keys import ReservationKeys, ResourceKeys, UserKeys
+from labdiscoveryengine.scheduling.keys import AdmissionKeys, ReservationKeys, ResourceKeys, UserKeys, WebKeys
 from labdiscoveryengine import mongo
 
-from ..data import ReservationRequest, ReservationStatus, ResourceHealth
+from ..data import AdmissionDecision, AdmissionScopes, ReservationRequest, ReservationStatus, ResourceHealth, ResourceUptime
+from labdiscoveryengine.history.rollups import UsageSummary, summarize_rollups
 from ..redis_scripts import ScriptNames, SCRIPT_FILES
 
-from labdiscoveryengine.utils import is_mongo_active, lde_config
+from labdiscoveryengine.utils import get_lde_config, is_mongo_active, lde_config
 
 redis_store = FlaskRedis(decode_responses=True)
 
@@ -74,17 +77,53 @@ class SyncLuaScripts:
         Get the reservation status in an adequate class
         """
         result = self._run_lua_script(ScriptNames.get_reservation_status, args=[reservation_id])
-        status, external_session_id, position, url, message = result
-        return ReservationStatus(status=status, reservation_id=reservation_id, external_session_id=external_session_id, position=position, url=url, message=message)
+        status, external_session_id, position, url, message, estimated_wait = result
+        return ReservationStatus(status=status, reservation_id=reservation_id, external_session_id=external_session_id, position=position, url=url, message=message,
+                                 estimated_wait=estimated_wait if estimated_wait is not False else None)
+
+    def admit_reservation(self, resources: List[str], buckets: List[Tuple[str, str, float]], max_queue_depth: int) -> AdmissionDecision:
+        """
+        Check (and take a token of) each bucket (scope, identifier, rate per minute), and
+        the depth of the queues
+        """
+        args = [time.time(), max_queue_depth, len(resources)]
+        args.extend(resources)
+        for scope, identifier, rate in buckets:
+            # Bursts of up to a minute of reservations
+            args.extend([scope, identifier, rate, max(1, math.ceil(rate))])
+
+        admitted, reason, retry_after_ms = self._run_lua_script(ScriptNames.admit_reservation, args=args)
+        if admitted:
+            return AdmissionDecision(admitted=True)
+        return AdmissionDecision(admitted=False, reason=reason, retry_after=max(1, math.ceil(retry_after_ms / 1000)))
 
 sync_lua_scripts = SyncLuaScripts()
 
 
 def get_resource_health(resource_name: str) -> ResourceHealth:
-    return ResourceHealth.fromdict(
+    resource_keys = ResourceKeys(resource_name)
+    health = ResourceHealth.fromdict(
         resource=resource_name,
-        data=redis_store.hgetall(ResourceKeys(resource_name).health()),
+        data=redis_store.hgetall(resource_keys.health()),
     )
+    if health.is_broken:
+        return health
+
+    # The healthchecks might say it is fine, but the last sessions failed (see scheduling/asyncio/passive_health.py)
+    passive_health = redis_store.get(resource_keys.passive_health())
+    if passive_health:
+        passive_health_data = json.loads(passive_health)
+        if passive_health_data.get('probation_until', 0) > time.time():
+            return ResourceHealth(
+                resource=resource_name,
+                status=ResourceHealth.states.broken,
+                message=f"The last sessions failed ({passive_health_data.get('last_message') or passive_health_data.get('last_signal')})",
+                source="passive",
+                checked_at=health.checked_at,
+                latency=health.latency,
+            )
+
+    return health
 
 
 def get_all_resource_health() -> Dict[str, ResourceHealth]:
@@ -94,6 +133,39 @@ def get_all_resource_health() -> Dict[str, ResourceHealth]:
     }
 
 
+def get_all_resource_uptime(hours: int = 24) -> Dict[str, ResourceUptime]:
+    """
+    Uptime of each resource in the last hours, from the health history written by the
+    healthcheck workers (a single round trip to Redis)
+    """
+    now = datetime.datetime.utcnow()
+    since_ms = int((time.time() - hours * 3600) * 1000)
+    resource_names = sorted(lde_config.resources)
+
+    pipeline = redis_store.pipeline()
+    for resource_name in resource_names:
+        pipeline.xrange(ResourceKeys(resource_name).health_history(), min=since_ms)
+
+    return {
+        resource_name: ResourceUptime.fromhistory(resource_name, entries, now=now)
+        for resource_name, entries in zip(resource_names, pipeline.execute())
+    }
+
+
+def get_usage_summary(hours: int = 24) -> List[UsageSummary]:
+    """
+    Summarize the usage of each resource during the last hours, based on the
+    hourly rollups maintained by the worker (not on the sessions collection).
+    """
+    if not is_mongo_active():
+        return []
+
+    since = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+    return summarize_rollups(mongo.db.session_rollups.find({
+        "hour": { "$gte": since },
+    }))
+
+
 def initialize_web(app: Flask):
     """
     Initializes the web interface
@@ -104,19 +176,22 @@ def initialize_web(app: Flask):
     
 
 def add_reservation(reservation_request: ReservationRequest) -> ReservationStatus:
+    config = get_lde_config()
+
     candidate_resources = list(reservation_request.resources)
     if reservation_request.features:
+        requested_features = frozenset(reservation_request.features)
         feature_filtered_resources = []
         for resource_name in candidate_resources:
-            resource = lde_config.resources.get(resource_name)
+            resource = config.resources.get(resource_name)
             if not resource:
                 continue
 
-            if all(feature in resource.features for feature in reservation_request.features):
+            if requested_features <= resource.features:
                 feature_filtered_resources.append(resource_name)
         candidate_resources = feature_filtered_resources
 
-    laboratory = lde_config.laboratories[reservation_request.laboratory]
+    laboratory = config.laboratories[reservation_request.laboratory]
     if not laboratory.bypass_resource_health:
         broken_health = []
         healthy_or_unknown_resources = []
@@ -180,12 +255,52 @@ def add_reservation(reservation_request: ReservationRequest) -> ReservationStatu
             "min_duration": None,
             "max_duration": None,
             "end_reservation": None,
+            # To restore the reservation if Redis is flushed (see scheduling/asyncio/recovery.py)
+            "metadata": json.dumps(reservation_request.todict()),
         })
 
     sync_lua_scripts.store_reservation(reservation_request)
     return sync_lua_scripts.get_reservation_status(reservation_request.identifier)
 
 
+def admit_reservation(reservation_request: ReservationRequest) -> AdmissionDecision:
+    """
+    Rate limit the new reservations (per external system, student and laboratory) and shed
+    them if the queues are full. Call it before add_reservation: if not admitted, the view
+    should return 429 (with Retry-After).
+    """
+    config = current_app.config
+    buckets = []
+
+    if reservation_request.user_role == 'external':
+        # user_identifier is the external system (and external_user_identifier its student)
+        buckets.append((AdmissionScopes.external, reservation_request.user_identifier, config.get('RESERVATIONS_PER_MINUTE_PER_EXTERNAL_USER', 0)))
+
+    buckets.append((AdmissionScopes.user, reservation_request.unique_username, config.get('RESERVATIONS_PER_MINUTE_PER_USER', 0)))
+    buckets.append((AdmissionScopes.laboratory, reservation_request.laboratory, config.get('RESERVATIONS_PER_MINUTE_PER_LABORATORY', 0)))
+    buckets = [ bucket for bucket in buckets if bucket[2] > 0 ]
+
+    max_queue_depth = config.get('MAX_QUEUE_DEPTH', 0)
+    if not buckets and not max_queue_depth:
+        return AdmissionDecision(admitted=True)
+
+    decision = sync_lua_scripts.admit_reservation(reservation_request.resources, buckets, max_queue_depth)
+    if decision.reason == AdmissionScopes.queue_full:
+        # No token will help: come back once the queues move
+        decision = decision._replace(retry_after=config.get('STATUS_MAX_RETRY_AFTER', 30))
+    return decision
+
+
+def get_admission_stats() -> Dict[str, int]:
+    """
+    Number of reservations admitted, shed (queue-full) and rejected by each rate limit
+    """
+    return {
+        key: int(value)
+        for key, value in (redis_store.hgetall(AdmissionKeys.stats()) or {}).items()
+    }
+
+
 def _store_terminal_reservation(reservation_request: ReservationRequest, status: str, message: str):
     reservation_id = reservation_request.identifier
     reservation_keys = ReservationKeys(reservation_id)
@@ -217,20 +332,75 @@ def get_reservation_status(username: str, reservation_id: str, previous_reservat
     reservation_status: ReservationStatus = sync_lua_scripts.get_reservation_status(reservation_id)
 
     if not previous_reservation_status or reservation_status.has_changed_from(previous_reservation_status):
-        return reservation_status
+        pollers = redis_store.zcount(WebKeys.pollers(), t0, '+inf')
+        return suggest_polling(reservation_status, pollers)
 
-    # Wait while the reservation status is different. Instead of waits, rely on pubsub channels
-    reservation_keys = ReservationKeys(reservation_id)
-    with redis_store.pubsub() as pubsub:
-        pubsub.subscribe(reservation_keys.channel())
+    # Count the requests waiting, as a measure of the load: one member per request, scored by
+    # when it stops waiting. If a web process dies while waiting, its members are purged once
+    # their deadline passes
+    poller = secrets.token_hex(8)
+    pipeline = redis_store.pipeline()
+    pipeline.zadd(WebKeys.pollers(), {poller: t0 + max_time})
+    pipeline.zremrangebyscore(WebKeys.pollers(), '-inf', t0)
+    pipeline.zcard(WebKeys.pollers())
+    pipeline.expire(WebKeys.pollers(), 3600)
+    _, _, pollers, _ = pipeline.execute()
+
+    try:
+        # Wait while the reservation status is different. Instead of waits, rely on pubsub channels
+        reservation_keys = ReservationKeys(reservation_id)
+        with redis_store.pubsub() as pubsub:
+            pubsub.subscribe(reservation_keys.channel())
 
-        elapsed = time.time() - t0
-        while elapsed < max_time and not reservation_status.has_changed_from(previous_reservation_status):
-            pubsub.get_message(timeout=max_time - elapsed)
-            reservation_status = sync_lua_scripts.get_reservation_status(reservation_id)
             elapsed = time.time() - t0
+            while elapsed < max_time and not reservation_status.has_changed_from(previous_reservation_status):
+                pubsub.get_message(timeout=max_time - elapsed)
+                reservation_status = sync_lua_scripts.get_reservation_status(reservation_id)
+                elapsed = time.time() - t0
+    finally:
+        redis_store.zrem(WebKeys.pollers(), poller)
 
-    return reservation_status
+    return suggest_polling(reservation_status, pollers)
+
+def suggest_polling(reservation_status: ReservationStatus, pollers: int, default_max_time: float = 20) -> ReservationStatus:
+    """
+    Add to the status how long the client should wait before asking again (retry_after) and
+    which max_time it should use then. The suggested max_time is based on default_max_time
+    (the maximum of the views), not on the max_time of the request: clients send back the
+    suggestion, so otherwise it would shrink in every request.
+
+    Every change of position wakes up all the requests waiting in the queue, so clients far
+    down the queue are asked to wait (a fraction of the estimated waiting time), while the
+    ones about to start poll continuously. If there are more than STATUS_TARGET_POLLERS
+    requests waiting, everyone backs off proportionally (and waits less in each request, so
+    the web processes are released).
+    """
+    max_retry_after = current_app.config.get('STATUS_MAX_RETRY_AFTER', 30)
+    target_pollers = current_app.config.get('STATUS_TARGET_POLLERS', 200)
+
+    status = reservation_status.status
+    if status in ReservationKeys.states.finished_states:
+        # Nothing else will change
+        return reservation_status
+
+    load = max(1.0, pollers / target_pollers) if target_pollers > 0 else 1.0
+
+    if status == ReservationKeys.states.queued and reservation_status.position:
+        if reservation_status.estimated_wait is not None:
+            retry_after = reservation_status.estimated_wait / 4
+        else:
+            retry_after = 2 * reservation_status.position
+    elif status in (ReservationKeys.states.ready, ReservationKeys.states.cancelling, ReservationKeys.states.finishing):
+        # The session is running: clients only wait for it to finish
+        retry_after = 5
+    else:
+        # pending, initializing or first in the queue: it is their turn
+        retry_after = 0
+
+    retry_after = min(max_retry_after, math.ceil(retry_after * load)) if retry_after else 0
+    suggested_max_time = math.ceil(default_max_time / load) if retry_after else math.ceil(default_max_time)
+
+    return reservation_status._replace(retry_after=retry_after, suggested_max_time=suggested_max_time)
 
 def cancel_reservation(user_identifier: str, reservation_id: str) -> bool:
     """
@@ -253,6 +423,16 @@ def cancel_reservation(user_identifier: str, reservation_id: str) -> bool:
     pipeline.hset(reservation_key, ReservationKeys.parameters.status, ReservationKeys.states.cancelling)
     pipeline.publish(ReservationKeys(reservation_id).channel(), ReservationKeys.states.cancelling)
     pipeline.execute()
+
+    if is_mongo_active():
+        # So it is not queued again if Redis is flushed before a worker takes it (see recovery.py)
+        mongo.db.sessions.update_one({
+            "reservation_id": reservation_id,
+        }, {
+            "$set": {
+                "status": ReservationKeys.states.cancelling,
+            }
+        })
     return True
         
 
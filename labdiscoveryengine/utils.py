@@ -1,6 +1,4 @@
 import re
-import asyncio
-from functools import wraps
 from unicodedata import normalize
 
 from werkzeug.local import LocalProxy
@@ -9,6 +7,11 @@ from flask import current_app
 from labdiscoveryengine.configuration.storage import StoredConfiguration
 
 def get_lde_config() -> StoredConfiguration:
+    """
+    Return the current configuration. Every attribute access on lde_config goes
+    through current_app, so code accessing it many times (e.g., in a loop) should
+    call this once and use the returned configuration (which is never modified).
+    """
     # This is added in __init__.py
     config = current_app.config.get('LDE_CONFIG')
     if config is None:
@@ -61,54 +64,33 @@ def create_proxied_instance(klass: type):
     class ProxyClass:
         def __init__(self):
             self._obj = None
-            self._method_cache = {}
+            self._bound_names = []
 
         def set_proxied_object(self, obj: klass):
+            # Forget the methods bound to the previous object
+            for name in self._bound_names:
+                self.__dict__.pop(name, None)
+            self._bound_names = []
             self._obj = obj
 
         def get_proxied_object(self):
             return self._obj
 
-        def _create_sync_wrapper(self, attr):
-            @wraps(attr)
-            def sync_method(*args, **kwargs):
-                if self._obj is None:
-                    raise Exception(f"{klass} is not initialized")
-                return attr(*args, **kwargs)
-            return sync_method
-
-        def _create_async_wrapper(self, attr):
-            @wraps(attr)
-            async def async_method(*args, **kwargs):
-                if self._obj is None:
-                    raise Exception(f"{klass} is not initialized")
-                return await attr(*args, **kwargs)
-            return async_method
-
         def __getattr__(self, name):
             """
-            Wrap all the methods of the class provided (klass)
+            Only called if the attribute is not found in the proxy. Methods of the
+            proxied object are stored in the proxy itself, so next time they are
+            found directly (without calling __getattr__ or any wrapper).
             """
-            if self._obj is None:
+            obj = self.__dict__.get('_obj')
+            if obj is None:
                 raise Exception(f"{klass} is not initialized")
 
-            # Check the cache first
-            if name in self._method_cache:
-                return self._method_cache[name]
-
-            # Get the attribute from the instance
-            attr = getattr(self._obj, name)
-
-            # Create and cache the appropriate wrapper
-            if asyncio.iscoroutinefunction(attr):
-                wrapper = self._create_async_wrapper(attr)
-            elif callable(attr):
-                wrapper = self._create_sync_wrapper(attr)
-            else:
-                wrapper = attr
-
-            self._method_cache[name] = wrapper
-            return wrapper
+            attr = getattr(obj, name)
+            if callable(attr):
+                self.__dict__[name] = attr
+                self._bound_names.append(name)
+            return attr
         
         def __repr__(self):
             return f"MimicClass of ({klass}) with obj: {self._obj}"
@@ -1,6 +1,7 @@
 import hashlib
+import tempfile
 from wtforms import fields, widgets, validators, form
-from flask import redirect, request, session, url_for
+from flask import Response, redirect, request, session, stream_with_context, url_for
 from flask_admin import Admin, AdminIndexView
 from flask_admin.form.widgets import Select2Widget
 from flask_babel import gettext, lazy_gettext
@@ -11,8 +12,9 @@ import flask_admin.contrib.pymongo as flask_admin_pymongo
 from flask_admin.model import filters
 
 from labdiscoveryengine import mongo, db
+from labdiscoveryengine.history.export import ExportFormats, is_format_available, iter_csv_chunks, iter_sessions, parse_export_date, write_parquet
 from labdiscoveryengine.models import GroupPermission, User, Group
-from labdiscoveryengine.scheduling.sync.web_api import get_all_resource_health
+from labdiscoveryengine.scheduling.sync.web_api import get_admission_stats, get_all_resource_health, get_all_resource_uptime, get_usage_summary
 from labdiscoveryengine.utils import lde_config, slugify, is_mongo_active, is_sql_active
 
 class AuthMixIn:
@@ -40,7 +42,10 @@ class MainIndexView(AuthMixIn, AdminIndexView):
         mongo_active = is_mongo_active()
         sql_active = is_sql_active()
         resource_health = get_all_resource_health()
-        return self.render('lde-admin/index.html', mongo_active=mongo_active, sql_active=sql_active, resource_health=resource_health)
+        resource_uptime = get_all_resource_uptime(hours=24)
+        usage_summary = get_usage_summary(hours=24) if mongo_active else []
+        admission_stats = get_admission_stats()
+        return self.render('lde-admin/index.html', mongo_active=mongo_active, sql_active=sql_active, resource_health=resource_health, resource_uptime=resource_uptime, usage_summary=usage_summary, admission_stats=admission_stats, parquet_available=is_format_available(ExportFormats.parquet))
 
 class NoPyMongoView(AuthMixIn, BaseView):
     @expose('/')
@@ -289,6 +294,55 @@ class UserSessionsView(AuthMixIn, flask_admin_pymongo.ModelView):
 
     form = UserSessionForm
 
+    @expose('/export/')
+    def export_view(self):
+        """
+        Download the session history (optionally filtered with since, until and laboratory)
+        as CSV or Parquet. Sessions are streamed, so the export is never kept in memory.
+        """
+        export_format = request.args.get('format', ExportFormats.csv)
+        if export_format not in ExportFormats.all_formats:
+            return gettext("Invalid format"), 400
+
+        if not is_format_available(export_format):
+            return gettext("Exporting to Parquet requires pyarrow"), 400
+
+        try:
+            since = parse_export_date(request.args.get('since'))
+            until = parse_export_date(request.args.get('until'))
+        except ValueError:
+            return gettext("Invalid date (use YYYY-MM-DD)"), 400
+
+        sessions = iter_sessions(self.coll, since=since, until=until, laboratories=request.args.getlist('laboratory'))
+        filename = f"sessions.{export_format}"
+
+        if export_format == ExportFormats.csv:
+            response = Response(stream_with_context(iter_csv_chunks(sessions)), mimetype='text/csv')
+        else:
+            # Parquet writes its footer at the end, so it is written to a temporary
+            # file (not to memory) and then streamed
+            parquet_file = tempfile.TemporaryFile()
+            try:
+                write_parquet(sessions, parquet_file)
+                parquet_file.seek(0)
+            except Exception:
+                parquet_file.close()
+                raise
+
+            def generate():
+                while True:
+                    chunk = parquet_file.read(64 * 1024)
+                    if not chunk:
+                        break
+                    yield chunk
+
+            response = Response(generate(), mimetype='application/vnd.apache.parquet')
+            # Also if the client disconnects before the download starts
+            response.call_on_close(parquet_file.close)
+
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
 
 def create_admin(app) -> Admin:
     admin = Admin(name='LabDiscoveryEngine', index_view=MainIndexView(), template_mode='bootstrap3')
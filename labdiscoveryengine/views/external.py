@@ -2,10 +2,10 @@ import secrets
 from typing import List, Optional
 from flask import Blueprint, jsonify, g, request
 
-from labdiscoveryengine.utils import lde_config
+from labdiscoveryengine.utils import get_lde_config, lde_config
 
 from labdiscoveryengine.scheduling.data import ReservationRequest, ReservationStatus
-from labdiscoveryengine.scheduling.sync.web_api import add_reservation, cancel_reservation, get_reservation_status
+from labdiscoveryengine.scheduling.sync.web_api import add_reservation, admit_reservation, cancel_reservation, get_reservation_status
 
 external_v1_blueprint = Blueprint('external', __name__)
 
@@ -54,7 +54,8 @@ def reservations():
         if not laboratory:
             return jsonify(success=False, code='invalid-request', message='Missing laboratory'), 400
         
-        if laboratory not in lde_config.laboratories:
+        config = get_lde_config()
+        if laboratory not in config.laboratories:
             # This would usually be a security issue, as external users will know the full list of laboratories (secret or not)
             # However, in 99% of the cases, the LDE host trusts the external system, and it can help debugging distributed systems
             return jsonify(success=False, code='invalid-request', message=f'Laboratory {laboratory} does not exist'), 400
@@ -65,7 +66,7 @@ def reservations():
             if not isinstance(resource, str):
                 return jsonify(success=False, code='invalid-request', message=f'Invalid resource (must be string): {resource}'), 400
 
-        laboratory_resources = set(lde_config.laboratories[laboratory].resources)
+        laboratory_resources = config.laboratories[laboratory].resources
         if not resources:
             # If it adds no resources, it means that all resources are valid
             resources = list(laboratory_resources)
@@ -91,14 +92,14 @@ def reservations():
             if not isinstance(feature, str):
                 return jsonify(success=False, code='invalid-request', message=f'Invalid feature (must be string): {feature}'), 400
 
-        if laboratory not in lde_config.external_users[g.external_username].laboratories:
+        if laboratory not in config.external_users[g.external_username].laboratories:
             return jsonify(success=False, code='invalid-request', message=f'User {g.external_username} is not authorized to reserve in {laboratory}'), 400
         
         back_url = request_data.get('backUrl')
         if not back_url:
             return jsonify(success=False, code='invalid-request', message='Missing backUrl'), 400
         
-        lab_max_time = lde_config.laboratories[laboratory].max_time
+        lab_max_time = config.laboratories[laboratory].max_time
         max_time = request_data.get('maxTime', lab_max_time)
 
         # max_time cannot be higher than max time of the laboratory
@@ -126,6 +127,10 @@ def reservations():
             client_initial_data=client_initial_data,
         )
 
+        admission = admit_reservation(reservation_request)
+        if not admission.admitted:
+            return jsonify(success=False, code='too-many-requests', reason=admission.reason, retry_after=admission.retry_after, message=admission.message), 429, {'Retry-After': str(admission.retry_after)}
+
         reservation_status: ReservationStatus = add_reservation(reservation_request=reservation_request)
 
         response_data = reservation_status.todict()
@@ -8,7 +8,7 @@ from sqlalchemy.orm import joinedload
 from labdiscoveryengine import get_locale, db
 from labdiscoveryengine.models import Group, User
 from labdiscoveryengine.scheduling.data import ReservationRequest, ReservationStatus
-from labdiscoveryengine.scheduling.sync.web_api import add_reservation, cancel_reservation, get_reservation_status
+from labdiscoveryengine.scheduling.sync.web_api import add_reservation, admit_reservation, cancel_reservation, get_reservation_status
 from labdiscoveryengine.utils import is_sql_active, lde_config
 from labdiscoveryengine.views.login import LogoutForm
 from labdiscoveryengine.views.utils import render_themed_template
@@ -111,7 +111,7 @@ def _validate_laboratory_access(laboratory: Optional[str], group: Optional[str],
     if laboratory not in laboratories_by_group[group]:
         return gettext('Laboratory is not in group'), 400
 
-    laboratory_resources = set(lde_config.laboratories[laboratory].resources)
+    laboratory_resources = lde_config.laboratories[laboratory].resources
     invalid_resources = [
         resource
         for resource in resources
@@ -184,6 +184,10 @@ def create_reservation():
         client_initial_data=_back_client_initial_data(back_url),
     )
 
+    admission = admit_reservation(reservation_request)
+    if not admission.admitted:
+        return jsonify(success=False, code='too-many-requests', reason=admission.reason, retry_after=admission.retry_after, message=admission.message), 429, {'Retry-After': str(admission.retry_after)}
+
     reservation_status: ReservationStatus = add_reservation(reservation_request=reservation_request)
 
     response_data = reservation_status.todict()
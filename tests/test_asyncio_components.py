@@ -1,16 +1,21 @@
+import json
+import time
+import asyncio
 import unittest
+from collections import deque
 from types import SimpleNamespace
 from unittest import mock
 
 import aiohttp.client_exceptions
 
-from labdiscoveryengine.data import Resource
+from labdiscoveryengine.data import HttpHealthcheck, Resource, RobotcheckerHealthcheck
 from labdiscoveryengine.scheduling.asyncio.client import WebLabLibResourceClient
-from labdiscoveryengine.scheduling.asyncio.healthcheck_worker import ResourceHealthchecksWorker
+from labdiscoveryengine.scheduling.asyncio.healthcheck_worker import HealthcheckProbeRegistry, ProbeResponse, ResourceHealthchecksWorker
 from labdiscoveryengine.scheduling.asyncio.processor import ResourceReservationProcessor
 from labdiscoveryengine.scheduling.asyncio.redis import aioredis_store
 from labdiscoveryengine.scheduling.asyncio.resource_worker import ResourceWorker
 from labdiscoveryengine.scheduling.data import ReservationRequest, ResourceHealth
+from labdiscoveryengine.scheduling.keys import ReservationKeys, ResourceKeys
 
 
 class ResourceWorkerTestCase(unittest.IsolatedAsyncioTestCase):
@@ -64,7 +69,7 @@ class WebLabLibResourceClientTestCase(unittest.IsolatedAsyncioTestCase):
             }
         )
 
-        with mock.patch("labdiscoveryengine.scheduling.asyncio.client.lde_config", fake_config):
+        with mock.patch("labdiscoveryengine.scheduling.asyncio.client.worker_config", SimpleNamespace(current=fake_config)):
             client = WebLabLibResourceClient(resource)
             try:
                 body = client._get_start_body(reservation_request)
@@ -114,7 +119,7 @@ class WebLabLibResourceClientTestCase(unittest.IsolatedAsyncioTestCase):
             }
         )
 
-        with mock.patch("labdiscoveryengine.scheduling.asyncio.client.lde_config", fake_config):
+        with mock.patch("labdiscoveryengine.scheduling.asyncio.client.worker_config", SimpleNamespace(current=fake_config)):
             client = WebLabLibResourceClient(resource)
             try:
                 body = client._get_start_body(reservation_request)
@@ -176,6 +181,91 @@ class ResourceReservationProcessorTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(processor.client.get_should_finish.await_count, 2)
         sleep.assert_awaited_once_with(0)
 
+    async def _start_failing(self, requeued_in: int, user_cancelled: bool = False):
+        processor = self.build_processor()
+        processor.client = SimpleNamespace(start=mock.AsyncMock(side_effect=ConnectionRefusedError("Connection refused")))
+        processor.fail = mock.AsyncMock()
+        processor.cancelled = mock.AsyncMock()
+        processor.did_user_cancel = mock.AsyncMock(return_value=user_cancelled)
+        processor.deassign = mock.AsyncMock()
+        lua_scripts = SimpleNamespace(requeue_reservation=mock.AsyncMock(return_value=requeued_in))
+        reservation_request = ReservationRequest(
+            identifier="reservation-1", laboratory="lab", features=[], resources=["resource-1", "resource-2"],
+            user_identifier="user", user_role="external", locale="en", max_time=180, back_url="https://back.example",
+            priority=3,
+        )
+
+        with mock.patch("labdiscoveryengine.scheduling.asyncio.processor.aioredis_store", SimpleNamespace(pipeline=lambda: mock.Mock(execute=mock.AsyncMock()))), \
+                mock.patch("labdiscoveryengine.scheduling.asyncio.processor.async_lua_scripts", lua_scripts), \
+                mock.patch("labdiscoveryengine.scheduling.asyncio.processor.passive_health", mock.AsyncMock()), \
+                mock.patch("labdiscoveryengine.scheduling.asyncio.processor.worker_config", SimpleNamespace(app_config={ 'START_FAILOVER_ATTEMPTS': 3 })):
+            result = await processor.initialize_laboratory(reservation_request)
+
+        return processor, lua_scripts, result
+
+    async def test_failed_start_is_requeued_in_other_resources(self):
+        processor, lua_scripts, result = await self._start_failing(requeued_in=1)
+
+        self.assertIsNone(result)
+        lua_scripts.requeue_reservation.assert_awaited_once_with("reservation-1", "resource-1", priority=3, max_attempts=3)
+        processor.deassign.assert_awaited_once()
+        processor.fail.assert_not_awaited()
+
+    async def test_failed_start_fails_without_other_resources(self):
+        processor, lua_scripts, result = await self._start_failing(requeued_in=0)
+
+        processor.fail.assert_awaited_once()
+        processor.cancelled.assert_not_awaited()
+
+    async def test_failed_start_of_cancelled_reservation_is_cancelled(self):
+        # requeue_reservation.lua does not requeue reservations being cancelled
+        processor, lua_scripts, result = await self._start_failing(requeued_in=0, user_cancelled=True)
+
+        self.assertIsNone(result)
+        processor.fail.assert_not_awaited()
+        processor.cancelled.assert_awaited_once()
+        self.assertIsNone(processor.cancelled.await_args.kwargs['session_id'])
+
+    async def test_failed_reservation_is_over_in_mongodb(self):
+        processor = self.build_processor()
+        processor.deassign = mock.AsyncMock()
+        sessions = SimpleNamespace(update_one=mock.AsyncMock())
+        store = SimpleNamespace(hset=mock.AsyncMock(), publish=mock.AsyncMock())
+
+        with mock.patch("labdiscoveryengine.scheduling.asyncio.processor.aioredis_store", store), \
+                mock.patch("labdiscoveryengine.scheduling.asyncio.processor.is_mongo_active", return_value=True), \
+                mock.patch("labdiscoveryengine.scheduling.asyncio.processor.async_mongo", SimpleNamespace(sessions=sessions)):
+            await processor.fail()
+
+        # So it is not queued again if Redis is flushed (see recovery.py)
+        query, update = sessions.update_one.await_args.args
+        self.assertEqual({"reservation_id": "reservation-1"}, query)
+        self.assertEqual(ReservationKeys.states.broken, update["$set"]["status"])
+        self.assertIsNotNone(update["$set"]["end_reservation"])
+
+    async def test_session_duration_is_recorded(self):
+        processor = self.build_processor()
+        lua_scripts = SimpleNamespace(record_session_duration=mock.AsyncMock())
+        reservation_request = ReservationRequest(
+            identifier="reservation-1", laboratory="lab", features=[], resources=["resource-1"],
+            user_identifier="user", user_role="external", locale="en", max_time=180, back_url="https://back.example",
+        )
+        store = SimpleNamespace(hget=mock.AsyncMock(return_value=str(time.time() - 60)))
+
+        with mock.patch("labdiscoveryengine.scheduling.asyncio.processor.aioredis_store", store), \
+                mock.patch("labdiscoveryengine.scheduling.asyncio.processor.async_lua_scripts", lua_scripts):
+            await processor.record_session_duration(reservation_request)
+
+            laboratory, duration = lua_scripts.record_session_duration.await_args.args
+            self.assertEqual("lab", laboratory)
+            self.assertAlmostEqual(60, duration, delta=5)
+
+            # Restored sessions do not know when they started
+            lua_scripts.record_session_duration.reset_mock()
+            store.hget.return_value = None
+            await processor.record_session_duration(reservation_request)
+            lua_scripts.record_session_duration.assert_not_awaited()
+
 
 class ReservationRequestTestCase(unittest.TestCase):
     def test_roundtrip_preserves_client_initial_data(self):
@@ -199,98 +289,253 @@ class ReservationRequestTestCase(unittest.TestCase):
 
 
 class ResourceHealthchecksWorkerTestCase(unittest.IsolatedAsyncioTestCase):
-    async def test_robotchecker_success_payload_is_healthy(self):
+    async def _run_healthcheck(self, healthcheck, status=200, body="", error=None, latency=0.1):
         worker = object.__new__(ResourceHealthchecksWorker)
         worker.resource_name = "resource-1"
 
-        healthcheck = SimpleNamespace(identifier="checker", url="https://checker.example", timeout=10)
-        response = mock.AsyncMock()
-        response.status = 200
-        response.json.return_value = {"found": True, "success": True}
-        session = mock.MagicMock()
-        session.get.return_value.__aenter__.return_value = response
+        probes = SimpleNamespace(fetch=mock.AsyncMock(return_value=ProbeResponse(status=status, body=body, error=error, latency=latency)))
+        with mock.patch("labdiscoveryengine.scheduling.asyncio.healthcheck_worker.healthcheck_probes", probes):
+            if isinstance(healthcheck, RobotcheckerHealthcheck):
+                return await worker._run_robotchecker_healthcheck(healthcheck)
+            return await worker._run_http_healthcheck(healthcheck)
 
-        with mock.patch("labdiscoveryengine.scheduling.asyncio.healthcheck_worker.aiohttp.ClientSession") as client_session:
-            client_session.return_value.__aenter__.return_value = session
-            health = await worker._run_robotchecker_healthcheck(healthcheck)
+    async def _run_robotchecker_healthcheck(self, payload, **kwargs):
+        healthcheck = RobotcheckerHealthcheck(identifier="checker", url="https://checker.example", timeout=10)
+        return await self._run_healthcheck(healthcheck, body=json.dumps(payload), **kwargs)
+
+    async def test_robotchecker_success_payload_is_healthy(self):
+        health = await self._run_robotchecker_healthcheck({"found": True, "success": True})
 
         self.assertEqual(ResourceHealth.states.healthy, health.status)
 
     async def test_robotchecker_failure_payload_is_broken(self):
-        worker = object.__new__(ResourceHealthchecksWorker)
-        worker.resource_name = "resource-1"
-
-        healthcheck = SimpleNamespace(identifier="checker", url="https://checker.example", timeout=10)
-        response = mock.AsyncMock()
-        response.status = 200
-        response.json.return_value = {"found": True, "success": False, "message": "no-loop"}
-        session = mock.MagicMock()
-        session.get.return_value.__aenter__.return_value = response
-
-        with mock.patch("labdiscoveryengine.scheduling.asyncio.healthcheck_worker.aiohttp.ClientSession") as client_session:
-            client_session.return_value.__aenter__.return_value = session
-            health = await worker._run_robotchecker_healthcheck(healthcheck)
+        health = await self._run_robotchecker_healthcheck({"found": True, "success": False, "message": "no-loop"})
 
         self.assertEqual(ResourceHealth.states.broken, health.status)
         self.assertEqual("no-loop", health.message)
 
     async def test_robotchecker_failure_payload_formats_dict_repr_message(self):
-        worker = object.__new__(ResourceHealthchecksWorker)
-        worker.resource_name = "resource-1"
-
-        healthcheck = SimpleNamespace(identifier="checker", url="https://checker.example", timeout=10)
-        response = mock.AsyncMock()
-        response.status = 200
-        response.json.return_value = {
+        health = await self._run_robotchecker_healthcheck({
             "found": True,
             "success": False,
             "message": "{'message': 'The robot has not done a single loop.', 'result': 'error', 'code': 'no-loop'}",
-        }
-        session = mock.MagicMock()
-        session.get.return_value.__aenter__.return_value = response
-
-        with mock.patch("labdiscoveryengine.scheduling.asyncio.healthcheck_worker.aiohttp.ClientSession") as client_session:
-            client_session.return_value.__aenter__.return_value = session
-            health = await worker._run_robotchecker_healthcheck(healthcheck)
+        })
 
         self.assertEqual(ResourceHealth.states.broken, health.status)
         self.assertEqual("The robot has not done a single loop. (no-loop)", health.message)
 
     async def test_robotchecker_failure_payload_keeps_plain_message(self):
-        worker = object.__new__(ResourceHealthchecksWorker)
-        worker.resource_name = "resource-1"
-
-        healthcheck = SimpleNamespace(identifier="checker", url="https://checker.example", timeout=10)
-        response = mock.AsyncMock()
-        response.status = 200
-        response.json.return_value = {
+        health = await self._run_robotchecker_healthcheck({
             "found": True,
             "success": False,
             "message": "Expecting value: line 1 column 1 (char 0)",
-        }
-        session = mock.MagicMock()
-        session.get.return_value.__aenter__.return_value = response
-
-        with mock.patch("labdiscoveryengine.scheduling.asyncio.healthcheck_worker.aiohttp.ClientSession") as client_session:
-            client_session.return_value.__aenter__.return_value = session
-            health = await worker._run_robotchecker_healthcheck(healthcheck)
+        })
 
         self.assertEqual(ResourceHealth.states.broken, health.status)
         self.assertEqual("Expecting value: line 1 column 1 (char 0)", health.message)
 
     async def test_robotchecker_missing_payload_is_unknown(self):
+        health = await self._run_robotchecker_healthcheck({"found": False})
+
+        self.assertEqual(ResourceHealth.states.unknown, health.status)
+
+    async def test_unreachable_robotchecker_is_unknown(self):
+        health = await self._run_robotchecker_healthcheck(None, status=None, error="Connection refused")
+
+        self.assertEqual(ResourceHealth.states.unknown, health.status)
+        self.assertEqual("checker: Connection refused", health.message)
+
+    def _interval_worker(self):
+        worker = object.__new__(ResourceHealthchecksWorker)
+        worker.interval = ResourceHealthchecksWorker.base_interval
+        worker.history = deque(maxlen=ResourceHealthchecksWorker.history_size)
+        worker.jitter = 0
+        return worker
+
+    def test_interval_grows_while_healthy_and_tightens_when_broken(self):
+        worker = self._interval_worker()
+
+        intervals = [ worker.next_interval(ResourceHealth.states.healthy) for _ in range(20) ]
+        self.assertEqual(ResourceHealthchecksWorker.base_interval, intervals[0])
+        self.assertLess(intervals[0], intervals[1])
+        self.assertEqual(ResourceHealthchecksWorker.max_interval, intervals[-1])
+
+        self.assertEqual(ResourceHealthchecksWorker.min_interval, worker.next_interval(ResourceHealth.states.broken))
+
+    def test_flapping_resources_are_checked_often(self):
+        worker = self._interval_worker()
+
+        for status in (ResourceHealth.states.healthy, ResourceHealth.states.broken, ResourceHealth.states.healthy):
+            interval = worker.next_interval(status)
+
+        # Healthy now, but it changed twice recently
+        self.assertEqual(ResourceHealthchecksWorker.min_interval, interval)
+
+    def test_interval_is_jittered(self):
+        worker = self._interval_worker()
+        worker.jitter = 0.2
+
+        interval = worker.next_interval(ResourceHealth.states.healthy)
+        self.assertGreaterEqual(interval, ResourceHealthchecksWorker.base_interval * 0.8)
+        self.assertLessEqual(interval, ResourceHealthchecksWorker.base_interval * 1.2)
+
+    async def test_healthchecks_run_concurrently(self):
         worker = object.__new__(ResourceHealthchecksWorker)
         worker.resource_name = "resource-1"
+        worker.resource = SimpleNamespace(healthchecks=[
+            RobotcheckerHealthcheck(identifier=f"checker-{index}", url=f"https://checker{index}.example")
+            for index in range(3)
+        ])
+        running = 0
+        max_running = 0
+
+        async def run_healthcheck(healthcheck):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return ResourceHealth(resource="resource-1", status=ResourceHealth.states.healthy)
+
+        worker._run_robotchecker_healthcheck = run_healthcheck
+        worker.mark_as_fixed = mock.AsyncMock()
+
+        status = await worker.check_health()
+
+        self.assertEqual(ResourceHealth.states.healthy, status)
+        self.assertEqual(3, max_running)
+        worker.mark_as_fixed.assert_awaited_once()
+
+    async def test_http_healthcheck_assertions(self):
+        healthcheck = HttpHealthcheck(identifier="device", url="http://device.example/status",
+                                      body_regex="ready", json_path="devices.0.status", json_value="ok")
+
+        health = await self._run_healthcheck(healthcheck, body='{"devices": [{"status": "ok"}], "state": "ready"}')
+        self.assertEqual(ResourceHealth.states.healthy, health.status)
+        self.assertEqual("http", health.source)
 
-        healthcheck = SimpleNamespace(identifier="checker", url="https://checker.example", timeout=10)
-        response = mock.AsyncMock()
-        response.status = 200
-        response.json.return_value = {"found": False}
-        session = mock.MagicMock()
-        session.get.return_value.__aenter__.return_value = response
+        health = await self._run_healthcheck(healthcheck, body='{"devices": [{"status": "error"}], "state": "ready"}')
+        self.assertEqual(ResourceHealth.states.broken, health.status)
+        self.assertEqual("device: devices.0.status is 'error'", health.message)
 
-        with mock.patch("labdiscoveryengine.scheduling.asyncio.healthcheck_worker.aiohttp.ClientSession") as client_session:
-            client_session.return_value.__aenter__.return_value = session
-            health = await worker._run_robotchecker_healthcheck(healthcheck)
+        health = await self._run_healthcheck(healthcheck, body='{"devices": [], "state": "ready"}')
+        self.assertEqual("device: devices.0.status not found", health.message)
 
-        self.assertEqual(ResourceHealth.states.unknown, health.status)
+        health = await self._run_healthcheck(healthcheck, status=503, body="ready")
+        self.assertEqual(ResourceHealth.states.broken, health.status)
+        self.assertEqual("device: HTTP 503 (expected 200)", health.message)
+
+    async def test_http_healthcheck_latency_threshold(self):
+        healthcheck = HttpHealthcheck(identifier="device", url="http://device.example/status", max_latency=1)
+
+        health = await self._run_healthcheck(healthcheck, latency=2.5)
+
+        self.assertEqual(ResourceHealth.states.broken, health.status)
+        self.assertIn("2.50 seconds", health.message)
+
+    async def test_http_healthcheck_unreachable_device_is_broken(self):
+        healthcheck = HttpHealthcheck(identifier="device", url="http://device.example/status")
+
+        health = await self._run_healthcheck(healthcheck, status=None, error="Connection refused")
+
+        self.assertEqual(ResourceHealth.states.broken, health.status)
+        self.assertEqual("device: Connection refused", health.message)
+
+
+class HealthcheckProbeRegistryTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.requests = 0
+
+        test_case = self
+
+        class FakeResponse:
+            status = 200
+
+            async def __aenter__(self):
+                test_case.requests += 1
+                await asyncio.sleep(0.01)
+                return self
+
+            async def __aexit__(self, *args):
+                pass
+
+            async def text(self):
+                return '{"found": true, "success": true}'
+
+        session = SimpleNamespace(get=lambda url, timeout: FakeResponse())
+        patchers = [
+            mock.patch("labdiscoveryengine.scheduling.asyncio.healthcheck_worker.healthcheck_http_pool", SimpleNamespace(session=session)),
+            # aiohttp might be replaced by a stub (see test_async_processor_cleanup.py)
+            mock.patch("labdiscoveryengine.scheduling.asyncio.healthcheck_worker.aiohttp.ClientTimeout", lambda total: total, create=True),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_concurrent_checks_share_the_request(self):
+        registry = HealthcheckProbeRegistry()
+
+        responses = await asyncio.gather(*[
+            registry.fetch("https://checker.example/status/", timeout=10, max_age=10)
+            for _ in range(20)
+        ])
+
+        self.assertEqual(1, self.requests)
+        self.assertTrue(all(response.status == 200 for response in responses))
+
+        # Recent enough: reused
+        await registry.fetch("https://checker.example/status/", timeout=10, max_age=10)
+        self.assertEqual(1, self.requests)
+
+        # Too old: fetched again
+        await registry.fetch("https://checker.example/status/", timeout=10, max_age=0)
+        self.assertEqual(2, self.requests)
+
+        # Other URLs are fetched separately
+        await registry.fetch("https://checker.example/other/", timeout=10, max_age=10)
+        self.assertEqual(3, self.requests)
+
+
+class FakeRedisPipeline:
+    def __init__(self, commands):
+        self.commands = commands
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    async def execute(self):
+        pass
+
+
+class HealthHistoryTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_status_changes_are_damped(self):
+        worker = object.__new__(ResourceHealthchecksWorker)
+        worker.resource_name = "resource-1"
+        worker.resource_keys = ResourceKeys("resource-1")
+        worker.published_status = None
+        worker.pending_status = None
+        worker.pending_results = 0
+
+        commands = []
+        fake_redis = SimpleNamespace(pipeline=lambda: FakeRedisPipeline(commands))
+
+        def published_statuses():
+            return [ kwargs['mapping']['status'] for name, args, kwargs in commands if name == 'hset' ]
+
+        with mock.patch("labdiscoveryengine.scheduling.asyncio.healthcheck_worker.aioredis_store", fake_redis):
+            await worker.mark_as_fixed(latency=0.2)
+            # A single failure is not published...
+            await worker.mark_as_broken("timeout")
+            await worker.mark_as_fixed()
+            self.assertEqual([ResourceHealth.states.healthy] * 2, published_statuses())
+
+            # ...but two in a row are
+            await worker.mark_as_broken("timeout")
+            await worker.mark_as_broken("timeout")
+            self.assertEqual(ResourceHealth.states.broken, published_statuses()[-1])
+
+        # Every result is in the history
+        history = [ args for name, args, kwargs in commands if name == 'xadd' ]
+        self.assertEqual(5, len(history))
+        self.assertEqual("lde:resources:resource-1:health:history", history[0][0])
+        self.assertEqual({"status": ResourceHealth.states.healthy, "latency": "0.200"}, history[0][1])
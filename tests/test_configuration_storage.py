@@ -1,12 +1,15 @@
 import datetime
+import pickle
 import tempfile
 import unittest
+from unittest import mock
 from pathlib import Path
 
 from flask import Flask
 
-from labdiscoveryengine.data import RobotcheckerHealthcheck
-from labdiscoveryengine.configuration.storage import ConfigurationFileNames, get_latest_configuration
+from labdiscoveryengine.data import HttpHealthcheck, RobotcheckerHealthcheck
+from labdiscoveryengine.configuration.exc import InvalidConfigurationValueError
+from labdiscoveryengine.configuration.storage import ConfigurationFileNames, ConfigurationReloader, get_latest_configuration
 
 
 class ConfigurationStorageTestCase(unittest.TestCase):
@@ -35,6 +38,11 @@ class ConfigurationStorageTestCase(unittest.TestCase):
                         "      type: robotchecker",
                         "      url: https://checker.example/status/robot-1/",
                         "      timeout: 25",
+                        "    device:",
+                        "      url: http://example.invalid/lab/status",
+                        "      expected_status: 204",
+                        "      json_path: devices.0.ready",
+                        "      max_latency: 2",
                         "",
                     ]
                 ),
@@ -46,6 +54,7 @@ class ConfigurationStorageTestCase(unittest.TestCase):
                         "boolean-lab:",
                         "  display_name: Boolean lab",
                         "  bypass_resource_health: true",
+                        "  prewarm: 2",
                         "  resources:",
                         "    - resource-1",
                         "",
@@ -79,8 +88,24 @@ class ConfigurationStorageTestCase(unittest.TestCase):
             self.assertEqual("default-pass", config.resources["resource-1"].password)
             self.assertEqual(180, config.laboratories["boolean-lab"].max_time)
             self.assertTrue(config.laboratories["boolean-lab"].bypass_resource_health)
+            self.assertEqual(2, config.laboratories["boolean-lab"].prewarm)
             self.assertIsInstance(config.resources["resource-1"].healthchecks[0], RobotcheckerHealthcheck)
             self.assertEqual(25, config.resources["resource-1"].healthchecks[0].timeout)
+            http_healthcheck = config.resources["resource-1"].healthchecks[1]
+            self.assertIs(HttpHealthcheck, type(http_healthcheck))
+            self.assertEqual(204, http_healthcheck.expected_status)
+            self.assertEqual("devices.0.ready", http_healthcheck.json_path)
+            self.assertEqual(2, http_healthcheck.max_latency)
+
+            # The configuration objects are immutable
+            resource = config.resources["resource-1"]
+            self.assertEqual(frozenset(["boolean"]), resource.features)
+            self.assertIsInstance(resource.healthchecks, tuple)
+            self.assertIsInstance(config.laboratories["boolean-lab"].resources, frozenset)
+            with self.assertRaises(AttributeError):
+                resource.healthchecks[0].url = "http://other.example"
+            self.assertFalse(hasattr(resource.healthchecks[0], "__dict__"))
+            self.assertEqual(resource, pickle.loads(pickle.dumps(resource)))
 
     def test_get_latest_configuration_prunes_removed_entries_on_reload(self):
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -194,9 +219,132 @@ class ConfigurationStorageTestCase(unittest.TestCase):
                 ):
                     config.last_check[configuration_type] = datetime.datetime.utcfromtimestamp(0)
 
+                previous_config = config
                 config = get_latest_configuration(config)
 
+                # The previous configuration is not modified (copy on write)...
+                self.assertIn("resource-2", previous_config.resources)
+                # ... and if nothing changed, the same configuration is returned
+                self.assertIs(config, get_latest_configuration(config))
+
             self.assertNotIn("resource-2", config.resources)
             self.assertNotIn("lab-2", config.laboratories)
             self.assertNotIn("admin-2", config.administrators)
             self.assertNotIn("tester-2", config.external_users)
+
+    def test_invalid_reload_does_not_apply_variables(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            deployment_dir = Path(tmpdir)
+            (deployment_dir / "configuration.yml").write_text("DEFAULT_MAX_TIME: 180\n", encoding="utf-8")
+            (deployment_dir / "resources.yml").write_text("resource-1:\n  url: http://example.invalid/lab1\n  login: user\n  password: pass\n", encoding="utf-8")
+            (deployment_dir / "laboratories.yml").write_text("lab-1:\n  resources: [resource-1]\n", encoding="utf-8")
+            (deployment_dir / "credentials.yml").write_text("administrators: {}\nexternal: {}\n", encoding="utf-8")
+
+            app = Flask(__name__)
+            app.config["LABDISCOVERYENGINE_DIRECTORY"] = str(deployment_dir)
+            app.config["CONFIGURATION_CACHE"] = False
+
+            with app.app_context():
+                config = get_latest_configuration()
+                self.assertEqual(180, app.config["DEFAULT_MAX_TIME"])
+
+                # New variables, but a resource without url: the reload is rejected...
+                (deployment_dir / "configuration.yml").write_text("DEFAULT_MAX_TIME: 300\n", encoding="utf-8")
+                (deployment_dir / "resources.yml").write_text("resource-1:\n  login: user\n  password: pass\n", encoding="utf-8")
+                for configuration_type in (ConfigurationFileNames.configuration, ConfigurationFileNames.resources):
+                    config.last_check[configuration_type] = datetime.datetime.utcfromtimestamp(0)
+
+                with self.assertRaises(InvalidConfigurationValueError):
+                    get_latest_configuration(config)
+
+                # ... and so are its variables
+                self.assertEqual(180, app.config["DEFAULT_MAX_TIME"])
+
+    def test_reload_of_resources_rebuilds_laboratories(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            deployment_dir = Path(tmpdir)
+            (deployment_dir / "configuration.yml").write_text("DEFAULT_RESOURCE_LOGIN: user\nDEFAULT_RESOURCE_PASSWORD: pass\n", encoding="utf-8")
+            (deployment_dir / "resources.yml").write_text(
+                "r1:\n  url: http://example.invalid/r1\n  features: [camera]\n"
+                "r2:\n  url: http://example.invalid/r2\n  features: [arm]\n",
+                encoding="utf-8",
+            )
+            (deployment_dir / "laboratories.yml").write_text("lab:\n  resources: [r1, r2]\n", encoding="utf-8")
+            (deployment_dir / "credentials.yml").write_text("administrators: {}\nexternal:\n  tester:\n    password: hash\n    laboratories: all\n", encoding="utf-8")
+
+            app = Flask(__name__)
+            app.config["LABDISCOVERYENGINE_DIRECTORY"] = str(deployment_dir)
+            app.config["CONFIGURATION_CACHE"] = False
+
+            with app.app_context():
+                config = get_latest_configuration()
+                self.assertEqual({"r1", "r2"}, config.laboratories["lab"].resources)
+                self.assertEqual({"camera", "arm"}, config.laboratories["lab"].features)
+
+                # Only resources.yml changes: r2 is still used by the laboratory, as in a cold start
+                (deployment_dir / "resources.yml").write_text("r1:\n  url: http://example.invalid/r1\n  features: [camera]\n", encoding="utf-8")
+                config.last_check[ConfigurationFileNames.resources] = datetime.datetime.utcfromtimestamp(0)
+
+                with self.assertRaises(InvalidConfigurationValueError):
+                    get_latest_configuration(config)
+                with self.assertRaises(InvalidConfigurationValueError):
+                    get_latest_configuration()
+
+                # Once the laboratory does not use it either, the features are updated too
+                (deployment_dir / "resources.yml").write_text(
+                    "r1:\n  url: http://example.invalid/r1\n  features: [camera]\n"
+                    "r2:\n  url: http://example.invalid/r2\n  features: [gripper]\n",
+                    encoding="utf-8",
+                )
+                config.last_check[ConfigurationFileNames.resources] = datetime.datetime.utcfromtimestamp(0)
+                config = get_latest_configuration(config)
+
+            self.assertEqual({"r1", "r2"}, config.laboratories["lab"].resources)
+            self.assertEqual({"camera", "gripper"}, config.laboratories["lab"].features)
+            self.assertEqual({"lab"}, config.external_users["tester"].laboratories)
+
+    def test_configuration_reloader_is_throttled(self):
+        app = Flask(__name__)
+        app.config["CONFIGURATION_RELOAD_INTERVAL"] = 5
+        app.config["LDE_CONFIG"] = "previous"
+
+        reloader = ConfigurationReloader(app)
+        with mock.patch("labdiscoveryengine.configuration.storage.get_latest_configuration", return_value="new") as mocked_reload:
+            with app.app_context():
+                reloader.reload_if_needed()
+                self.assertEqual("previous", app.config["LDE_CONFIG"])
+
+                reloader.last_check -= 10
+                reloader.reload_if_needed()
+                reloader.reload_if_needed()
+
+        mocked_reload.assert_called_once_with("previous")
+        self.assertEqual("new", app.config["LDE_CONFIG"])
+
+    def test_cold_start_reuses_configuration_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            deployment_dir = Path(tmpdir)
+            (deployment_dir / "configuration.yml").write_text("DEFAULT_RESOURCE_LOGIN: user\nDEFAULT_RESOURCE_PASSWORD: pass\n", encoding="utf-8")
+            (deployment_dir / "resources.yml").write_text("resource-1:\n  url: http://example.invalid/lab1\n", encoding="utf-8")
+            (deployment_dir / "laboratories.yml").write_text("lab-1:\n  resources: [resource-1]\n", encoding="utf-8")
+            (deployment_dir / "credentials.yml").write_text("administrators: {}\n", encoding="utf-8")
+
+            app = Flask(__name__)
+            app.config["LABDISCOVERYENGINE_DIRECTORY"] = str(deployment_dir)
+
+            with app.app_context():
+                config = get_latest_configuration()
+                self.assertEqual(1, len(list((deployment_dir / ".lde-cache").glob("configuration-*.pickle"))))
+
+                # Same files: YAML is not parsed again
+                with mock.patch("labdiscoveryengine.configuration.storage.load_yaml", side_effect=AssertionError("parsed")):
+                    cached_config = get_latest_configuration()
+                self.assertEqual(config.resources, cached_config.resources)
+                self.assertEqual(config.laboratories, cached_config.laboratories)
+                self.assertEqual("user", app.config["DEFAULT_RESOURCE_LOGIN"])
+
+                # Different files: parsed again, and the previous snapshot is replaced
+                (deployment_dir / "resources.yml").write_text("resource-1:\n  url: http://example.invalid/other\n", encoding="utf-8")
+                config = get_latest_configuration()
+                self.assertEqual("http://example.invalid/other", config.resources["resource-1"].url)
+                self.assertEqual(1, len(list((deployment_dir / ".lde-cache").glob("configuration-*.pickle"))))
@@ -0,0 +1,94 @@
+import json
+import time
+import unittest
+from unittest import mock
+
+from labdiscoveryengine.scheduling.asyncio.passive_health import PassiveHealthSignals, ResourcePassiveHealth
+from labdiscoveryengine.scheduling.data import ResourceHealth
+from labdiscoveryengine.scheduling.sync.web_api import get_resource_health
+
+
+class ResourcePassiveHealthTestCase(unittest.TestCase):
+    def test_probation_after_consecutive_failures(self):
+        resource_health = ResourcePassiveHealth("robot-1", failures=3, probation=60)
+
+        resource_health.record_failure(PassiveHealthSignals.start_failed, "Connection refused", now=1000)
+        resource_health.record_failure(PassiveHealthSignals.start_failed, "Connection refused", now=1000)
+        self.assertFalse(resource_health.in_probation(now=1000))
+
+        resource_health.record_failure(PassiveHealthSignals.start_failed, "Connection refused", now=1000)
+        self.assertTrue(resource_health.in_probation(now=1000))
+        self.assertFalse(resource_health.in_probation(now=1061))
+
+        # The trial after the probation fails: back to probation, for longer
+        resource_health.record_failure(PassiveHealthSignals.start_failed, "Connection refused", now=1061)
+        self.assertTrue(resource_health.in_probation(now=1061 + 119))
+
+        # The next trial works: recovered
+        self.assertTrue(resource_health.record_success(latency=1.0))
+        self.assertFalse(resource_health.in_probation(now=1061))
+        self.assertEqual(0, resource_health.probations)
+
+    def test_success_resets_the_failures(self):
+        resource_health = ResourcePassiveHealth("robot-1", failures=3, probation=60)
+
+        resource_health.record_failure(PassiveHealthSignals.start_failed, "Connection refused", now=1000)
+        resource_health.record_failure(PassiveHealthSignals.finish_failed, "Connection refused", now=1000)
+        resource_health.record_success()
+        resource_health.record_failure(PassiveHealthSignals.start_failed, "Connection refused", now=1000)
+
+        self.assertFalse(resource_health.in_probation(now=1000))
+        self.assertEqual(1, resource_health.consecutive_failures)
+
+    def test_latency_outliers_count_as_failures(self):
+        resource_health = ResourcePassiveHealth("robot-1", failures=1, probation=60)
+
+        for latency in [1.0, 1.2, 0.9, 1.1] * 5:
+            self.assertFalse(resource_health.record_success(latency=latency))
+
+        # Slower, but not an outlier
+        resource_health.record_success(latency=1.5)
+        self.assertFalse(resource_health.in_probation())
+
+        resource_health.record_success(latency=30)
+        self.assertTrue(resource_health.in_probation())
+        self.assertEqual(PassiveHealthSignals.slow_start, resource_health.last_signal)
+
+    def test_permanently_slower_devices_recover(self):
+        resource_health = ResourcePassiveHealth("robot-1", failures=1, probation=60)
+        for latency in [1.0, 1.2, 0.9, 1.1] * 5:
+            resource_health.record_success(latency=latency)
+
+        # e.g., new firmware: every session now takes 30 seconds to start
+        trials = 0
+        now = 1000
+        while resource_health.record_success(latency=30) is False or resource_health.in_probation(now=now):
+            now = resource_health.probation_until
+            trials += 1
+            self.assertLess(trials, 5)
+
+        self.assertFalse(resource_health.in_probation(now=now))
+        self.assertEqual(0, resource_health.probations)
+
+
+class WebPassiveHealthTestCase(unittest.TestCase):
+    def _get_resource_health(self, health, passive_health):
+        with mock.patch("labdiscoveryengine.scheduling.sync.web_api.redis_store.hgetall", return_value=health, create=True), \
+                mock.patch("labdiscoveryengine.scheduling.sync.web_api.redis_store.get", return_value=passive_health, create=True):
+            return get_resource_health("robot-1")
+
+    def test_resources_on_probation_are_broken(self):
+        passive_health = json.dumps({ 'probation_until': time.time() + 60, 'last_signal': PassiveHealthSignals.start_failed, 'last_message': 'Connection refused' })
+
+        health = self._get_resource_health({ 'status': ResourceHealth.states.healthy }, passive_health)
+
+        self.assertTrue(health.is_broken)
+        self.assertEqual("passive", health.source)
+        self.assertIn("Connection refused", health.message)
+
+    def test_probation_is_over(self):
+        passive_health = json.dumps({ 'probation_until': time.time() - 1, 'last_signal': PassiveHealthSignals.start_failed })
+
+        health = self._get_resource_health({ 'status': ResourceHealth.states.healthy }, passive_health)
+
+        self.assertEqual(ResourceHealth.states.healthy, health.status)
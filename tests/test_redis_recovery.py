@@ -0,0 +1,107 @@
+import json
+import datetime
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from labdiscoveryengine.scheduling.data import ReservationRequest
+from labdiscoveryengine.scheduling.keys import ReservationKeys
+from labdiscoveryengine.scheduling.asyncio import recovery
+
+
+def _metadata(identifier: str) -> str:
+    return json.dumps(ReservationRequest(
+        identifier=identifier, laboratory='lab', features=[], resources=['resource-1', 'resource-2'],
+        user_identifier='user', user_role='external', locale='en', max_time=300, back_url='http://back.example',
+    ).todict())
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, *args):
+        return self
+
+    async def to_list(self, length):
+        return self.documents
+
+
+class FakePipeline:
+    def __init__(self, commands):
+        self.commands = commands
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    async def execute(self):
+        pass
+
+
+class RedisRecoveryTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.sessions = [
+            # Waiting in the queue
+            { 'reservation_id': 'queued', 'metadata': _metadata('queued'), 'start': None, 'assigned_resource': None },
+            # Running in the laboratory
+            { 'reservation_id': 'running', 'metadata': _metadata('running'), 'start': datetime.datetime.utcnow(),
+              'assigned_resource': 'resource-1', 'session_id': 'session-1', 'url': 'http://lab.example/session-1' },
+            # Finished in the laboratory, but not disposed
+            { 'reservation_id': 'finished', 'metadata': _metadata('finished'), 'start': datetime.datetime.utcnow(),
+              'assigned_resource': 'resource-2', 'session_id': 'session-2', 'url': 'http://lab.example/session-2' },
+            # Requested before the metadata was stored
+            { 'reservation_id': 'old', 'start': None },
+            # Cancelled by the user while waiting in the queue
+            { 'reservation_id': 'cancelled', 'metadata': _metadata('cancelled'), 'start': None, 'assigned_resource': None,
+              'status': ReservationKeys.states.cancelling },
+            # Cancelled by the user while running (still running in the laboratory)
+            { 'reservation_id': 'cancelled-running', 'metadata': _metadata('cancelled-running'), 'start': datetime.datetime.utcnow(),
+              'assigned_resource': 'resource-1', 'session_id': 'session-1', 'url': 'http://lab.example/session-1',
+              'status': ReservationKeys.states.cancelling },
+        ]
+        self.find = mock.Mock(return_value=FakeCursor(self.sessions))
+        self.commands = []
+        self.store_reservation = mock.AsyncMock()
+
+        configuration = SimpleNamespace(resources={ 'resource-1': SimpleNamespace(identifier='resource-1'),
+                                                    'resource-2': SimpleNamespace(identifier='resource-2') })
+
+        async def is_session_running(resource, session_id):
+            return session_id == 'session-1'
+
+        patchers = [
+            mock.patch.object(recovery, 'async_mongo', SimpleNamespace(sessions=SimpleNamespace(find=self.find))),
+            mock.patch.object(recovery, 'aioredis_store', SimpleNamespace(pipeline=lambda: FakePipeline(self.commands))),
+            mock.patch.object(recovery, 'async_lua_scripts', SimpleNamespace(store_reservation=self.store_reservation)),
+            mock.patch.object(recovery, 'worker_config', SimpleNamespace(current=configuration)),
+            mock.patch.object(recovery, 'is_session_running', is_session_running),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _restored_status(self, reservation_id: str) -> str:
+        for name, args, kwargs in self.commands:
+            if name == 'hset' and args[0] == ReservationKeys(reservation_id).base():
+                return kwargs['mapping'][ReservationKeys.parameters.status]
+
+    async def test_reservations_are_restored(self):
+        now = datetime.datetime(2024, 1, 1, 12, 0)
+        result = await recovery.recover_from_mongodb(now=now)
+
+        self.assertEqual(recovery.RecoveryResult(queued=1, running=1, finishing=2, skipped=2), result)
+
+        # Only the reservations that could still be in Redis (and not over, e.g. broken)
+        query = self.find.call_args.args[0]
+        self.assertIsNone(query['end_reservation'])
+        self.assertIn(ReservationKeys.states.broken, query['status']['$nin'])
+        self.assertEqual(now - datetime.timedelta(hours=1), query['start_reservation']['$gte'])
+
+        self.store_reservation.assert_awaited_once()
+        self.assertEqual('queued', self.store_reservation.await_args.args[0].identifier)
+
+        self.assertEqual(ReservationKeys.states.ready, self._restored_status('running'))
+        self.assertEqual(ReservationKeys.states.finishing, self._restored_status('finished'))
+        self.assertEqual(ReservationKeys.states.finishing, self._restored_status('cancelled-running'))
+        self.assertIn(('setex', ('lde:resources:resource-1:assigned', recovery.RESERVATION_MAX_AGE, 'running'), {}), self.commands)
+        self.assertIn(('sadd', ('lde:users:user:reservations', 'running'), {}), self.commands)
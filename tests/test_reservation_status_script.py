@@ -1,3 +1,4 @@
+import json
 import socket
 import subprocess
 import tempfile
@@ -9,7 +10,8 @@ import redis
 
 
 ROOT = Path(__file__).resolve().parents[1]
-SCRIPT_PATH = ROOT / "labdiscoveryengine" / "lua" / "get_reservation_status.lua"
+LUA_PATH = ROOT / "labdiscoveryengine" / "lua"
+SCRIPT_PATH = LUA_PATH / "get_reservation_status.lua"
 REDIS_SERVER = "/opt/homebrew/bin/redis-server"
 
 
@@ -67,6 +69,9 @@ class ReservationStatusLuaScriptTestCase(unittest.TestCase):
         self.redis.flushdb()
         self.script = self.redis.register_script(SCRIPT_PATH.read_text(encoding="utf-8"))
 
+    def register_script(self, name: str):
+        return self.redis.register_script((LUA_PATH / name).read_text(encoding="utf-8"))
+
     def test_pending_status_is_preserved_when_reservation_leaves_queue_before_hash_updates(self):
         reservation_id = "res-1"
         reservation_key = f"lde:reservations:{reservation_id}"
@@ -75,10 +80,158 @@ class ReservationStatusLuaScriptTestCase(unittest.TestCase):
         self.redis.sadd(f"{reservation_key}:resources", "boolean-s1i3")
         self.redis.zadd("lde:resources:boolean-s1i3:queues:priorities", {"normal": 0})
 
-        status, external_session_id, position, url, message = self.script(args=[reservation_id])
+        status, external_session_id, position, url, message, estimated_wait = self.script(args=[reservation_id])
 
         self.assertEqual("pending", status)
         self.assertFalse(external_session_id)
         self.assertFalse(position)
         self.assertFalse(url)
         self.assertFalse(message)
+        self.assertFalse(estimated_wait)
+
+    def test_queued_reservation_estimates_the_wait(self):
+        reservation_id = "res-1"
+        reservation_key = f"lde:reservations:{reservation_id}"
+
+        self.redis.hset(reservation_key, mapping={"status": "queued", "laboratory": "boolean", "metadata": json.dumps({"max_time": 300})})
+        for resource in ("boolean-s1i3", "boolean-s1i4"):
+            self.redis.sadd(f"{reservation_key}:resources", resource)
+            self.redis.zadd(f"lde:resources:{resource}:queues:priorities", {"5": 5})
+            self.redis.rpush(f"lde:resources:{resource}:queues:5", "res-0", "res-00", reservation_id)
+
+        # No sessions yet: max_time
+        status, _, position, _, _, estimated_wait = self.script(args=[reservation_id])
+        self.assertEqual("queued", status)
+        self.assertEqual(2, position)
+        self.assertEqual(450, estimated_wait)
+
+        self.redis.hset("lde:laboratories:boolean:stats", mapping={"sessions": 10, "mean_duration": "61.5"})
+        *_, estimated_wait = self.script(args=[reservation_id])
+        self.assertEqual(92, estimated_wait)
+
+    def _queued_in(self, resource: str, priority: int = 3):
+        return self.redis.lrange(f"lde:resources:{resource}:queues:{priority}", 0, -1)
+
+    def test_requeue_skips_the_resources_already_tried(self):
+        requeue = self.register_script("requeue_reservation.lua")
+        reservation_key = "lde:reservations:res-1"
+        self.redis.hset(reservation_key, mapping={"status": "initializing", ":assigned": "robot-1"})
+        self.redis.sadd(f"{reservation_key}:resources", "robot-1", "robot-2", "robot-3")
+        self.redis.rpush("lde:resources:robot-2:queues:3", "res-0", "res-1")
+
+        self.assertEqual(2, requeue(args=["res-1", "robot-1", 3, 3]))
+        self.assertEqual("queued", self.redis.hget(reservation_key, "status"))
+        self.assertIsNone(self.redis.hget(reservation_key, ":assigned"))
+        self.assertEqual([], self._queued_in("robot-1"))
+        # Moved to the head, only once
+        self.assertEqual(["res-1", "res-0"], self._queued_in("robot-2"))
+        self.assertEqual(["res-1"], self._queued_in("robot-3"))
+
+        # robot-2 fails too: only robot-3 is left
+        self.redis.delete("lde:resources:robot-2:queues:3", "lde:resources:robot-3:queues:3")
+        self.redis.hset(reservation_key, "status", "initializing")
+        self.assertEqual(1, requeue(args=["res-1", "robot-2", 3, 5]))
+        self.assertEqual([], self._queued_in("robot-2"))
+        self.assertEqual(["res-1"], self._queued_in("robot-3"))
+
+        # And when robot-3 fails there is nothing left to try
+        self.assertEqual(0, requeue(args=["res-1", "robot-3", 3, 5]))
+
+    def test_requeue_stops_after_max_attempts(self):
+        requeue = self.register_script("requeue_reservation.lua")
+        reservation_key = "lde:reservations:res-1"
+        self.redis.hset(reservation_key, "status", "initializing")
+        self.redis.sadd(f"{reservation_key}:resources", "robot-1", "robot-2", "robot-3")
+
+        self.assertEqual(2, requeue(args=["res-1", "robot-1", 3, 2]))
+        self.assertEqual(0, requeue(args=["res-1", "robot-2", 3, 2]))
+
+    def test_requeue_ignores_cancelled_reservations(self):
+        requeue = self.register_script("requeue_reservation.lua")
+        reservation_key = "lde:reservations:res-1"
+        self.redis.hset(reservation_key, "status", "cancelling")
+        self.redis.sadd(f"{reservation_key}:resources", "robot-1", "robot-2")
+
+        self.assertEqual(0, requeue(args=["res-1", "robot-1", 3, 3]))
+        self.assertEqual("cancelling", self.redis.hget(reservation_key, "status"))
+        self.assertEqual([], self._queued_in("robot-2"))
+        self.assertFalse(self.redis.exists(f"{reservation_key}:tried"))
+
+    def test_admission_buckets_refill_over_time(self):
+        admit = self.register_script("admit_reservation.lua")
+        # 60 per minute (one per second), up to 2 at once
+        args = [0, 1, "robot-1", "user", "student-1", 60, 2]
+
+        self.assertEqual([1, None, 0], admit(args=[1000] + args))
+        self.assertEqual([1, None, 0], admit(args=[1000] + args))
+        self.assertEqual([0, "user", 1000], admit(args=[1000] + args))
+        # Half a token later
+        self.assertEqual([0, "user", 500], admit(args=[1000.5] + args))
+        self.assertEqual([1, None, 0], admit(args=[1001] + args))
+
+        # Other users have their own bucket
+        self.assertEqual([1, None, 0], admit(args=[1001, 0, 1, "robot-1", "user", "student-2", 60, 2]))
+
+        stats = self.redis.hgetall("lde:admission:stats")
+        self.assertEqual({"admitted": "4", "rejected:user": "2"}, stats)
+
+    def test_admission_takes_tokens_only_when_every_bucket_has_one(self):
+        admit = self.register_script("admit_reservation.lua")
+        buckets = ["laboratory", "robots", 60, 10, "user", "student-1", 1, 1]
+
+        self.assertEqual([1, None, 0], admit(args=[1000, 0, 0] + buckets))
+        self.assertEqual([0, "user", 60000], admit(args=[1000, 0, 0] + buckets))
+        # The rejected reservation did not take a token of the laboratory
+        self.assertEqual("9", self.redis.hget("lde:admission:buckets:laboratory:robots", "tokens"))
+
+    def test_admission_sheds_when_every_queue_is_full(self):
+        admit = self.register_script("admit_reservation.lua")
+        for resource, reservations in (("robot-1", ["res-1", "res-2"]), ("robot-2", ["res-3"])):
+            self.redis.zadd(f"lde:resources:{resource}:queues:priorities", {"3": 3})
+            self.redis.rpush(f"lde:resources:{resource}:queues:3", *reservations)
+
+        self.assertEqual([0, "queue-full", 0], admit(args=[1000, 1, 2, "robot-1", "robot-2"]))
+        # robot-2 still has room for one more
+        self.assertEqual([1, None, 0], admit(args=[1000, 2, 2, "robot-1", "robot-2"]))
+        self.assertEqual({"shed": "1", "admitted": "1"}, self.redis.hgetall("lde:admission:stats"))
+
+    def test_warm_candidates_take_the_next_reservation(self):
+        has_warm_candidate = self.register_script("has_warm_candidate.lua")
+        reservation_key = "lde:reservations:res-1"
+        self.redis.hset(reservation_key, "laboratory", "robots")
+        self.redis.sadd(f"{reservation_key}:resources", "robot-1", "robot-2")
+        self.redis.zadd("lde:resources:robot-1:queues:priorities", {"3": 3})
+        self.redis.rpush("lde:resources:robot-1:queues:3", "res-1")
+
+        # Nothing prepared
+        self.assertIsNone(has_warm_candidate(args=["robot-1", 1000]))
+
+        # Prepared, but not among the resources of the reservation, or no longer confirmed
+        self.redis.zadd("lde:laboratories:robots:warm", {"robot-1": 1030, "robot-3": 1030, "robot-2": 990})
+        self.assertIsNone(has_warm_candidate(args=["robot-1", 1000]))
+
+        self.redis.zadd("lde:laboratories:robots:warm", {"robot-2": 1100})
+        self.assertEqual("robot-2", has_warm_candidate(args=["robot-1", 1000]))
+
+        # Not if it is broken or on probation
+        self.redis.hset("lde:resources:robot-2:health", "status", "broken")
+        self.assertIsNone(has_warm_candidate(args=["robot-1", 1000]))
+        self.redis.hset("lde:resources:robot-2:health", "status", "healthy")
+        self.redis.set("lde:resources:robot-2:health:passive", json.dumps({"probation_until": 1060}))
+        self.assertIsNone(has_warm_candidate(args=["robot-1", 1000]))
+        self.assertEqual("robot-2", has_warm_candidate(args=["robot-1", 1061]))
+
+        # Nor once another resource took the reservation
+        self.redis.hset(reservation_key, ":assigned", 1)
+        self.assertIsNone(has_warm_candidate(args=["robot-1", 1061]))
+
+    def test_locks_are_only_released_by_their_owner(self):
+        release_lock = self.register_script("release_lock.lua")
+        self.redis.set("lde:retention", "worker-2", nx=True, px=60000)
+
+        # e.g., the lock of worker-1 expired and worker-2 took it
+        self.assertEqual(0, release_lock(keys=["lde:retention"], args=["worker-1"]))
+        self.assertEqual("worker-2", self.redis.get("lde:retention"))
+
+        self.assertEqual(1, release_lock(keys=["lde:retention"], args=["worker-2"]))
+        self.assertIsNone(self.redis.get("lde:retention"))
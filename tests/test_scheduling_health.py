@@ -1,11 +1,15 @@
 import unittest
 import json
+import datetime
+import time
 from types import SimpleNamespace
 from unittest import mock
 
-from labdiscoveryengine.scheduling.data import ReservationRequest, ReservationStatus, ResourceHealth
-from labdiscoveryengine.scheduling.keys import ReservationKeys
-from labdiscoveryengine.scheduling.sync.web_api import add_reservation, cancel_reservation
+from flask import Flask
+
+from labdiscoveryengine.scheduling.data import AdmissionDecision, AdmissionScopes, ReservationRequest, ReservationStatus, ResourceHealth, ResourceUptime
+from labdiscoveryengine.scheduling.keys import ReservationKeys, WebKeys
+from labdiscoveryengine.scheduling.sync.web_api import add_reservation, admit_reservation, cancel_reservation, get_reservation_status, suggest_polling
 
 
 def _reservation_request(resources):
@@ -68,7 +72,7 @@ class SchedulingHealthTestCase(unittest.TestCase):
         }
         reservation_status = ReservationStatus(status=ReservationKeys.states.queued, reservation_id="reservation-1", position=0)
 
-        with mock.patch("labdiscoveryengine.scheduling.sync.web_api.lde_config", self._config()), \
+        with mock.patch("labdiscoveryengine.scheduling.sync.web_api.get_lde_config", return_value=self._config()), \
                 mock.patch("labdiscoveryengine.scheduling.sync.web_api.get_resource_health", side_effect=lambda resource: statuses[resource]), \
                 mock.patch("labdiscoveryengine.scheduling.sync.web_api.is_mongo_active", return_value=False), \
                 mock.patch("labdiscoveryengine.scheduling.sync.web_api.sync_lua_scripts.store_reservation") as store_reservation, \
@@ -86,7 +90,7 @@ class SchedulingHealthTestCase(unittest.TestCase):
             "robot-2": ResourceHealth(resource="robot-2", status=ResourceHealth.states.broken, message="no-movement"),
         }
 
-        with mock.patch("labdiscoveryengine.scheduling.sync.web_api.lde_config", self._config()), \
+        with mock.patch("labdiscoveryengine.scheduling.sync.web_api.get_lde_config", return_value=self._config()), \
                 mock.patch("labdiscoveryengine.scheduling.sync.web_api.get_resource_health", side_effect=lambda resource: statuses[resource]), \
                 mock.patch("labdiscoveryengine.scheduling.sync.web_api.is_mongo_active", return_value=False), \
                 mock.patch("labdiscoveryengine.scheduling.sync.web_api.redis_store.pipeline", return_value=pipeline, create=True), \
@@ -107,7 +111,7 @@ class SchedulingHealthTestCase(unittest.TestCase):
         }
         reservation_status = ReservationStatus(status=ReservationKeys.states.queued, reservation_id="reservation-1", position=0)
 
-        with mock.patch("labdiscoveryengine.scheduling.sync.web_api.lde_config", self._config(bypass=True)), \
+        with mock.patch("labdiscoveryengine.scheduling.sync.web_api.get_lde_config", return_value=self._config(bypass=True)), \
                 mock.patch("labdiscoveryengine.scheduling.sync.web_api.get_resource_health", side_effect=lambda resource: statuses[resource]), \
                 mock.patch("labdiscoveryengine.scheduling.sync.web_api.is_mongo_active", return_value=False), \
                 mock.patch("labdiscoveryengine.scheduling.sync.web_api.sync_lua_scripts.store_reservation") as store_reservation, \
@@ -135,3 +139,148 @@ class SchedulingHealthTestCase(unittest.TestCase):
 
         self.assertFalse(result)
         srem.assert_called_once()
+
+
+class ResourceUptimeTestCase(unittest.TestCase):
+    def test_uptime_is_weighted_by_time(self):
+        start = datetime.datetime(2024, 1, 1, 12, 0)
+
+        def entry(minutes, status):
+            timestamp = (start + datetime.timedelta(minutes=minutes)).replace(tzinfo=datetime.timezone.utc).timestamp()
+            return (f"{int(timestamp * 1000)}-0", {"status": status, "latency": "0.100"})
+
+        entries = [
+            entry(0, ResourceHealth.states.healthy),
+            entry(30, ResourceHealth.states.broken),
+            # Unknown periods are not counted
+            entry(40, ResourceHealth.states.unknown),
+            entry(50, ResourceHealth.states.healthy),
+        ]
+
+        uptime = ResourceUptime.fromhistory("robot-1", entries, now=start + datetime.timedelta(minutes=60))
+
+        self.assertAlmostEqual(100.0 * 40 / 50, uptime.uptime)
+        self.assertEqual(start, uptime.since)
+        self.assertEqual(3, uptime.changes)
+
+    def test_no_history(self):
+        self.assertIsNone(ResourceUptime.fromhistory("robot-1", [], now=datetime.datetime.utcnow()).uptime)
+
+
+class ReservationStatusTestCase(unittest.TestCase):
+    def test_estimated_wait_only_while_queued(self):
+        queued = ReservationStatus(status=ReservationKeys.states.queued, reservation_id="reservation-1", position=2, estimated_wait=90)
+        self.assertEqual(90, queued.todict()['estimated_wait'])
+        self.assertEqual(queued, ReservationStatus.fromdict(queued.todict()))
+
+        ready = ReservationStatus(status=ReservationKeys.states.ready, reservation_id="reservation-1", url="https://lab.example", estimated_wait=90)
+        self.assertNotIn('estimated_wait', ready.todict())
+
+
+class SuggestPollingTestCase(unittest.TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        app.config.update(STATUS_MAX_RETRY_AFTER=30, STATUS_TARGET_POLLERS=100)
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+    def _queued(self, position, estimated_wait=None):
+        return ReservationStatus(status=ReservationKeys.states.queued, reservation_id="reservation-1", position=position, estimated_wait=estimated_wait)
+
+    def test_clients_back_off_down_the_queue(self):
+        first = suggest_polling(self._queued(0, estimated_wait=60), pollers=10)
+        self.assertEqual(0, first.retry_after)
+        self.assertEqual(20, first.suggested_max_time)
+
+        third = suggest_polling(self._queued(2, estimated_wait=60), pollers=10)
+        self.assertEqual(15, third.retry_after)
+
+        # Capped
+        last = suggest_polling(self._queued(50, estimated_wait=3000), pollers=10)
+        self.assertEqual(30, last.retry_after)
+
+        # Without estimation
+        self.assertEqual(6, suggest_polling(self._queued(3), pollers=10).retry_after)
+
+    def test_clients_back_off_under_load(self):
+        status = suggest_polling(self._queued(2, estimated_wait=20), pollers=300)
+        self.assertEqual(15, status.retry_after)
+        self.assertEqual(7, status.suggested_max_time)
+
+        # It is still their turn
+        initializing = ReservationStatus(status=ReservationKeys.states.initializing, reservation_id="reservation-1")
+        self.assertEqual(0, suggest_polling(initializing, pollers=300).retry_after)
+
+    def test_no_suggestion_for_finished_reservations(self):
+        finished = ReservationStatus(status=ReservationKeys.states.finished, reservation_id="reservation-1")
+        self.assertNotIn('retry_after', suggest_polling(finished, pollers=10).todict())
+
+    def _get_reservation_status(self, statuses, max_time, pollers=10):
+        pipeline = mock.Mock(execute=mock.Mock(return_value=[1, 0, pollers, True]))
+        pubsub = mock.MagicMock()
+        pubsub.__enter__.return_value.get_message.return_value = None
+        lua_scripts = SimpleNamespace(get_reservation_status=mock.Mock(side_effect=statuses))
+        store = SimpleNamespace(
+            smembers=mock.Mock(return_value={"reservation-1"}), zcount=mock.Mock(return_value=pollers),
+            pipeline=mock.Mock(return_value=pipeline), pubsub=mock.Mock(return_value=pubsub), zrem=mock.Mock(),
+        )
+        with mock.patch("labdiscoveryengine.scheduling.sync.web_api.redis_store", store), \
+                mock.patch("labdiscoveryengine.scheduling.sync.web_api.sync_lua_scripts", lua_scripts):
+            status = get_reservation_status("user-1", "reservation-1", previous_reservation_status=self._queued(3), max_time=max_time)
+        return status, store, pipeline
+
+    def test_suggested_max_time_does_not_shrink(self):
+        # Clients send back the suggested max_time
+        max_time = 20
+        for _ in range(3):
+            status, _, _ = self._get_reservation_status([self._queued(2, estimated_wait=20)], max_time=max_time, pollers=300)
+            self.assertEqual(7, status.suggested_max_time)
+            max_time = status.suggested_max_time
+
+    def test_waiting_requests_are_counted_until_they_finish(self):
+        status, store, pipeline = self._get_reservation_status([self._queued(3), self._queued(2)], max_time=5)
+
+        self.assertEqual(2, status.position)
+        (poller, deadline), = pipeline.zadd.call_args.args[1].items()
+        self.assertAlmostEqual(time.time() + 5, deadline, delta=2)
+        # Requests of processes that died while waiting are purged
+        self.assertEqual('-inf', pipeline.zremrangebyscore.call_args.args[1])
+        store.zrem.assert_called_once_with(WebKeys.pollers(), poller)
+
+
+class AdmissionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(RESERVATIONS_PER_MINUTE_PER_EXTERNAL_USER=600, RESERVATIONS_PER_MINUTE_PER_USER=10,
+                               RESERVATIONS_PER_MINUTE_PER_LABORATORY=0, MAX_QUEUE_DEPTH=100, STATUS_MAX_RETRY_AFTER=30)
+        context = self.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+    def _admit(self, reservation_request, result):
+        with mock.patch("labdiscoveryengine.scheduling.sync.web_api.sync_lua_scripts._run_lua_script", return_value=result) as run_lua_script:
+            return admit_reservation(reservation_request), run_lua_script.call_args.kwargs['args']
+
+    def test_buckets_of_external_students(self):
+        reservation_request = _reservation_request(["robot-1", "robot-2"])._replace(user_identifier="labsland", user_role="external", external_user_identifier="student-1")
+
+        decision, args = self._admit(reservation_request, [1, None, 0])
+
+        self.assertEqual(AdmissionDecision(admitted=True), decision)
+        # now, max_queue_depth, resources, and the buckets (disabled ones are not sent)
+        self.assertEqual([100, 2, "robot-1", "robot-2"], args[1:5])
+        self.assertEqual([AdmissionScopes.external, "labsland", 600, 600, AdmissionScopes.user, "student-1@labsland", 10, 10], args[5:])
+
+    def test_rejected(self):
+        decision, _ = self._admit(_reservation_request(["robot-1"]), [0, AdmissionScopes.user, 5500])
+        self.assertEqual(AdmissionDecision(admitted=False, reason=AdmissionScopes.user, retry_after=6), decision)
+
+        decision, _ = self._admit(_reservation_request(["robot-1"]), [0, AdmissionScopes.queue_full, 0])
+        self.assertEqual(30, decision.retry_after)
+
+    def test_all_limits_disabled(self):
+        self.app.config.update(RESERVATIONS_PER_MINUTE_PER_EXTERNAL_USER=0, RESERVATIONS_PER_MINUTE_PER_USER=0, MAX_QUEUE_DEPTH=0)
+        with mock.patch("labdiscoveryengine.scheduling.sync.web_api.sync_lua_scripts._run_lua_script") as run_lua_script:
+            self.assertTrue(admit_reservation(_reservation_request(["robot-1"])).admitted)
+        run_lua_script.assert_not_called()
@@ -0,0 +1,43 @@
+import csv
+import datetime
+import io
+import unittest
+
+from labdiscoveryengine.history.export import EXPORT_FIELDS, build_sessions_query, iter_csv_chunks, write_csv
+
+
+class SessionExportTestCase(unittest.TestCase):
+    def test_build_sessions_query(self):
+        self.assertEqual({}, build_sessions_query())
+
+        since = datetime.datetime(2024, 3, 1)
+        until = datetime.datetime(2024, 4, 1)
+        query = build_sessions_query(since=since, until=until, laboratories=["robot-lab"])
+        self.assertEqual({"$gte": since, "$lt": until}, query["start_reservation"])
+        self.assertEqual("robot-lab", query["laboratory"])
+
+        query = build_sessions_query(laboratories=["robot-lab", "fpga-lab"])
+        self.assertEqual({"$in": ["robot-lab", "fpga-lab"]}, query["laboratory"])
+
+    def test_iter_csv_chunks(self):
+        sessions = [
+            {"reservation_id": str(i), "laboratory": "robot-lab", "resources": ["robot-1", "robot-2"],
+             "start_reservation": datetime.datetime(2024, 3, 1, 10, i)}
+            for i in range(5)
+        ]
+
+        chunks = list(iter_csv_chunks(iter(sessions), rows_per_chunk=2))
+        # header + 2 rows, 2 rows, 1 row
+        self.assertEqual(3, len(chunks))
+
+        rows = list(csv.DictReader(io.StringIO(''.join(chunks))))
+        self.assertEqual(EXPORT_FIELDS, list(rows[0].keys()))
+        self.assertEqual(5, len(rows))
+        self.assertEqual("robot-1;robot-2", rows[0]["resources"])
+        self.assertEqual("2024-03-01T10:04:00", rows[4]["start_reservation"])
+        self.assertEqual("", rows[0]["user"])
+
+    def test_write_csv_counts_sessions(self):
+        output = io.StringIO()
+        self.assertEqual(0, write_csv([], output))
+        self.assertEqual(','.join(EXPORT_FIELDS), output.getvalue().strip())
@@ -0,0 +1,154 @@
+import asyncio
+import datetime
+import gzip
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import bson
+from bson import json_util
+
+from labdiscoveryengine.history.retention import ArchiveModes, archive_sessions, decode_archived_session, prune_archive_files
+from labdiscoveryengine.scheduling.asyncio.runner import WorkerAggregator
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, field, direction):
+        self.documents = sorted(self.documents, key=lambda document: document[field], reverse=direction < 0)
+        return self
+
+    def limit(self, limit):
+        self.documents = self.documents[:limit]
+        return self
+
+    def __iter__(self):
+        return iter(self.documents)
+
+
+class FakeCollection:
+    """
+    Minimal pymongo collection supporting what the retention policy uses
+    """
+    def __init__(self, documents=None):
+        self.documents = list(documents or [])
+
+    def find(self, query):
+        cutoff = query['start_reservation']['$lt']
+        return FakeCursor([ document for document in self.documents if document['start_reservation'] < cutoff ])
+
+    def insert_many(self, documents, ordered=True):
+        self.documents.extend(documents)
+
+    def delete_many(self, query):
+        identifiers = set(query['_id']['$in'])
+        self.documents = [ document for document in self.documents if document['_id'] not in identifiers ]
+
+
+def _session(day: int):
+    return {
+        '_id': bson.ObjectId(),
+        'reservation_id': f'reservation-{day}',
+        'laboratory': 'robot-lab',
+        'resources': ['robot-1'],
+        'start_reservation': datetime.datetime(2024, 3, day, 10),
+    }
+
+
+class SessionRetentionTestCase(unittest.TestCase):
+    def test_archive_to_collection_in_batches(self):
+        sessions = FakeCollection([ _session(day) for day in range(1, 11) ])
+        archive = FakeCollection()
+
+        total = archive_sessions(sessions, datetime.datetime(2024, 3, 6), ArchiveModes.collection, archive_collection=archive, batch_size=2)
+
+        self.assertEqual(5, total)
+        self.assertEqual(5, len(sessions.documents))
+        self.assertEqual(5, len(archive.documents))
+        self.assertTrue(all(document['start_reservation'] >= datetime.datetime(2024, 3, 6) for document in sessions.documents))
+
+        archived = archive.documents[0]
+        self.assertIn('archived_at', archived)
+        self.assertEqual('reservation-1', archived['reservation_id'])
+        self.assertEqual(['robot-1'], decode_archived_session(archived)['resources'])
+
+    def test_archive_to_files(self):
+        sessions = FakeCollection([ _session(day) for day in range(1, 4) ])
+
+        with tempfile.TemporaryDirectory() as directory:
+            total = archive_sessions(sessions, datetime.datetime(2024, 4, 1), ArchiveModes.files, directory=directory)
+            self.assertEqual(3, total)
+            self.assertEqual([], sessions.documents)
+
+            with gzip.open(os.path.join(directory, 'sessions-2024-03.jsonl.gz'), 'rt') as archive_file:
+                archived = [ json_util.loads(line) for line in archive_file ]
+            self.assertEqual(['reservation-1', 'reservation-2', 'reservation-3'], [ session['reservation_id'] for session in archived ])
+
+            self.assertEqual([], prune_archive_files(directory, ttl_days=30))
+            future = datetime.datetime.now().timestamp() + 31 * 24 * 3600
+            self.assertEqual(1, len(prune_archive_files(directory, ttl_days=30, now=future)))
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            archive_sessions(FakeCollection(), datetime.datetime(2024, 4, 1), 'foo')
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    async def set(self, key, value, nx=False, px=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def release_lock(self, key, owner):
+        # As release_lock.lua
+        if self.values.get(key) == owner:
+            return bool(self.values.pop(key))
+        return False
+
+
+class RetentionLockTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_only_one_worker_applies_it(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def apply_retention_policy(app_config, db, max_batches):
+            calls.append(app_config)
+            started.set()
+            release.wait(5)
+            return 7
+
+        redis = FakeRedis()
+        patchers = [
+            mock.patch("labdiscoveryengine.scheduling.asyncio.runner.aioredis_store", redis),
+            mock.patch("labdiscoveryengine.scheduling.asyncio.runner.async_lua_scripts", redis),
+            mock.patch("labdiscoveryengine.scheduling.asyncio.runner.apply_retention_policy", apply_retention_policy),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # e.g., the default (unsharded) worker of two hosts
+        first, second = WorkerAggregator(), WorkerAggregator()
+        first_run = asyncio.create_task(first.run_retention_policy({}))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+
+        self.assertEqual(0, await second.run_retention_policy({}))
+
+        release.set()
+        self.assertEqual(7, await first_run)
+        self.assertEqual(1, len(calls))
+
+        # Released afterwards
+        self.assertEqual(7, await second.run_retention_policy({}))
@@ -0,0 +1,72 @@
+import math
+import datetime
+import unittest
+
+from labdiscoveryengine.history.rollups import DURATION_BUCKETS, UsageSummary, build_rollup_update, histogram_percentile, summarize_rollups
+
+
+class SessionRollupsTestCase(unittest.TestCase):
+    def test_build_rollup_update_groups_by_hour(self):
+        finished_at = datetime.datetime(2024, 3, 1, 10, 42, 13, tzinfo=datetime.timezone.utc)
+
+        rollup_filter, rollup_update = build_rollup_update(
+            laboratory="robot-lab",
+            resource="robot-1",
+            finished_at=finished_at,
+            queue_duration=12.5,
+            session_duration=250,
+        )
+
+        self.assertEqual(datetime.datetime(2024, 3, 1, 10), rollup_filter["hour"])
+        self.assertEqual("robot-1", rollup_filter["resource"])
+        increments = rollup_update["$inc"]
+        self.assertEqual(1, increments["count"])
+        self.assertEqual(12.5, increments["total_queue_duration"])
+        self.assertEqual(250, increments["total_session_duration"])
+        self.assertEqual(1, sum(value for key, value in increments.items() if key.startswith("session_histogram.")))
+
+    def test_build_rollup_update_skips_missing_durations(self):
+        _, rollup_update = build_rollup_update(
+            laboratory="robot-lab",
+            resource="robot-1",
+            finished_at=datetime.datetime(2024, 3, 1, 10, 42),
+            queue_duration=None,
+            session_duration=None,
+        )
+
+        self.assertEqual({"count": 1}, rollup_update["$inc"])
+
+    def test_histogram_percentile(self):
+        self.assertIsNone(histogram_percentile({}, 0.5))
+        # 90 sessions of at most 60 seconds, 10 sessions of at most 600 seconds
+        histogram = {"7": 90, "14": 10}
+        self.assertEqual(60, histogram_percentile(histogram, 0.5))
+        self.assertEqual(600, histogram_percentile(histogram, 0.95))
+
+    def test_histogram_percentile_overflow(self):
+        # 10 sessions longer than the last bucket
+        histogram = {"7": 90, str(len(DURATION_BUCKETS)): 10}
+        self.assertEqual(60, histogram_percentile(histogram, 0.5))
+        self.assertEqual(math.inf, histogram_percentile(histogram, 0.95))
+        self.assertEqual(f"> {DURATION_BUCKETS[-1]} s", UsageSummary.format_percentile(math.inf))
+        self.assertEqual("\u2264 60 s", UsageSummary.format_percentile(60))
+
+    def test_summarize_rollups_merges_hours(self):
+        documents = [
+            {"laboratory": "robot-lab", "resource": "robot-1", "count": 2, "session_count": 2, "total_session_duration": 100.0, "session_histogram": {"7": 2}},
+            {"laboratory": "robot-lab", "resource": "robot-1", "count": 1, "session_count": 1, "total_session_duration": 50.0, "session_histogram": {"7": 1},
+             "queue_count": 1, "total_queue_duration": 4.0, "queue_histogram": {"2": 1}},
+            {"laboratory": "robot-lab", "resource": "robot-2", "count": 1},
+        ]
+
+        summaries = summarize_rollups(documents)
+
+        self.assertEqual(["robot-1", "robot-2"], [summary.resource for summary in summaries])
+        self.assertEqual(3, summaries[0].sessions)
+        self.assertEqual(50.0, summaries[0].average_session_duration)
+        self.assertEqual(4.0, summaries[0].average_queue_duration)
+        self.assertIsNone(summaries[1].average_session_duration)
+
+        per_laboratory = summarize_rollups(documents, by_resource=False)
+        self.assertEqual(1, len(per_laboratory))
+        self.assertEqual(4, per_laboratory[0].sessions)
@@ -0,0 +1,33 @@
+import unittest
+from types import SimpleNamespace
+
+from labdiscoveryengine.utils import create_proxied_instance
+
+
+class ProxiedInstanceTestCase(unittest.TestCase):
+    def test_uninitialized_proxy_raises(self):
+        proxy = create_proxied_instance(object)
+        with self.assertRaises(Exception):
+            proxy.get("foo")
+
+    def test_methods_are_bound_directly(self):
+        obj = SimpleNamespace(get=lambda key: f"value-{key}", name="first")
+        proxy = create_proxied_instance(object)
+        proxy.set_proxied_object(obj)
+
+        self.assertEqual("value-foo", proxy.get("foo"))
+        # No wrapper: it is the method of the proxied object
+        self.assertIs(obj.get, proxy.get)
+        self.assertEqual("first", proxy.name)
+
+    def test_replacing_the_object_forgets_bound_methods(self):
+        proxy = create_proxied_instance(object)
+        proxy.set_proxied_object(SimpleNamespace(get=lambda key: "first"))
+        self.assertEqual("first", proxy.get("foo"))
+
+        proxy.set_proxied_object(SimpleNamespace(get=lambda key: "second"))
+        self.assertEqual("second", proxy.get("foo"))
+
+        proxy.set_proxied_object(None)
+        with self.assertRaises(Exception):
+            proxy.get("foo")
@@ -0,0 +1,141 @@
+import json
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from redis.asyncio.connection import Connection
+
+from labdiscoveryengine.data import Resource
+from labdiscoveryengine.scheduling.asyncio.channels import ChannelListener
+from labdiscoveryengine.scheduling.asyncio.governor import Backends, ConcurrencyGovernor
+from labdiscoveryengine.scheduling.asyncio.processor import ResourceReservationProcessor
+from labdiscoveryengine.scheduling.asyncio.redis import create_redis_client
+from labdiscoveryengine.scheduling.asyncio.resource_worker import ResourceWorker, ResourceWorkerStates
+from labdiscoveryengine.scheduling.asyncio.runner import WorkerAggregator
+
+
+class ConcurrencyGovernorTestCase(unittest.IsolatedAsyncioTestCase):
+    async def _max_concurrency(self, context_factory, tasks: int) -> int:
+        running = 0
+        max_running = 0
+
+        async def operation(index):
+            nonlocal running, max_running
+            async with context_factory(index):
+                running += 1
+                max_running = max(max_running, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        await asyncio.gather(*[ operation(index) for index in range(tasks) ])
+        return max_running
+
+    async def test_backend_limit(self):
+        governor = ConcurrencyGovernor()
+        governor.configure({ 'WORKER_MAX_MONGO_OPERATIONS': 3 })
+
+        self.assertEqual(3, await self._max_concurrency(lambda index: governor.limit(Backends.mongo), 10))
+        # Not configured: not limited
+        self.assertEqual(10, await self._max_concurrency(lambda index: governor.limit(Backends.redis), 10))
+
+    async def test_per_host_limit(self):
+        governor = ConcurrencyGovernor()
+        governor.configure({ 'WORKER_MAX_HTTP_REQUESTS': 4, 'WORKER_MAX_REQUESTS_PER_HOST': 1 })
+
+        # All in the same laboratory host
+        self.assertEqual(1, await self._max_concurrency(lambda index: governor.http_request(f"http://lab.example/ldl/sessions/{index}"), 6))
+        # Different hosts: only the global limit applies
+        self.assertEqual(4, await self._max_concurrency(lambda index: governor.http_request(f"http://lab{index}.example/ldl/sessions/"), 6))
+
+
+class FakeConnection(Connection):
+    """
+    Answers every command after a while, counting the connections in use at the same time
+    """
+    in_use = 0
+    max_in_use = 0
+
+    async def connect(self):
+        pass
+
+    async def can_read_destructive(self):
+        return False
+
+    async def send_command(self, *args, **kwargs):
+        FakeConnection.in_use += 1
+        FakeConnection.max_in_use = max(FakeConnection.max_in_use, FakeConnection.in_use)
+
+    async def read_response(self, *args, **kwargs):
+        await asyncio.sleep(0.01)
+        FakeConnection.in_use -= 1
+        return None
+
+    async def disconnect(self, nowait=False):
+        pass
+
+
+class BoundedRedisPoolTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_burst_of_processors_does_not_exceed_the_limit(self):
+        redis_obj = create_redis_client("redis://localhost", max_connections=3)
+        redis_obj.connection_pool.connection_class = FakeConnection
+
+        resource = Resource(identifier="resource-1", url="https://resource.example", login="user", password="pass",
+                            features=[], cameras=[], healthchecks=[], api="labdiscoverylib")
+        processors = [ ResourceReservationProcessor(resource, f"reservation-{index}") for index in range(20) ]
+
+        # Plain commands, not wrapped in governor.limit
+        with mock.patch("labdiscoveryengine.scheduling.asyncio.processor.aioredis_store", redis_obj):
+            results = await asyncio.gather(*[ processor.did_user_cancel() for processor in processors ])
+
+        self.assertEqual([False] * 20, results)
+        self.assertEqual(3, FakeConnection.max_in_use)
+        self.assertEqual(0, FakeConnection.in_use)
+
+
+class ChannelListenerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_messages_are_forwarded_to_the_subscriptions(self):
+        listener = ChannelListener()
+        first = listener.subscribe("lde:resources:resource-1:channel")
+        second = listener.subscribe("lde:resources:resource-1:channel")
+        other = listener.subscribe("lde:resources:resource-2:channel")
+
+        listener.deliver("lde:resources:resource-1:channel", { 'data': 'reservation-1' })
+        listener.deliver("lde:resources:resource-1:channel", { 'data': 'reservation-2' })
+
+        # Coalesced: the last one
+        self.assertEqual('reservation-2', (await first.get_message(timeout=1))['data'])
+        self.assertIsNone(await first.get_message(timeout=0.01))
+        self.assertEqual('reservation-2', (await second.get_message(timeout=1))['data'])
+        self.assertIsNone(await other.get_message(timeout=0.01))
+
+        listener.unsubscribe(first)
+        listener.unsubscribe(second)
+        self.assertEqual(["lde:resources:resource-2:channel"], list(listener.subscriptions))
+
+
+class WorkerStateReportTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_states_are_reported_in_redis(self):
+        worker = object.__new__(ResourceWorker)
+        worker.on_state_change = None
+        worker.processor = SimpleNamespace(reservation_id="reservation-1")
+        worker.state = ResourceWorkerStates.idle
+        worker.error = None
+        worker.set_state(ResourceWorkerStates.processing)
+
+        aggregator = WorkerAggregator()
+        aggregator.resource_workers["resource-1"] = worker
+        aggregator.healthcheck_workers["resource-1"] = SimpleNamespace(running=lambda: True)
+
+        fake_redis = SimpleNamespace(hset=mock.AsyncMock())
+        with mock.patch("labdiscoveryengine.scheduling.asyncio.runner.aioredis_store", fake_redis):
+            await aggregator.report_states()
+            # Not again until state_report_interval passes
+            await aggregator.report_states()
+
+        fake_redis.hset.assert_awaited_once()
+        state = json.loads(fake_redis.hset.await_args.kwargs['mapping']['resource-1'])
+        self.assertEqual(ResourceWorkerStates.processing, state['state'])
+        self.assertEqual("reservation-1", state['reservation'])
+        self.assertTrue(state['healthchecks'])
+        self.assertEqual(aggregator.owner, state['owner'])
@@ -0,0 +1,180 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from flask import Flask
+
+from labdiscoveryengine.scheduling.asyncio.leases import ResourceLeases
+from labdiscoveryengine.scheduling.asyncio.resource_worker import ResourceWorker, ResourceWorkerStates
+from labdiscoveryengine.scheduling.asyncio.runner import WorkerAggregator
+
+
+class FakeLeaseScripts:
+    """
+    Same behavior as acquire_resource_leases.lua and release_resource_leases.lua (without TTLs)
+    """
+    def __init__(self):
+        self.leases = {}
+
+    async def acquire_resource_leases(self, owner, ttl_ms, resource_names):
+        acquired = []
+        for resource_name in resource_names:
+            if self.leases.get(resource_name, owner) == owner:
+                self.leases[resource_name] = owner
+                acquired.append(resource_name)
+        return acquired
+
+    async def release_resource_leases(self, owner, resource_names):
+        for resource_name in resource_names:
+            if self.leases.get(resource_name) == owner:
+                del self.leases[resource_name]
+        return len(resource_names)
+
+
+class FakeWorker:
+    def __init__(self, resource):
+        self.resource = resource
+        self.task = None
+        self.stopped = False
+
+    def running(self):
+        return True
+
+    async def start(self):
+        self.task = asyncio.get_running_loop().create_future()
+
+    async def stop(self):
+        self.stopped = True
+
+
+class ResourceLeasesTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['LDE_CONFIG'] = SimpleNamespace(resources={ "resource-1": None, "resource-2": None })
+        self.context = self.app.app_context()
+        self.context.push()
+
+        self.scripts = FakeLeaseScripts()
+        patchers = [
+            mock.patch("labdiscoveryengine.scheduling.asyncio.leases.async_lua_scripts", self.scripts),
+            mock.patch("labdiscoveryengine.scheduling.asyncio.runner.ResourceWorker", FakeWorker),
+            mock.patch("labdiscoveryengine.scheduling.asyncio.runner.ResourceHealthchecksWorker", FakeWorker),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.context.pop()
+
+    async def test_resources_leased_by_other_workers_are_skipped(self):
+        self.scripts.leases["resource-2"] = "other-host"
+
+        aggregator = WorkerAggregator(leases=ResourceLeases(15, owner="this-host"))
+        await aggregator.update_workers()
+
+        self.assertEqual(["resource-1"], list(aggregator.resource_workers))
+        self.assertEqual({"resource-1"}, aggregator.leases.held)
+
+        # Once the other worker releases it (or its lease expires), it is taken over
+        del self.scripts.leases["resource-2"]
+        await aggregator.update_workers()
+        self.assertEqual({"resource-1", "resource-2"}, set(aggregator.resource_workers))
+
+    async def test_lost_leases_stop_the_workers(self):
+        aggregator = WorkerAggregator(leases=ResourceLeases(15, owner="this-host"))
+        await aggregator.update_workers()
+        worker = aggregator.resource_workers["resource-1"]
+
+        # The lease expired and another worker took it
+        self.scripts.leases["resource-1"] = "other-host"
+        await aggregator.renew_leases()
+
+        self.assertTrue(worker.stopped)
+        self.assertEqual(["resource-2"], list(aggregator.resource_workers))
+        self.assertEqual({"resource-2"}, aggregator.leases.held)
+
+        # Not renewed again until a third of the TTL passes
+        self.assertFalse(aggregator.leases.renewal_needed())
+
+    async def test_release_only_own_leases(self):
+        leases = ResourceLeases(15, owner="this-host")
+        await leases.acquire(["resource-1"])
+        self.scripts.leases["resource-2"] = "other-host"
+
+        await leases.release(["resource-1", "resource-2"])
+
+        self.assertEqual({"resource-2": "other-host"}, self.scripts.leases)
+        self.assertEqual(set(), leases.held)
+
+
+class HandoverTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['WORKER_DRAIN_TIMEOUT'] = 5
+        self.app.config['LDE_CONFIG'] = SimpleNamespace(resources={ "resource-1": None })
+        self.context = self.app.app_context()
+        self.context.push()
+
+        self.scripts = FakeLeaseScripts()
+        patcher = mock.patch("labdiscoveryengine.scheduling.asyncio.leases.async_lua_scripts", self.scripts)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.context.pop()
+
+    def _processing_worker(self):
+        """
+        A ResourceWorker processing a reservation that reaches a safe point once the handover is requested
+        """
+        worker = object.__new__(ResourceWorker)
+        worker.on_state_change = None
+        worker.resource_name = "resource-1"
+        worker.draining = False
+        worker.processing = True
+        worker.state = ResourceWorkerStates.processing
+        worker.processor = SimpleNamespace(handover_requested=False)
+        worker.processor.request_handover = lambda: setattr(worker.processor, 'handover_requested', True)
+
+        async def run():
+            # Like ResourceWorker.run, cancelling it stops it quietly
+            try:
+                while not worker.processor.handover_requested:
+                    await asyncio.sleep(0.01)
+            except asyncio.CancelledError:
+                pass
+
+        worker.task = asyncio.create_task(run())
+        return worker
+
+    async def test_handover_waits_for_safe_point_and_releases_lease(self):
+        leases = ResourceLeases(15, owner="this-host")
+        await leases.acquire(["resource-1"])
+
+        aggregator = WorkerAggregator(leases=leases)
+        worker = self._processing_worker()
+        healthcheck_worker = FakeWorker(None)
+        aggregator.resource_workers["resource-1"] = worker
+        aggregator.healthcheck_workers["resource-1"] = healthcheck_worker
+
+        aggregator.request_handover()
+        self.assertTrue(aggregator.stopping)
+        await aggregator.hand_over_workers()
+
+        self.assertTrue(worker.processor.handover_requested)
+        self.assertIsNone(worker.task)
+        self.assertTrue(healthcheck_worker.stopped)
+        self.assertEqual({}, aggregator.resource_workers)
+        # Other workers can take the resource immediately
+        self.assertEqual({}, self.scripts.leases)
+
+    async def test_drain_timeout_cancels_the_reservation(self):
+        worker = self._processing_worker()
+        worker.processor.request_handover = lambda: None
+
+        await worker.drain(timeout=0.05, handover=True)
+
+        self.assertTrue(worker.draining)
+        self.assertIsNone(worker.task)
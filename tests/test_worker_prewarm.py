@@ -0,0 +1,189 @@
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from labdiscoveryengine.scheduling.asyncio.resource_worker import ResourceWorker
+
+
+class FakePipeline:
+    def __init__(self, commands):
+        self.commands = commands
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    async def execute(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self, supported=True):
+        self.supported = supported
+        self.prepared = 0
+        # Set it to block prepare until it is set
+        self.release: asyncio.Event = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def prepare(self):
+        self.prepared += 1
+        if self.release is not None:
+            await self.release.wait()
+        return self.supported
+
+
+class PrewarmTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        configuration = SimpleNamespace(resources={
+            "resource-1": SimpleNamespace(identifier="resource-1", url="http://lab.example/resource-1"),
+        }, laboratories={
+            "warm-lab": SimpleNamespace(identifier="warm-lab", prewarm=2, resources={"resource-1", "resource-2", "resource-3"}),
+            "other-lab": SimpleNamespace(identifier="other-lab", prewarm=0, resources={"resource-1"}),
+        })
+        self.configuration = configuration
+        self.commands = []
+        self.pool_size = 0
+        self.client = FakeClient()
+        self.probation = set()
+        self.lua_scripts = SimpleNamespace(has_warm_candidate=mock.AsyncMock(return_value=None), assign_reservation_to_resource=mock.AsyncMock(return_value=None))
+
+        async def zcount(key, minimum, maximum):
+            return self.pool_size
+
+        patchers = [
+            mock.patch("labdiscoveryengine.scheduling.asyncio.resource_worker.worker_config", SimpleNamespace(current=configuration)),
+            mock.patch("labdiscoveryengine.scheduling.asyncio.resource_worker.aioredis_store", SimpleNamespace(zcount=zcount, pipeline=lambda: FakePipeline(self.commands))),
+            mock.patch("labdiscoveryengine.scheduling.asyncio.resource_worker.AbstractResourceClient.create", lambda resource: self.client),
+            mock.patch("labdiscoveryengine.scheduling.asyncio.resource_worker.async_lua_scripts", self.lua_scripts),
+            mock.patch("labdiscoveryengine.scheduling.asyncio.resource_worker.passive_health", SimpleNamespace(in_probation=lambda resource: resource in self.probation)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _worker(self):
+        return ResourceWorker("resource-1")
+
+    async def test_idle_resource_joins_the_warm_pool(self):
+        worker = self._worker()
+
+        await worker.prewarm()
+
+        self.assertEqual(1, self.client.prepared)
+        self.assertGreater(worker.warm_until, time.time())
+        name, (key, scores), _ = self.commands[0]
+        self.assertEqual(('zadd', 'lde:laboratories:warm-lab:warm'), (name, key))
+        # Until its worker confirms it again
+        self.assertAlmostEqual(time.time() + worker.warm_pool_liveness, scores["resource-1"], delta=5)
+
+        # Not prepared again until it is about to expire, only confirmed in the pool
+        self.commands.clear()
+        await worker.prewarm()
+        self.assertEqual(1, self.client.prepared)
+        self.assertEqual('zadd', self.commands[0][0])
+
+        # Taking a reservation leaves the pool
+        await worker.leave_warm_pool()
+        self.assertEqual(0, worker.warm_until)
+        self.assertIn(('zrem', ('lde:laboratories:warm-lab:warm', "resource-1"), {}), self.commands)
+
+    async def test_full_pool_is_not_extended(self):
+        self.pool_size = 2
+        worker = self._worker()
+
+        await worker.prewarm()
+
+        self.assertEqual(0, self.client.prepared)
+        self.assertEqual(0, worker.warm_until)
+
+    async def test_laboratories_without_prepare_support(self):
+        self.client = FakeClient(supported=False)
+        worker = self._worker()
+
+        await worker.prewarm()
+        await worker.prewarm()
+
+        self.assertEqual(1, self.client.prepared)
+        self.assertFalse(worker.prepare_supported)
+        self.assertEqual([], self.commands)
+
+    async def test_slow_prepare_does_not_block_reservations(self):
+        self.client.release = asyncio.Event()
+        worker = self._worker()
+
+        worker.start_prewarm()
+        await asyncio.sleep(0)
+        self.assertEqual(1, self.client.prepared)
+        self.assertFalse(worker.prewarm_task.done())
+
+        # Not prepared twice at the same time
+        worker.start_prewarm()
+        await asyncio.sleep(0)
+        self.assertEqual(1, self.client.prepared)
+
+        # A reservation arrives meanwhile: the resource is not added to the pool afterwards
+        await worker.leave_warm_pool()
+        self.assertIsNone(worker.prewarm_task)
+        self.client.release.set()
+        await asyncio.sleep(0)
+        self.assertEqual(0, worker.warm_until)
+        self.assertEqual([], self.commands)
+
+    async def test_resources_on_probation_are_not_prepared(self):
+        self.probation.add("resource-1")
+        worker = self._worker()
+
+        await worker.prewarm()
+
+        self.assertEqual(0, self.client.prepared)
+        self.assertEqual([], self.commands)
+
+    async def test_new_url_is_asked_to_prepare_again(self):
+        self.client = FakeClient(supported=False)
+        worker = self._worker()
+        await worker.prewarm()
+        self.assertFalse(worker.prepare_supported)
+
+        # Same laboratory server (e.g., new credentials)
+        worker.update_resource(SimpleNamespace(identifier="resource-1", url="http://lab.example/resource-1"))
+        self.assertFalse(worker.prepare_supported)
+
+        worker.update_resource(SimpleNamespace(identifier="resource-1", url="http://new-lab.example/resource-1"))
+        self.assertTrue(worker.prepare_supported)
+
+    async def test_cold_resources_defer_to_warm_ones(self):
+        worker = self._worker()
+        worker.cold_assignment_delay = 0.05
+
+        async def process_all_existing_reservations():
+            started = time.monotonic()
+            await worker.process_all_existing_reservations()
+            return time.monotonic() - started
+
+        # No prepared resource can take the next reservation
+        self.assertLess(await process_all_existing_reservations(), 0.05)
+        self.lua_scripts.has_warm_candidate.assert_awaited_once_with("resource-1")
+
+        self.lua_scripts.has_warm_candidate.return_value = "resource-2"
+        self.assertGreaterEqual(await process_all_existing_reservations(), 0.05)
+        self.lua_scripts.assign_reservation_to_resource.assert_awaited_with("resource-1")
+
+        # Once prepared, it does not wait
+        self.lua_scripts.has_warm_candidate.reset_mock()
+        worker.warm_until = time.time() + 60
+        self.assertLess(await process_all_existing_reservations(), 0.05)
+        self.lua_scripts.has_warm_candidate.assert_not_awaited()
+
+    async def test_laboratories_without_prewarm_do_not_defer(self):
+        self.configuration.laboratories["warm-lab"].prewarm = 0
+        self.lua_scripts.has_warm_candidate.return_value = "resource-2"
+        worker = self._worker()
+
+        self.assertFalse(await worker.should_defer_to_warm_resource())
+        self.lua_scripts.has_warm_candidate.assert_not_awaited()
@@ -0,0 +1,155 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from flask import Flask
+
+from labdiscoveryengine.data import HttpHealthcheck, Resource
+from labdiscoveryengine.scheduling.asyncio.config import WorkerConfiguration
+from labdiscoveryengine.scheduling.asyncio.resource_worker import ResourceWorker, ResourceWorkerStates
+from labdiscoveryengine.scheduling.asyncio.runner import WorkerAggregator
+
+
+def _resource(identifier: str, password: str = "pass", healthcheck_url: str = "http://lab.example/status") -> Resource:
+    return Resource(
+        identifier=identifier,
+        url="http://lab.example",
+        login="user",
+        password=password,
+        features=[],
+        cameras=[],
+        healthchecks=[HttpHealthcheck("status", healthcheck_url)],
+    )
+
+
+class FakeWorker:
+    def __init__(self, resource):
+        self.resource = resource
+        self.start = mock.AsyncMock()
+
+    def update_resource(self, resource):
+        self.resource = resource
+
+
+class WorkerAggregatorReloadTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['CONFIGURATION_RELOAD_INTERVAL'] = 5
+        self.app.config['LDE_CONFIG'] = SimpleNamespace(resources={"resource-1": _resource("resource-1")})
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_healthchecks_compare_by_value(self):
+        self.assertEqual(_resource("resource-1"), _resource("resource-1"))
+        self.assertNotEqual(_resource("resource-1"), _resource("resource-1", healthcheck_url="http://other.example"))
+
+    async def test_changed_resource_updates_workers(self):
+        aggregator = WorkerAggregator()
+        aggregator.last_configuration_check = 0
+        aggregator.resource_workers["resource-1"] = FakeWorker(_resource("resource-1"))
+        aggregator.healthcheck_workers["resource-1"] = FakeWorker(_resource("resource-1"))
+
+        def reload(configuration):
+            return SimpleNamespace(resources={"resource-1": _resource("resource-1", password="new-pass")})
+
+        with mock.patch("labdiscoveryengine.scheduling.asyncio.runner.get_latest_configuration", side_effect=reload) as mocked_reload:
+            await aggregator.check_configuration()
+            # Not again until CONFIGURATION_RELOAD_INTERVAL passes
+            await aggregator.check_configuration()
+
+        mocked_reload.assert_called_once()
+        self.assertEqual("new-pass", aggregator.resource_workers["resource-1"].resource.password)
+        self.assertEqual("new-pass", aggregator.healthcheck_workers["resource-1"].resource.password)
+        # Healthchecks did not change, so the healthcheck worker is not restarted
+        aggregator.healthcheck_workers["resource-1"].start.assert_not_awaited()
+
+    async def test_drain_waits_for_current_reservation(self):
+        worker = object.__new__(ResourceWorker)
+        worker.on_state_change = None
+        worker.resource_name = "resource-1"
+        worker.draining = False
+        worker.processing = True
+        worker.state = ResourceWorkerStates.processing
+
+        finished = asyncio.Event()
+
+        async def run():
+            await finished.wait()
+
+        worker.task = asyncio.create_task(run())
+        drain_task = asyncio.create_task(worker.drain())
+        await asyncio.sleep(0)
+        self.assertTrue(worker.draining)
+        self.assertFalse(drain_task.done())
+
+        finished.set()
+        await drain_task
+        self.assertIsNone(worker.task)
+
+
+class WorkerConfigurationTestCase(unittest.TestCase):
+    def test_snapshot_is_swapped_without_app_context(self):
+        app_config = {'LDE_CONFIG': SimpleNamespace(resources={})}
+        config = WorkerConfiguration()
+        config.initialize(app_config)
+
+        # No app context is needed once initialized
+        self.assertIs(app_config['LDE_CONFIG'], config.current)
+
+        new_configuration = SimpleNamespace(resources={"resource-1": _resource("resource-1")})
+        config.update(new_configuration)
+        self.assertIs(new_configuration, config.current)
+        self.assertIs(new_configuration, app_config['LDE_CONFIG'])
+
+
+class WorkerSupervisionTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_stopped_workers_are_restarted_with_backoff(self):
+        aggregator = WorkerAggregator()
+
+        class CrashingWorker:
+            draining = False
+            starts = 0
+
+            async def start(self):
+                CrashingWorker.starts += 1
+                self.task = asyncio.get_running_loop().create_future()
+
+            def running(self):
+                return not self.task.done()
+
+        worker = CrashingWorker()
+        aggregator.resource_workers["resource-1"] = worker
+        await aggregator.start_worker("resource-1", worker)
+
+        # e.g., an unexpected error in the worker
+        worker.task.set_result(None)
+        await asyncio.sleep(0)
+        self.assertTrue(aggregator.wakeup.is_set())
+        self.assertEqual(WorkerAggregator.min_restart_delay, aggregator.restart_delays["resource-1"])
+
+        # Not before the delay
+        await aggregator.restart_stopped_workers()
+        self.assertEqual(1, CrashingWorker.starts)
+
+        aggregator.restart_at["resource-1"] = 0
+        await aggregator.restart_stopped_workers()
+        self.assertEqual(2, CrashingWorker.starts)
+
+        # Stopping again right away doubles the delay
+        worker.task.set_result(None)
+        await asyncio.sleep(0)
+        self.assertEqual(2 * WorkerAggregator.min_restart_delay, aggregator.restart_delays["resource-1"])
+
+        # Workers stopped on purpose are not restarted
+        aggregator.restart_at.clear()
+        aggregator.resource_workers.pop("resource-1")
+        worker.task = asyncio.get_running_loop().create_future()
+        aggregator.started_at["resource-1"] = 0
+        worker.task.add_done_callback(lambda task: aggregator.worker_stopped("resource-1", worker))
+        worker.task.set_result(None)
+        await asyncio.sleep(0)
+        self.assertEqual({}, aggregator.restart_at)
@@ -0,0 +1,129 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from flask import Flask
+
+from labdiscoveryengine.scheduling.sharding import HashRing
+from labdiscoveryengine.scheduling.supervisor import ShardSupervisor
+from labdiscoveryengine.scheduling.asyncio.runner import WorkerAggregator
+
+
+class HashRingTestCase(unittest.TestCase):
+    def test_every_resource_has_one_shard(self):
+        ring = HashRing(4)
+        resources = [ f"resource-{i}" for i in range(400) ]
+        owned = [ ring.filter(resources, shard) for shard in range(4) ]
+
+        self.assertEqual(set(resources), set().union(*owned))
+        self.assertEqual(len(resources), sum(len(shard_resources) for shard_resources in owned))
+        # Roughly balanced
+        for shard_resources in owned:
+            self.assertGreater(len(shard_resources), 50)
+
+    def test_assignment_is_stable(self):
+        self.assertEqual(HashRing(3).get_shard("resource-1"), HashRing(3).get_shard("resource-1"))
+
+        # Adding a process only moves resources to the new one
+        resources = [ f"resource-{i}" for i in range(400) ]
+        ring, bigger_ring = HashRing(4), HashRing(5)
+        moved = [ resource for resource in resources if ring.get_shard(resource) != bigger_ring.get_shard(resource) ]
+        self.assertTrue(all(bigger_ring.get_shard(resource) == 4 for resource in moved))
+        self.assertLess(len(moved), len(resources) / 2)
+
+    def test_invalid_shards(self):
+        with self.assertRaises(ValueError):
+            HashRing(0)
+
+
+class FakeWorker:
+    def __init__(self, resource):
+        self.resource = resource
+        self.task = None
+        self.stop = mock.AsyncMock()
+
+    async def start(self):
+        self.task = asyncio.get_running_loop().create_future()
+
+    def running(self):
+        return True
+
+
+class ShardedAggregatorTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.resources = { f"resource-{i}": None for i in range(20) }
+        self.app.config['LDE_CONFIG'] = SimpleNamespace(resources=self.resources)
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    async def test_only_resources_of_the_shard_are_started(self):
+        started = set()
+        for shard in range(3):
+            aggregator = WorkerAggregator(shard=shard, shards=3)
+            with mock.patch("labdiscoveryengine.scheduling.asyncio.runner.ResourceWorker", FakeWorker), \
+                    mock.patch("labdiscoveryengine.scheduling.asyncio.runner.ResourceHealthchecksWorker", FakeWorker):
+                await aggregator.update_workers()
+
+            self.assertEqual(HashRing(3).filter(self.resources, shard), set(aggregator.resource_workers))
+            started.update(aggregator.resource_workers)
+
+        self.assertEqual(set(self.resources), started)
+
+    async def test_new_resources_are_picked_up(self):
+        aggregator = WorkerAggregator(shard=0, shards=2)
+        with mock.patch("labdiscoveryengine.scheduling.asyncio.runner.ResourceWorker", FakeWorker), \
+                mock.patch("labdiscoveryengine.scheduling.asyncio.runner.ResourceHealthchecksWorker", FakeWorker):
+            await aggregator.update_workers()
+
+            resources = dict(self.resources, **{ f"new-resource-{i}": None for i in range(20) })
+            self.app.config['LDE_CONFIG'] = SimpleNamespace(resources=resources)
+            await aggregator.update_workers()
+
+        self.assertEqual(HashRing(2).filter(resources, 0), set(aggregator.resource_workers))
+        self.assertTrue(any(resource.startswith("new-") for resource in aggregator.resource_workers))
+
+
+class FakeProcess:
+    pid = 1234
+
+    def __init__(self, target, args, name):
+        self.args = args
+        self.alive = False
+        self.exitcode = None
+
+    def start(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+
+class ShardSupervisorTestCase(unittest.TestCase):
+    def test_crashed_shards_are_restarted_with_backoff(self):
+        supervisor = ShardSupervisor(2, 'testing', context=SimpleNamespace(Process=FakeProcess))
+        with mock.patch("labdiscoveryengine.scheduling.supervisor.time.monotonic", return_value=0):
+            supervisor.check_shards(now=0)
+        self.assertEqual([0, 1], sorted(supervisor.processes))
+
+        crashed_process = supervisor.processes[1]
+        crashed_process.alive = False
+        crashed_process.exitcode = 1
+
+        supervisor.check_shards(now=5)
+        self.assertNotIn(1, supervisor.processes)
+        self.assertEqual(ShardSupervisor.MIN_RESTART_DELAY, supervisor.restart_delays[1])
+
+        with mock.patch("labdiscoveryengine.scheduling.supervisor.time.monotonic", return_value=6):
+            supervisor.check_shards(now=5 + ShardSupervisor.MIN_RESTART_DELAY)
+        self.assertIsNot(crashed_process, supervisor.processes[1])
+        self.assertEqual((1, 2, 'testing'), supervisor.processes[1].args)
+
+        # Crashing again soon doubles the delay
+        supervisor.processes[1].alive = False
+        supervisor.check_shards(now=7)
+        self.assertEqual(2 * ShardSupervisor.MIN_RESTART_DELAY, supervisor.restart_delays[1])
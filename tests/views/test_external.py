@@ -5,7 +5,7 @@ import unittest
 from unittest.mock import patch
 
 from labdiscoveryengine import create_app
-from labdiscoveryengine.scheduling.data import ReservationStatus
+from labdiscoveryengine.scheduling.data import AdmissionDecision, AdmissionScopes, ReservationStatus
 
 
 class ExternalTestCase(unittest.TestCase):
@@ -67,8 +67,9 @@ class ExternalTestCase(unittest.TestCase):
         self.assertNotIn("{laboratory}", response.json["message"])
         add_reservation.assert_not_called()
 
+    @patch("labdiscoveryengine.views.external.admit_reservation", return_value=AdmissionDecision(admitted=True))
     @patch("labdiscoveryengine.views.external.add_reservation")
-    def test_create_reservation_accepts_known_resource(self, add_reservation):
+    def test_create_reservation_accepts_known_resource(self, add_reservation, admit_reservation):
         add_reservation.return_value = ReservationStatus(
             status="queued",
             reservation_id="reservation-1",
@@ -92,8 +93,9 @@ class ExternalTestCase(unittest.TestCase):
         reservation_request = add_reservation.call_args.kwargs["reservation_request"]
         self.assertEqual(["fpga-1"], reservation_request.resources)
 
+    @patch("labdiscoveryengine.views.external.admit_reservation", return_value=AdmissionDecision(admitted=True))
     @patch("labdiscoveryengine.views.external.add_reservation")
-    def test_create_reservation_with_broken_status_returns_checker_message(self, add_reservation):
+    def test_create_reservation_with_broken_status_returns_checker_message(self, add_reservation, admit_reservation):
         add_reservation.return_value = ReservationStatus(
             status="broken",
             reservation_id="reservation-1",
@@ -115,3 +117,23 @@ class ExternalTestCase(unittest.TestCase):
         self.assertTrue(response.json["success"])
         self.assertEqual("broken", response.json["status"])
         self.assertEqual("checker says broken", response.json["message"])
+
+    @patch("labdiscoveryengine.views.external.admit_reservation", return_value=AdmissionDecision(admitted=False, reason=AdmissionScopes.external, retry_after=3))
+    @patch("labdiscoveryengine.views.external.add_reservation")
+    def test_create_reservation_rate_limited(self, add_reservation, admit_reservation):
+        response = self.client.post(
+            "/external/v1/reservations/",
+            headers=self._auth_headers(),
+            json={
+                "laboratory": "dummy",
+                "userIdentifier": "tester",
+                "backUrl": "https://example.invalid/back",
+            },
+        )
+
+        self.assertEqual(429, response.status_code)
+        self.assertEqual("3", response.headers["Retry-After"])
+        self.assertEqual("external", response.json["reason"])
+        add_reservation.assert_not_called()
+        reservation_request = admit_reservation.call_args.args[0]
+        self.assertEqual("tester@labsland", reservation_request.unique_username)
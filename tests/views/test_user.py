@@ -2,7 +2,7 @@ import unittest
 from unittest import mock
 
 from labdiscoveryengine import create_app
-from labdiscoveryengine.scheduling.data import ReservationStatus
+from labdiscoveryengine.scheduling.data import AdmissionDecision, ReservationStatus
 
 class UserTestCase(unittest.TestCase):
     def setUp(self):
@@ -65,8 +65,9 @@ class UserTestCase(unittest.TestCase):
         html = response.get_data(as_text=True)
         self.assertNotIn('src=""', html)
 
+    @mock.patch("labdiscoveryengine.views.user.admit_reservation", return_value=AdmissionDecision(admitted=True))
     @mock.patch("labdiscoveryengine.views.user.add_reservation")
-    def test_create_reservation_adds_back_variants_to_client_initial_data(self, add_reservation):
+    def test_create_reservation_adds_back_variants_to_client_initial_data(self, add_reservation, admit_reservation):
         self._login_as_admin()
         add_reservation.return_value = ReservationStatus(
             status="queued",
@@ -89,8 +90,9 @@ class UserTestCase(unittest.TestCase):
         self.assertEqual(reservation_request.back_url, reservation_request.client_initial_data['back_url'])
         self.assertEqual(reservation_request.back_url, reservation_request.client_initial_data['backUrl'])
 
+    @mock.patch("labdiscoveryengine.views.user.admit_reservation", return_value=AdmissionDecision(admitted=True))
     @mock.patch("labdiscoveryengine.views.user.add_reservation")
-    def test_create_reservation_with_broken_status_returns_checker_message(self, add_reservation):
+    def test_create_reservation_with_broken_status_returns_checker_message(self, add_reservation, admit_reservation):
         self._login_as_admin()
         add_reservation.return_value = ReservationStatus(
             status="broken",
@@ -0,0 +1,98 @@
+"""
+Micro-benchmark of the code paths that read the configuration on every request
+or every worker iteration:
+
+ - add_reservation (with Redis, MongoDB and the resource health mocked out, so
+   only the configuration-related work is measured)
+ - WorkerAggregator.update_workers (with all the workers already running)
+
+Usage:
+
+    python tools/benchmark-config.py [number of resources]
+"""
+import sys
+import time
+import asyncio
+import pathlib
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+
+from flask import Flask
+
+from labdiscoveryengine.configuration.storage import get_latest_configuration
+from labdiscoveryengine.scheduling.data import ReservationRequest
+from labdiscoveryengine.scheduling.sync import web_api
+from labdiscoveryengine.scheduling.asyncio.config import worker_config
+from labdiscoveryengine.scheduling.asyncio.runner import WorkerAggregator
+
+
+def create_deployment(directory: pathlib.Path, resources: int):
+    (directory / "configuration.yml").write_text("DEFAULT_RESOURCE_LOGIN: user\nDEFAULT_RESOURCE_PASSWORD: pass\nCONFIGURATION_CACHE: false\n")
+    (directory / "resources.yml").write_text(''.join(
+        f"resource-{i}:\n  url: http://lab.example/{i}\n  features: [feature-{i % 5}, feature-{i % 7}]\n  healthchecks:\n    status: http://lab.example/{i}/status\n"
+        for i in range(resources)
+    ))
+    (directory / "laboratories.yml").write_text(
+        "big-lab:\n  resources: [" + ", ".join(f"resource-{i}" for i in range(resources)) + "]\n"
+    )
+    (directory / "credentials.yml").write_text("administrators: {}\nexternal: {}\n")
+
+
+def measure(label: str, func, iterations: int):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed / iterations * 1e6:10.1f} us/call")
+
+
+class RunningWorker:
+    def running(self):
+        return True
+
+
+def main():
+    resources = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        create_deployment(pathlib.Path(tmpdir), resources)
+
+        app = Flask(__name__)
+        app.config['LABDISCOVERYENGINE_DIRECTORY'] = tmpdir
+        app.config['CONFIGURATION_CACHE'] = False
+
+        with app.app_context():
+            app.config['LDE_CONFIG'] = get_latest_configuration()
+            resource_names = list(app.config['LDE_CONFIG'].resources)
+
+        reservation_request = ReservationRequest(
+            identifier='reservation-1', laboratory='big-lab', features=['feature-1', 'feature-3'],
+            resources=resource_names, user_identifier='user', user_role='external', locale='en',
+            max_time=300, back_url='http://back.example',
+        )
+
+        healthy = SimpleNamespace(is_broken=False)
+        fake_lua_scripts = SimpleNamespace(store_reservation=lambda request: None, get_reservation_status=lambda identifier: None)
+
+        # Plain functions instead of mocks, so their overhead does not hide the configuration access
+        with app.test_request_context('/'), \
+                mock.patch.object(web_api, 'get_resource_health', lambda resource_name: healthy), \
+                mock.patch.object(web_api, 'sync_lua_scripts', fake_lua_scripts), \
+                mock.patch.object(web_api, 'is_mongo_active', lambda: False):
+            measure(f"add_reservation ({resources} resources)", lambda: web_api.add_reservation(reservation_request), 2000)
+
+        aggregator = WorkerAggregator()
+        for resource_name in resource_names:
+            aggregator.resource_workers[resource_name] = RunningWorker()
+            aggregator.healthcheck_workers[resource_name] = RunningWorker()
+
+        loop = asyncio.new_event_loop()
+        with app.app_context():
+            worker_config.initialize(app.config)
+            measure(f"update_workers ({resources} resources)", lambda: loop.run_until_complete(aggregator.update_workers()), 2000)
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
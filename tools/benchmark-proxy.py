@@ -0,0 +1,51 @@
+"""
+Micro-benchmark of the proxies created with create_proxied_instance (e.g.,
+aioredis_store), compared to calling the underlying object directly.
+
+Redis is replaced by an object with coroutine methods returning immediately,
+so only the overhead of the proxy is measured.
+
+Usage:
+
+    python tools/benchmark-proxy.py [iterations]
+"""
+import sys
+import time
+import asyncio
+
+from redis.asyncio import Redis
+
+from labdiscoveryengine.utils import create_proxied_instance
+
+
+class FakeRedis:
+    async def hget(self, name, key):
+        return None
+
+    async def publish(self, channel, message):
+        return 0
+
+
+async def measure(label: str, coroutine_function, iterations: int):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await coroutine_function()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<30} {elapsed / iterations * 1e9:10.1f} ns/call")
+
+
+async def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+
+    direct = FakeRedis()
+    proxy = create_proxied_instance(Redis)
+    proxy.set_proxied_object(FakeRedis())
+
+    await measure("hget (direct)", lambda: direct.hget("lde:resources:r1:health", "status"), iterations)
+    await measure("hget (proxy)", lambda: proxy.hget("lde:resources:r1:health", "status"), iterations)
+    await measure("publish (direct)", lambda: direct.publish("lde:resources:r1:channel", "new"), iterations)
+    await measure("publish (proxy)", lambda: proxy.publish("lde:resources:r1:channel", "new"), iterations)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -29,6 +29,8 @@ def main():
     reservation_id = result['reservation_id']
     previous_status = result['status']
     previous_position = result.get('position')
+    retry_after = result.get('retry_after') or 0
+    max_time = result.get('suggested_max_time') or 8
     print(time.asctime())
     pprint.pprint(result)
 
@@ -42,7 +44,9 @@ def main():
         print(f"[{time.asctime()}] Cancelled")
 
     while True:
-        parameters = f'?previous_status={previous_status}&max_time=8'
+        # As suggested by the server
+        time.sleep(retry_after)
+        parameters = f'?previous_status={previous_status}&max_time={max_time}'
         if previous_position is not None:
             parameters += f'&previous_position={previous_position}'
         print(time.asctime(), f"before request... parameters={parameters}")
@@ -52,6 +56,8 @@ def main():
         print(time.asctime(), "...after request")
         previous_status = result['status']
         previous_position = result.get('position')
+        retry_after = result.get('retry_after') or 0
+        max_time = result.get('suggested_max_time') or 8
         pprint.pprint(result)
         if result['status'] not in ('queued', 'initializing', 'ready', 'cancelling', 'finishing'):
             break